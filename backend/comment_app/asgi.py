@@ -10,15 +10,22 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "comment_app.settings")
+
+# Set up Django before importing code that uses models or settings
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
+from comment_app.jwt_cookie_middleware import JWTCookieWebSocketMiddleware
 from comment_app.routing import websocket_urlpatterns
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "comment_app.settings")
-
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
-        "websocket": AuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+        "http": django_asgi_app,
+        "websocket": AuthMiddlewareStack(
+            JWTCookieWebSocketMiddleware(URLRouter(websocket_urlpatterns))
+        ),
     }
 )
@@ -1,6 +1,17 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from users.authentication import get_token_user
+
+
 class JWTAuthenticationFromCookieMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
         # Ищем токен в cookie
@@ -8,4 +19,23 @@ class JWTAuthenticationFromCookieMiddleware:
         if access_token and "HTTP_AUTHORIZATION" not in request.META:
             # Добавляем токен в заголовок Authorization
             request.META["HTTP_AUTHORIZATION"] = f"Bearer {access_token}"
+        # A coroutine under ASGI, so async views are not run in a thread
         return self.get_response(request)
+
+
+class JWTCookieWebSocketMiddleware(BaseMiddleware):
+    """
+    Authenticate WebSocket connections from the ``access_token`` cookie,
+    like the HTTP API, instead of only from the Django session.
+
+    Goes inside ``AuthMiddlewareStack``, which parses the cookies and sets
+    the session user that is kept when there is no valid token.
+    """
+
+    async def __call__(self, scope, receive, send):
+        access_token = scope.get("cookies", {}).get("access_token")
+        if access_token:
+            user = await database_sync_to_async(get_token_user)(access_token)
+            if user is not None:
+                scope = dict(scope, user=user)
+        return await super().__call__(scope, receive, send)
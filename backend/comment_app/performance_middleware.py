@@ -0,0 +1,202 @@
+import logging
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+_metrics = ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """Counters for one sampled request; also its DB execute wrapper."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.timings = defaultdict(float)
+        self.depth = defaultdict(int)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    """Forward queries to the current request's metrics, if it is sampled."""
+    metrics = _metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def _install_execute_wrapper(connection, **kwargs):
+    # Installed on every connection instead of per request, because under
+    # ASGI queries run on other threads' connections. The request's metrics
+    # reach them through the context variable.
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+connection_created.connect(_install_execute_wrapper)
+
+
+@contextmanager
+def timed(name):
+    """
+    Add the time spent in the block to the current request's ``name`` timing.
+
+    Nested blocks with the same name are only counted once, so e.g. nested
+    serializers do not double-count. Does nothing outside sampled requests.
+    Also usable as a decorator.
+    """
+    metrics = _metrics.get()
+    if metrics is None or metrics.depth[name]:
+        yield
+        return
+
+    metrics.depth[name] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[name] += time.perf_counter() - started
+        metrics.depth[name] -= 1
+
+
+def record_cache(hit):
+    """Count a cache hit or miss for the current request, if sampled."""
+    metrics = _metrics.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+class PerformanceMiddleware:
+    """
+    Measure total time, database queries, cache hits and serialization.
+
+    A ``PERFORMANCE_SAMPLE_RATE`` fraction of requests is instrumented. The
+    numbers are logged as structured fields (at WARNING above
+    ``PERFORMANCE_SLOW_REQUEST_MS``) and, with ``PERFORMANCE_SERVER_TIMING``,
+    returned in a ``Server-Timing`` header that browser dev tools display.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        for alias in connections:  # Connections opened before this import
+            _install_execute_wrapper(connections[alias])
+
+    def sampled(self):
+        rate = settings.PERFORMANCE_SAMPLE_RATE
+        return rate > 0 and (rate >= 1 or random.random() < rate)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = _metrics.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _metrics.reset(token)
+
+        self.report(request, response, metrics, time.perf_counter() - metrics.started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = _metrics.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _metrics.reset(token)
+
+        self.report(request, response, metrics, time.perf_counter() - metrics.started)
+        return response
+
+    def process_template_response(self, request, response):
+        """Time the rendering of DRF/template responses, which happens next."""
+        metrics = _metrics.get()
+        if metrics is not None:
+            started = time.perf_counter()
+
+            def rendered(response):
+                metrics.timings["render"] += time.perf_counter() - started
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def report(self, request, response, metrics, total):
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total * 1000, 2),
+            "db_queries": metrics.queries,
+            "db_ms": round(metrics.db_time * 1000, 2),
+            "cache_hits": metrics.cache_hits,
+            "cache_misses": metrics.cache_misses,
+            **{
+                f"{name}_ms": round(seconds * 1000, 2)
+                for name, seconds in metrics.timings.items()
+            },
+        }
+
+        if settings.PERFORMANCE_SERVER_TIMING:
+            timings = dict(metrics.timings)
+            cache_entry = (
+                f'cache;desc="{metrics.cache_hits} hits, '
+                f'{metrics.cache_misses} misses"'
+            )
+            if "cache" in timings:
+                cache_entry += f";dur={round(timings.pop('cache') * 1000, 2)}"
+            entries = [
+                f"total;dur={fields['total_ms']}",
+                f'db;dur={fields["db_ms"]};desc="{metrics.queries} queries"',
+                cache_entry,
+            ]
+            entries += [
+                f"{name};dur={round(seconds * 1000, 2)}"
+                for name, seconds in timings.items()
+            ]
+            if response.has_header("Server-Timing"):
+                entries.insert(0, response["Server-Timing"])
+            response["Server-Timing"] = ", ".join(entries)
+
+        level = (
+            logging.WARNING
+            if fields["total_ms"] >= settings.PERFORMANCE_SLOW_REQUEST_MS
+            else logging.INFO
+        )
+        logger.log(
+            level,
+            " ".join(f"{key}={value}" for key, value in fields.items()),
+            extra={"performance": fields},
+        )
@@ -0,0 +1,275 @@
+import ipaddress
+import logging
+import math
+import threading
+import time
+from functools import lru_cache
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+from comment_app.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Sliding-window counter: the previous fixed window's count is weighted by how
+# much of it still overlaps the sliding window. One hash per client holds the
+# window index and both counts, updated in one atomic step on the Redis clock.
+# ARGV[3] is the number of requests to record; 0 only checks the quota.
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = (tonumber(clock[1]) + tonumber(clock[2]) / 1000000) / window
+local index = math.floor(now)
+local state = redis.call('HMGET', KEYS[1], 'index', 'current', 'previous')
+local stored = tonumber(state[1]) or index
+local current = tonumber(state[2]) or 0
+local previous = tonumber(state[3]) or 0
+if stored == index - 1 then
+    previous = current
+    current = 0
+elseif stored ~= index then
+    previous = 0
+    current = 0
+end
+local elapsed = now - index
+local count = previous * (1 - elapsed) + current
+local allowed = 0
+if count + math.max(cost, 1) <= limit then
+    allowed = 1
+    current = current + cost
+    count = count + cost
+    redis.call('HSET', KEYS[1], 'index', index, 'current', current, 'previous', previous)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(window * 2000))
+end
+return {allowed, tostring(count), tostring(elapsed), current, previous}
+"""
+
+_script = None
+
+
+@lru_cache(maxsize=8)
+def trusted_networks(proxies):
+    return [ipaddress.ip_network(proxy, strict=False) for proxy in proxies]
+
+
+def get_client_ip(request):
+    """
+    Return the client address, honouring ``X-Forwarded-For`` only from
+    ``TRUSTED_PROXIES``.
+
+    The header is read right to left, skipping trusted proxies, so addresses
+    a client prepends itself are never used.
+    """
+    return resolve_client_ip(
+        request.META.get("REMOTE_ADDR", ""),
+        request.META.get("HTTP_X_FORWARDED_FOR", ""),
+    )
+
+
+def get_scope_client_ip(scope):
+    """Like ``get_client_ip``, for an ASGI (e.g. WebSocket) scope."""
+    headers = dict(scope.get("headers") or [])
+    return resolve_client_ip(
+        (scope.get("client") or [""])[0],
+        headers.get(b"x-forwarded-for", b"").decode("latin1"),
+    )
+
+
+def resolve_client_ip(address, forwarded):
+    networks = trusted_networks(tuple(settings.TRUSTED_PROXIES))
+
+    def is_trusted(address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in networks)
+
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    while hops and is_trusted(address):
+        address = hops.pop()
+    return address
+
+
+class RateLimitResult:
+    """Outcome of a rate limit check, convertible to response headers."""
+
+    def __init__(self, allowed, limit, window, count, elapsed, current, previous):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = max(0, math.floor(limit - count))
+        # Seconds until the current fixed window rolls over
+        self.reset = math.ceil((1 - elapsed) * window)
+        self.retry_after = 0
+        if not allowed:
+            room = limit - 1 - current
+            if previous and room >= 0:
+                # The previous window's weight drops below the remaining room
+                self.retry_after = (1 - room / previous - elapsed) * window
+            else:
+                # This window's requests must first fade as the previous one
+                self.retry_after = (2 - elapsed - (limit - 1) / current) * window
+            self.retry_after = max(1, math.ceil(self.retry_after))
+
+    def headers(self):
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+class SlidingWindowLimiter:
+    """
+    Sliding-window rate limit shared by every worker (``RATE_LIMIT_BACKEND``
+    "redis", one round trip per check) or kept per process ("local").
+
+    Args:
+        scope (str): Key in ``RATE_LIMITS``, giving (requests, window seconds)
+    """
+
+    _local_state = {}
+    _local_lock = threading.Lock()
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.limit, self.window = settings.RATE_LIMITS[scope]
+
+    def key(self, ident):
+        return f"ratelimit:{self.scope}:{ident}"
+
+    def hit(self, ident, cost=1):
+        """
+        Record ``cost`` requests for ``ident`` if the quota allows one more.
+
+        Fails open when Redis is unreachable.
+
+        Returns:
+            RateLimitResult
+        """
+        try:
+            if settings.RATE_LIMIT_BACKEND == "redis":
+                state = self._hit_redis(ident, cost)
+            else:
+                state = self._hit_local(ident, cost)
+        except Exception as e:
+            logger.error(f"Error checking rate limit {self.scope}: {str(e)}")
+            state = (True, 0, 0, 0, 0)
+        return RateLimitResult(state[0], self.limit, self.window, *state[1:])
+
+    def check(self, ident):
+        """Whether ``ident`` may make one more request, without recording it."""
+        return self.hit(ident, cost=0)
+
+    def reset(self, ident):
+        """Forget ``ident``'s requests, e.g. after a successful login."""
+        try:
+            if settings.RATE_LIMIT_BACKEND == "redis":
+                get_redis_client().delete(self.key(ident))
+            else:
+                with self._local_lock:
+                    self._local_state.pop(self.key(ident), None)
+        except Exception as e:
+            logger.error(f"Error resetting rate limit {self.scope}: {str(e)}")
+
+    def _hit_redis(self, ident, cost):
+        global _script
+        if _script is None:
+            _script = get_redis_client().register_script(SLIDING_WINDOW_SCRIPT)
+        allowed, count, elapsed, current, previous = _script(
+            keys=[self.key(ident)], args=[self.limit, self.window, cost]
+        )
+        return bool(allowed), float(count), float(elapsed), current, previous
+
+    def _hit_local(self, ident, cost):
+        now = time.time() / self.window
+        index = math.floor(now)
+        elapsed = now - index
+        key = self.key(ident)
+        with self._local_lock:
+            stored, current, previous = self._local_state.get(key, (index, 0, 0))
+            if stored == index - 1:
+                previous, current = current, 0
+            elif stored != index:
+                previous, current = 0, 0
+            count = previous * (1 - elapsed) + current
+            allowed = count + max(cost, 1) <= self.limit
+            if allowed:
+                current += cost
+                count += cost
+                self._local_state[key] = (index, current, previous)
+        return allowed, count, elapsed, current, previous
+
+
+def set_rate_limit(request, result):
+    """Remember ``result`` so RateLimitHeadersMiddleware adds its headers."""
+    request = getattr(request, "_request", request)  # DRF Request -> Django
+    request.rate_limit = result
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    DRF throttle backed by SlidingWindowLimiter.
+
+    Subclasses set ``scope``, and optionally ``methods`` to limit only e.g.
+    POSTs. Authenticated users are limited per user, others per client IP.
+    """
+
+    scope = None
+    methods = None
+
+    def allow_request(self, request, view):
+        if self.methods and request.method not in self.methods:
+            return True
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            ident = f"user:{user.pk}"
+        else:
+            ident = f"ip:{get_client_ip(request)}"
+        self.result = SlidingWindowLimiter(self.scope).hit(ident)
+        set_rate_limit(request, self.result)
+        return self.result.allowed
+
+    def wait(self):
+        return self.result.retry_after
+
+
+class CaptchaRateThrottle(SlidingWindowThrottle):
+    scope = "captcha"
+
+
+class CommentCreateRateThrottle(SlidingWindowThrottle):
+    scope = "comments"
+    methods = ("POST",)
+
+
+class RateLimitHeadersMiddleware:
+    """Add ``X-RateLimit-*`` headers for requests that were rate limited."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.add_headers(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.add_headers(request, await self.get_response(request))
+
+    def add_headers(self, request, response):
+        result = getattr(request, "rate_limit", None)
+        if result is not None:
+            for header, value in result.headers().items():
+                response[header] = value
+        return response
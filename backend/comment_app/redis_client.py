@@ -0,0 +1,15 @@
+import redis
+from django.conf import settings
+
+_client = None
+
+
+def get_redis_client():
+    """
+    Return a shared redis-py client for features that need native Redis
+    commands (queues, streams, atomic scripts) beyond the Django cache API.
+    """
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
@@ -62,6 +62,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its total covers every other middleware
+    "comment_app.performance_middleware.PerformanceMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -71,6 +73,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "comment_app.jwt_cookie_middleware.JWTAuthenticationFromCookieMiddleware",
+    "comment_app.ratelimit.RateLimitHeadersMiddleware",
 ]
 
 
@@ -95,6 +98,8 @@ TEMPLATES = [
 # WSGI_APPLICATION = "comment_app.wsgi.application"
 ASGI_APPLICATION = "comment_app.asgi.application"
 
+REDIS_URL = config("REDIS_URL", default="redis://redis:6379/0")
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -107,11 +112,103 @@ CHANNEL_LAYERS = {
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.redis.RedisCache",
-        "LOCATION": "redis://redis",
+        "LOCATION": REDIS_URL,
         "TIMEOUT": 300,
     }
 }
 
+# Cached comment list pages are invalidated on write (comments/caching.py),
+# so the TTL only bounds memory use.
+COMMENT_CACHE_TIMEOUT = config("COMMENT_CACHE_TIMEOUT", default=6 * 60 * 60, cast=int)
+# Optional per-worker LRU tier in front of Redis for hot list pages
+COMMENT_LOCAL_CACHE_ENABLED = config(
+    "COMMENT_LOCAL_CACHE_ENABLED", default=False, cast=bool
+)
+COMMENT_LOCAL_CACHE_SIZE = config("COMMENT_LOCAL_CACHE_SIZE", default=256, cast=int)
+COMMENT_LOCAL_CACHE_GENERATION_TTL = config(
+    "COMMENT_LOCAL_CACHE_GENERATION_TTL", default=1, cast=float
+)
+
+# Image thumbnailing runs off the request path: "local" uses an in-process
+# thread pool, "redis" queues jobs for `manage.py process_images` workers and
+# "sync" processes inline (tests).
+COMMENT_IMAGE_QUEUE = config("COMMENT_IMAGE_QUEUE", default="local")
+COMMENT_IMAGE_WORKERS = config("COMMENT_IMAGE_WORKERS", default=2, cast=int)
+# Seconds after which a job processing a shared image blob is presumed dead
+COMMENT_IMAGE_PROCESSING_TIMEOUT = config(
+    "COMMENT_IMAGE_PROCESSING_TIMEOUT", default=120, cast=int
+)
+# Per-field byte limits and image pixel cap enforced while uploads stream in
+COMMENT_UPLOAD_LIMITS = {"image": 5 * 1024 * 1024, "file": 100 * 1024}
+COMMENT_MAX_IMAGE_PIXELS = config(
+    "COMMENT_MAX_IMAGE_PIXELS", default=4096 * 4096, cast=int
+)
+COMMENT_MAX_IMAGE_FRAMES = config("COMMENT_MAX_IMAGE_FRAMES", default=100, cast=int)
+
+# WebSocket fan-out: events are queued on commit (at most
+# COMMENT_WS_OUTBOX_SIZE per worker), serialized once and coalesced per window
+# (seconds); each socket buffers at most COMMENT_WS_SEND_QUEUE_SIZE frames
+# before it is dropped as too slow.
+COMMENT_WS_BATCH_WINDOW = config("COMMENT_WS_BATCH_WINDOW", default=0.05, cast=float)
+COMMENT_WS_MAX_BATCH = config("COMMENT_WS_MAX_BATCH", default=100, cast=int)
+COMMENT_WS_OUTBOX_SIZE = config("COMMENT_WS_OUTBOX_SIZE", default=10000, cast=int)
+COMMENT_WS_SEND_QUEUE_SIZE = config("COMMENT_WS_SEND_QUEUE_SIZE", default=100, cast=int)
+# Broadcast events are numbered and the last COMMENT_WS_REPLAY_SIZE kept in a
+# Redis stream ("local": in-process, single worker) so reconnecting clients
+# can resume with ?last_seq= instead of refetching.
+COMMENT_WS_REPLAY = config("COMMENT_WS_REPLAY", default="redis")
+COMMENT_WS_REPLAY_SIZE = config("COMMENT_WS_REPLAY_SIZE", default=10000, cast=int)
+COMMENT_WS_REPLAY_LIMIT = config("COMMENT_WS_REPLAY_LIMIT", default=1000, cast=int)
+# Client frames: maximum size, token buckets as (messages per second, burst)
+# per connection and per user (per client IP for anonymous sockets), and
+# whether clients may broadcast comments.
+COMMENT_WS_MAX_MESSAGE_BYTES = config(
+    "COMMENT_WS_MAX_MESSAGE_BYTES", default=4096, cast=int
+)
+COMMENT_WS_RATE_LIMITS = {"connection": (5, 50), "user": (10, 100)}
+COMMENT_WS_CLIENT_BROADCAST = config(
+    "COMMENT_WS_CLIENT_BROADCAST", default=False, cast=bool
+)
+# Upper bound on topic groups (threads) a single socket may subscribe to
+COMMENT_WS_MAX_SUBSCRIPTIONS = config(
+    "COMMENT_WS_MAX_SUBSCRIPTIONS", default=500, cast=int
+)
+
+# Per-request instrumentation (comment_app/performance_middleware.py): the
+# fraction of requests measured, whether to send Server-Timing headers and
+# the duration above which a request is logged as a warning. Server-Timing
+# exposes query counts and timings to any client, so it is off unless DEBUG.
+PERFORMANCE_SAMPLE_RATE = config("PERFORMANCE_SAMPLE_RATE", default=0.05, cast=float)
+PERFORMANCE_SERVER_TIMING = config(
+    "PERFORMANCE_SERVER_TIMING", default=DEBUG, cast=bool
+)
+PERFORMANCE_SLOW_REQUEST_MS = config(
+    "PERFORMANCE_SLOW_REQUEST_MS", default=500, cast=int
+)
+
+# Sliding-window rate limits (comment_app/ratelimit.py) as (requests, window
+# seconds): failed logins and CAPTCHAs per client IP, comment POSTs per user.
+# "redis" shares the counters between workers, "local" keeps them per process.
+RATE_LIMIT_BACKEND = config("RATE_LIMIT_BACKEND", default="redis")
+RATE_LIMITS = {"login": (5, 15 * 60), "captcha": (10, 60), "comments": (10, 60)}
+# Proxies (addresses or CIDR ranges) whose X-Forwarded-For is trusted, e.g.
+# nginx on the Docker network. Other hops in the header are ignored.
+TRUSTED_PROXIES = config(
+    "TRUSTED_PROXIES",
+    default="127.0.0.1 ::1 10.0.0.0/8 172.16.0.0/12 192.168.0.0/16",
+).split()
+
+# Users resolved from access tokens are cached for AUTH_USER_CACHE_TIMEOUT
+# seconds (dropped when the user is saved) and per process for
+# AUTH_USER_CACHE_LOCAL_TTL seconds; comment reads trust the token claims.
+AUTH_USER_CACHE_TIMEOUT = config("AUTH_USER_CACHE_TIMEOUT", default=60, cast=int)
+AUTH_USER_CACHE_LOCAL_TTL = config("AUTH_USER_CACHE_LOCAL_TTL", default=5, cast=float)
+AUTH_USER_CACHE_LOCAL_SIZE = 1024
+# Password hashing for the async auth views runs in AUTH_HASH_WORKERS threads
+# (0: inline, tests); at most AUTH_HASH_QUEUE_SIZE more logins or sign-ups
+# wait, further ones get an immediate 503.
+AUTH_HASH_WORKERS = config("AUTH_HASH_WORKERS", default=4, cast=int)
+AUTH_HASH_QUEUE_SIZE = config("AUTH_HASH_QUEUE_SIZE", default=16, cast=int)
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=15),
@@ -133,9 +230,7 @@ SESSION_COOKIE_DOMAIN = config("SESSION_COOKIE_DOMAIN", default=None)
 REST_FRAMEWORK = {
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 25,
-    "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
-    ),
+    "DEFAULT_AUTHENTICATION_CLASSES": ("users.authentication.CachedJWTAuthentication",),
     # "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
 }
 
@@ -143,6 +238,23 @@ REST_FRAMEWORK = {
 CAPTCHA_LENGTH = 6  # Length of CAPTCHA text
 CAPTCHA_TIMEOUT = 5  # CAPTCHA timeout in minutes
 CAPTCHA_CHALLENGE_FUNCT = "comment_app.custom_generate_captcha.generate_captcha"
+# Where CAPTCHA answers and images live: "redis" (native TTLs, atomic
+# consume), "local" (per process, tests) or "db" (django-simple-captcha table).
+COMMENT_CAPTCHA_BACKEND = config("COMMENT_CAPTCHA_BACKEND", default="redis")
+# get_captcha hands out pre-rendered CAPTCHAs from a pool: "local" keeps it
+# per process with a refill thread, "redis" shares one list filled by
+# `manage.py refill_captchas`, which also removes expired CAPTCHAs (db).
+# The redis pool is kept at POOL_SIZE; a local pool follows recent demand
+# within POOL_MIN..POOL_SIZE.
+COMMENT_CAPTCHA_POOL = config("COMMENT_CAPTCHA_POOL", default="local")
+COMMENT_CAPTCHA_POOL_SIZE = config("COMMENT_CAPTCHA_POOL_SIZE", default=500, cast=int)
+COMMENT_CAPTCHA_POOL_MIN = config("COMMENT_CAPTCHA_POOL_MIN", default=10, cast=int)
+COMMENT_CAPTCHA_POOL_BATCH = 100  # CAPTCHAs per bulk INSERT
+# Seconds an entry may wait in the pool; it stays valid CAPTCHA_TIMEOUT after
+COMMENT_CAPTCHA_POOL_MAX_AGE = config(
+    "COMMENT_CAPTCHA_POOL_MAX_AGE", default=600, cast=int
+)
+COMMENT_CAPTCHA_CLEANUP_INTERVAL = 60  # Seconds between expired-row deletes
 
 CSRF_COOKIE_SAMESITE = "Lax"
 SESSION_COOKIE_SAMESITE = "Lax"
@@ -244,6 +356,10 @@ LOGGING = {
         },
     },
     "loggers": {
+        "comment_app.performance_middleware": {
+            "handlers": ["file"],
+            "level": "INFO",
+        },
         "your_app_name": {  # Replace with your app name
             "handlers": ["file", "console"],
             "level": "DEBUG",
@@ -22,13 +22,14 @@ from django.conf.urls.static import static
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
 )
+from comments.views import captcha_image
 from users.views import CustomTokenRefreshView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("users.urls")),
     path("api/", include("comments.urls")),
-    path("captcha/", include("captcha.urls")),
+    path("captcha/image/<str:key>/", captcha_image, name="captcha-image"),
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/token/refresh/", CustomTokenRefreshView.as_view(), name="token_refresh"),
 ]
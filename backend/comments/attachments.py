@@ -0,0 +1,77 @@
+import logging
+from django.db import transaction
+from django.db.models import F
+from .models import StoredFile
+from .storage import attachment_storage
+
+logger = logging.getLogger(__name__)
+
+
+def variant_names(variants):
+    """Return the storage names of the files in ``Comment.image_variants``."""
+    return {
+        value
+        for variant in (variants or {}).values()
+        for key, value in variant.items()
+        if key not in ("width", "height")
+    }
+
+
+def attachment_names(comment):
+    """Return every storage name a comment references (files and variants)."""
+    names = {field.name for field in (comment.image, comment.file) if field}
+    return names | variant_names(comment.image_variants)
+
+
+def lock_blobs(names):
+    """
+    Lock the StoredFile rows of ``names`` until the transaction ends.
+
+    ``collect_garbage`` locks the same rows before deleting, so blobs that
+    exist once this returns cannot be deleted before the caller's reference
+    is committed.
+
+    Returns:
+        bool: True if every blob still exists in storage
+    """
+    if not names:
+        return True
+    list(
+        StoredFile.objects.select_for_update()
+        .filter(name__in=names)
+        .values_list("pk", flat=True)
+    )
+    return all(attachment_storage.exists(name) for name in names)
+
+
+def retain(names):
+    """Add one reference to each stored file in ``names``."""
+    if not names:
+        return
+    StoredFile.objects.bulk_create(
+        [StoredFile(name=name) for name in names], ignore_conflicts=True
+    )
+    StoredFile.objects.filter(name__in=names).update(ref_count=F("ref_count") + 1)
+
+
+def release(names):
+    """Drop one reference from each name and collect orphans after commit."""
+    if not names:
+        return
+    StoredFile.objects.filter(name__in=names).update(ref_count=F("ref_count") - 1)
+    names = list(names)
+    transaction.on_commit(lambda: collect_garbage(names))
+
+
+def collect_garbage(names):
+    """Delete the blobs among ``names`` that are no longer referenced."""
+    try:
+        with transaction.atomic():
+            for stored in StoredFile.objects.select_for_update().filter(name__in=names):
+                if stored.ref_count > 0:
+                    continue  # Referenced again before we got the lock
+                attachment_storage.delete(stored.name)
+                logger.info(f"Deleted unreferenced attachment {stored.name}")
+                stored.delete()
+    except Exception as e:
+        logger.error(f"Error collecting unreferenced attachments: {str(e)}")
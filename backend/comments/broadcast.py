@@ -0,0 +1,147 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from .replay import get_replay_buffer
+
+logger = logging.getLogger(__name__)
+
+ALL_GROUP = "comments"
+TOP_GROUP = "comments.top"
+THREAD_GROUP = "comments.thread.{}"
+
+
+def topic_group(topic):
+    """
+    Map a client topic to its channel layer group.
+
+    Args:
+        topic (str): "all" (every event), "top" (top-level comments) or
+            "thread:<id>" (direct replies to comment ``id``)
+
+    Returns:
+        str | None: The group name, or None if the topic is invalid
+    """
+    if topic == "all":
+        return ALL_GROUP
+    if topic == "top":
+        return TOP_GROUP
+    if isinstance(topic, str) and topic.startswith("thread:"):
+        comment_id = topic[len("thread:") :]
+        if comment_id.isdigit():
+            return THREAD_GROUP.format(int(comment_id))
+    return None
+
+
+def comment_groups(parent_id):
+    """Return the groups that events about a comment under ``parent_id`` go to."""
+    if parent_id:
+        return [ALL_GROUP, THREAD_GROUP.format(parent_id)]
+    return [ALL_GROUP, TOP_GROUP]
+
+
+class CommentBroadcaster:
+    """
+    Coalesce WebSocket events into time-windowed batches per group.
+
+    ``publish`` only appends to an in-memory outbox; a background thread
+    drains it every ``COMMENT_WS_BATCH_WINDOW`` seconds (or as soon as
+    ``COMMENT_WS_MAX_BATCH`` events are waiting), so callers never wait on
+    Redis or the channel layer. Each drained event is serialized to JSON
+    exactly once, numbered by the replay buffer, and every group's batch is
+    sent with a single ``group_send`` carrying the texts once. Consumers
+    forward the pre-serialized texts as-is (batching clients get them joined
+    into one array frame), so nothing is re-serialized per socket.
+    """
+
+    def __init__(self):
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @property
+    def window(self):
+        return getattr(settings, "COMMENT_WS_BATCH_WINDOW", 0.05)
+
+    @property
+    def max_batch(self):
+        return getattr(settings, "COMMENT_WS_MAX_BATCH", 100)
+
+    @property
+    def max_pending(self):
+        return getattr(settings, "COMMENT_WS_OUTBOX_SIZE", 10000)
+
+    def publish(self, groups, message):
+        """Queue ``message`` for each of ``groups``; safe to call from any thread."""
+        with self._condition:
+            if len(self._pending) >= self.max_pending:
+                # The channel layer is not keeping up; clients resync on gaps
+                logger.error("WebSocket outbox is full, dropping oldest event")
+                self._pending.popleft()
+            self._pending.append((list(groups), message))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="comment-broadcaster", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._condition.wait(timeout=60)
+                    if not self._pending:  # Idle: let the thread exit
+                        self._thread = None
+                        return
+                # Let the window fill up unless a batch is already full
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(timeout=remaining)
+            self.flush()
+
+    def flush(self):
+        """Serialize, number and send every pending event now."""
+        with self._condition:
+            pending, self._pending = self._pending, deque()
+        if not pending:
+            return
+
+        events = [
+            (groups, json.dumps(message, cls=DjangoJSONEncoder))
+            for groups, message in pending
+        ]
+        try:
+            # Numbered and kept for clients that reconnect (comments/replay.py)
+            stamped = get_replay_buffer().append(events)
+            events = [(groups, text) for (groups, _), (_, text) in zip(events, stamped)]
+        except Exception as e:
+            logger.error(f"Error recording events for replay: {str(e)}")
+
+        batches = defaultdict(list)
+        for groups, text in events:
+            for group in groups:
+                batches[group].append(text)
+        for group, texts in batches.items():
+            for start in range(0, len(texts), self.max_batch):
+                self._send(group, texts[start : start + self.max_batch])
+
+    def _send(self, group, texts):
+        try:
+            async_to_sync(get_channel_layer().group_send)(
+                group,
+                {"type": "send_batch", "texts": texts},
+            )
+        except Exception as e:
+            logger.error(f"Error broadcasting to {group}: {str(e)}")
+
+
+broadcaster = CommentBroadcaster()
@@ -0,0 +1,263 @@
+import gzip
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.redis import RedisCache
+from rest_framework.renderers import JSONRenderer
+from comment_app.performance_middleware import record_cache, timed
+
+logger = logging.getLogger(__name__)
+
+LIST_CACHE_PREFIX = "comment_list"
+LIST_GENERATION_KEY = f"{LIST_CACHE_PREFIX}:generation"
+COMPRESS_MIN_SIZE = 1024
+
+# Compare-and-delete, so only the holder of a rebuild lock releases it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LocalPageCache:
+    """
+    Bounded in-process LRU tier in front of the shared Django cache.
+
+    Entries are only trusted together with a generation number that is
+    re-read from the shared cache at most once per ``generation_ttl``
+    seconds, which is how writes in other workers invalidate this tier.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._generation_checked = 0.0
+        self.stats = {
+            "local": {"hits": 0, "misses": 0},
+            "shared": {"hits": 0, "misses": 0},
+        }
+
+    @property
+    def enabled(self):
+        return getattr(settings, "COMMENT_LOCAL_CACHE_ENABLED", False)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, "COMMENT_LOCAL_CACHE_SIZE", 256)
+
+    @property
+    def generation_ttl(self):
+        return getattr(settings, "COMMENT_LOCAL_CACHE_GENERATION_TTL", 1)
+
+    def get_generation(self):
+        """Return the locally known generation if it was checked recently."""
+        if time.monotonic() - self._generation_checked < self.generation_ttl:
+            return self._generation
+        return None
+
+    def set_generation(self, generation):
+        self._generation = generation
+        self._generation_checked = time.monotonic()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record(self, tier, hit):
+        record_cache(hit)
+        with self._lock:
+            self.stats[tier]["hits" if hit else "misses"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation = None
+            self._generation_checked = 0.0
+            for counters in self.stats.values():
+                counters.update(hits=0, misses=0)
+
+
+local_cache = LocalPageCache()
+
+
+def get_cache_stats():
+    """Return hit/miss counters per cache tier for this worker process."""
+    return {
+        "local_enabled": local_cache.enabled,
+        "local_entries": len(local_cache._entries),
+        **{tier: dict(counters) for tier, counters in local_cache.stats.items()},
+    }
+
+
+def get_list_generation():
+    """
+    Return the current generation of the comment list cache.
+
+    Every cached list page records the generation it was built for, so
+    bumping the generation makes all pages stale at once without scanning keys.
+    """
+    generation = cache.get(LIST_GENERATION_KEY)
+    if generation is None:
+        # Seed from the clock so an evicted counter never reuses old values
+        cache.add(LIST_GENERATION_KEY, int(time.time() * 1000), timeout=None)
+        generation = cache.get(LIST_GENERATION_KEY)
+    return generation
+
+
+def bump_list_generation():
+    """Invalidate every cached comment list page in O(1)."""
+    local_cache.set_generation(None)
+    try:
+        try:
+            return cache.incr(LIST_GENERATION_KEY)
+        except ValueError:  # Counter missing or evicted
+            get_list_generation()
+            return cache.incr(LIST_GENERATION_KEY)
+    except Exception as e:
+        logger.error(f"Error invalidating comment list cache: {str(e)}")
+
+
+@timed("cache")
+def get_cached_page(cache_key):
+    """
+    Fetch a cached list page and the current generation.
+
+    The in-process tier is consulted first when enabled; otherwise the page
+    and the generation come from the shared cache in one round trip.
+
+    Returns:
+        Tuple ``(entry, generation)``; ``entry`` is None on a miss.
+    """
+    if local_cache.enabled:
+        generation = local_cache.get_generation()
+        if generation is not None:
+            entry = local_cache.get(cache_key)
+            if is_fresh(entry, generation):
+                local_cache.record("local", hit=True)
+                return entry, generation
+        local_cache.record("local", hit=False)
+
+    values = cache.get_many([cache_key, LIST_GENERATION_KEY])
+    generation = values.get(LIST_GENERATION_KEY)
+    if generation is None:
+        generation = get_list_generation()
+
+    entry = values.get(cache_key)
+    local_cache.record("shared", hit=is_fresh(entry, generation))
+    if local_cache.enabled:
+        local_cache.set_generation(generation)
+        if is_fresh(entry, generation):
+            local_cache.set(cache_key, entry)
+    return entry, generation
+
+
+def is_fresh(entry, generation):
+    """A page is fresh if built for the current generation and not expired."""
+    return (
+        entry is not None
+        and entry["generation"] == generation
+        and entry["fresh_until"] > time.time()
+    )
+
+
+@timed("render")
+def render_page(data, compress=True):
+    """
+    Render list data to the final JSON bytes with a strong ETag of the
+    uncompressed body (the view suffixes it for the gzip encoding).
+
+    Bodies of at least ``COMPRESS_MIN_SIZE`` bytes are gzip-compressed when
+    ``compress`` is set, so cache hits neither re-render nor re-compress.
+    """
+    body = JSONRenderer().render(data)
+    page = {"body": body, "etag": f'"{sha256(body).hexdigest()[:32]}"', "gzip": False}
+    if compress and len(body) >= COMPRESS_MIN_SIZE:
+        page["body"] = gzip.compress(body, mtime=0)
+        page["gzip"] = True
+    return page
+
+
+@timed("cache")
+def set_cached_page(cache_key, page, generation, timeout, stale_timeout):
+    """
+    Store a rendered list page that is fresh for ``timeout`` seconds.
+
+    The entry is kept for a further ``stale_timeout`` seconds so it can be
+    served stale while another worker rebuilds it.
+    """
+    entry = dict(page, generation=generation, fresh_until=time.time() + timeout)
+    cache.set(cache_key, entry, timeout=timeout + stale_timeout)
+    if local_cache.enabled:
+        local_cache.set(cache_key, entry)
+    return entry
+
+
+def acquire_rebuild_lock(cache_key, timeout):
+    """
+    Try to become the single worker rebuilding ``cache_key``.
+
+    Returns:
+        A token to pass to ``release_rebuild_lock``, or None if another
+        worker holds the lock.
+    """
+    token = secrets.randbits(62)  # An int, so RedisCache stores it unpickled
+    if cache.add(f"{cache_key}:lock", token, timeout=timeout):
+        return token
+    return None
+
+
+@timed("cache")
+def wait_for_page(cache_key, generation, timeout, interval=0.05):
+    """
+    Briefly poll for a page that another worker is rebuilding.
+
+    Returns:
+        The fresh entry, or None if it did not appear within ``timeout``
+        seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(interval)
+        entry = cache.get(cache_key)
+        if is_fresh(entry, generation):
+            return entry
+    return None
+
+
+def release_rebuild_lock(cache_key, token):
+    """
+    Release the lock if it is still ours.
+
+    A rebuild that outlived the lock timeout must not delete the lock that
+    another worker has taken since, so the token is compared and the key
+    deleted in one step on Redis.
+    """
+    key = f"{cache_key}:lock"
+    backend = caches[DEFAULT_CACHE_ALIAS]  # ``cache`` is only a proxy
+    try:
+        if isinstance(backend, RedisCache):
+            redis_key = backend.make_and_validate_key(key)
+            client = backend._cache.get_client(redis_key, write=True)
+            client.eval(RELEASE_LOCK_SCRIPT, 1, redis_key, token)
+        elif cache.get(key) == token:
+            cache.delete(key)
+    except Exception as e:
+        logger.error(f"Error releasing rebuild lock {key}: {str(e)}")
@@ -0,0 +1,421 @@
+import datetime
+import logging
+import secrets
+import threading
+import time
+from collections import deque
+from io import BytesIO
+from captcha.conf import settings as captcha_settings
+from captcha.models import CaptchaStore
+from captcha.views import DISTANCE_FROM_TOP, getsize, makeimg
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+from PIL import Image, ImageDraw, ImageFont
+from comment_app.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+CAPTCHA_POOL_KEY = "captcha:pool"
+CAPTCHA_IMAGE_PREFIX = "captcha:image:"
+CAPTCHA_ANSWER_PREFIX = "captcha:answer:"
+
+# Pool entries are "<key>:<created>", appended in creation order, so stale
+# ones are at the front of the list
+PRUNE_POOL_SCRIPT = """
+local removed = 0
+while true do
+    local entry = redis.call('LINDEX', KEYS[1], 0)
+    if not entry or tonumber(string.match(entry, ':(%d+)$')) >= tonumber(ARGV[1]) then
+        return removed
+    end
+    redis.call('LPOP', KEYS[1])
+    removed = removed + 1
+end
+"""
+
+_local_pool = deque()
+_local_captchas = {}
+_local_lock = threading.Lock()
+_refill_lock = threading.Lock()
+_recent_takes = deque()  # When this process handed out CAPTCHAs
+_last_cleanup = 0.0
+
+
+def render_captcha(text):
+    """
+    Render a CAPTCHA challenge to PNG bytes.
+
+    Draws like django-simple-captcha's image view (font, rotation, noise and
+    filter settings) but needs no ``CaptchaStore`` row, so images can be
+    rendered ahead of time.
+    """
+    font_path = captcha_settings.CAPTCHA_FONT_PATH
+    if isinstance(font_path, (list, tuple)):
+        font_path = secrets.choice(font_path)
+    if font_path.lower().strip().endswith("ttf"):
+        font = ImageFont.truetype(font_path, captcha_settings.CAPTCHA_FONT_SIZE)
+    else:
+        font = ImageFont.load(font_path)
+
+    width, height = getsize(font, text)
+    size = (width * 2, int(height * 1.4))
+    image = makeimg(size)
+    xpos = 2
+    for char in text:
+        foreground = Image.new("RGB", size, captcha_settings.CAPTCHA_FOREGROUND_COLOR)
+        char_image = Image.new("L", getsize(font, f" {char} "), "#000000")
+        ImageDraw.Draw(char_image).text((0, 0), f" {char} ", font=font, fill="#ffffff")
+        if captcha_settings.CAPTCHA_LETTER_ROTATION:
+            char_image = char_image.rotate(
+                secrets.choice(range(*captcha_settings.CAPTCHA_LETTER_ROTATION)),
+                expand=0,
+                resample=Image.BICUBIC,
+            )
+        char_image = char_image.crop(char_image.getbbox())
+        mask = Image.new("L", size)
+        mask.paste(char_image, (xpos, DISTANCE_FROM_TOP))
+        image = Image.composite(foreground, image, mask)
+        xpos += 2 + char_image.size[0]
+
+    image = image.crop((0, 0, xpos + 1, size[1]))
+    draw = ImageDraw.Draw(image)
+    for noise in captcha_settings.noise_functions():
+        draw = noise(draw, image)
+    for image_filter in captcha_settings.filter_functions():
+        image = image_filter(image)
+
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def image_timeout():
+    """Seconds a rendered image (and its answer) must outlive its pool entry."""
+    return settings.COMMENT_CAPTCHA_POOL_MAX_AGE + captcha_settings.CAPTCHA_TIMEOUT * 60
+
+
+class RedisCaptchaBackend:
+    """
+    Answers and images as Redis keys with native TTLs.
+
+    A Lua script reads and deletes the answer (and image) in one atomic step,
+    so concurrent requests cannot both use the same CAPTCHA.
+    """
+
+    CONSUME_SCRIPT = """
+    local answer = redis.call("GET", KEYS[1])
+    if answer then
+        redis.call("DEL", KEYS[1], KEYS[2])
+    end
+    return answer
+    """
+
+    def __init__(self):
+        self.client = get_redis_client()
+        self.consume_script = self.client.register_script(self.CONSUME_SCRIPT)
+
+    def store(self, captchas, timeout):
+        pipe = self.client.pipeline(transaction=False)
+        for key, answer, image in captchas:
+            pipe.set(f"{CAPTCHA_ANSWER_PREFIX}{key}", answer, ex=timeout)
+            pipe.set(f"{CAPTCHA_IMAGE_PREFIX}{key}", image, ex=timeout)
+        pipe.execute()
+
+    def get_image(self, key):
+        return self.client.get(f"{CAPTCHA_IMAGE_PREFIX}{key}")
+
+    def consume(self, key):
+        answer = self.consume_script(
+            keys=[f"{CAPTCHA_ANSWER_PREFIX}{key}", f"{CAPTCHA_IMAGE_PREFIX}{key}"]
+        )
+        return answer.decode() if answer is not None else None
+
+    def remove_expired(self):
+        pass  # Redis expires keys itself
+
+
+class LocalCaptchaBackend:
+    """In-process equivalent of the Redis backend (single process, tests)."""
+
+    def store(self, captchas, timeout):
+        expires = time.monotonic() + timeout
+        with _local_lock:
+            for key, answer, image in captchas:
+                _local_captchas[key] = (answer, image, expires)
+
+    def get_image(self, key):
+        entry = _local_captchas.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def consume(self, key):
+        with _local_lock:
+            entry = _local_captchas.pop(key, None)
+        if entry is None or entry[2] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def remove_expired(self):
+        now = time.monotonic()
+        with _local_lock:
+            for key in [k for k, v in _local_captchas.items() if v[2] <= now]:
+                del _local_captchas[key]
+
+
+class DatabaseCaptchaBackend:
+    """
+    django-simple-captcha's ``CaptchaStore`` table, images in the cache.
+
+    A CAPTCHA only counts as consumed by the request whose DELETE removed
+    the row, which keeps concurrent submissions from sharing one.
+    """
+
+    def store(self, captchas, timeout):
+        expiration = timezone.now() + datetime.timedelta(seconds=timeout)
+        CaptchaStore.objects.bulk_create(
+            CaptchaStore(
+                challenge=answer,  # Images are pre-rendered from the challenge
+                response=answer.lower(),
+                hashkey=key,
+                expiration=expiration,
+            )
+            for key, answer, image in captchas
+        )
+        cache.set_many(
+            {f"{CAPTCHA_IMAGE_PREFIX}{key}": image for key, _, image in captchas},
+            timeout,
+        )
+
+    def get_image(self, key):
+        return cache.get(f"{CAPTCHA_IMAGE_PREFIX}{key}")
+
+    def consume(self, key):
+        store = CaptchaStore.objects.filter(
+            hashkey=key, expiration__gt=timezone.now()
+        ).first()
+        if store is None:
+            return None
+        deleted, _ = CaptchaStore.objects.filter(pk=store.pk).delete()
+        return store.response if deleted else None
+
+    def remove_expired(self):
+        CaptchaStore.remove_expired()
+
+
+def get_captcha_backend():
+    """Return the store selected by ``COMMENT_CAPTCHA_BACKEND``."""
+    backend = settings.COMMENT_CAPTCHA_BACKEND
+    if backend == "redis":
+        return RedisCaptchaBackend()
+    if backend == "db":
+        return DatabaseCaptchaBackend()
+    return LocalCaptchaBackend()
+
+
+def make_captchas(count):
+    """
+    Generate, render and store ``count`` CAPTCHAs in the configured backend.
+
+    They stay valid for the pool lifetime plus ``CAPTCHA_TIMEOUT``.
+
+    Returns:
+        list: ``(key, answer)`` pairs
+    """
+    captchas = []
+    for _ in range(count):
+        challenge, response = captcha_settings.get_challenge()()
+        captchas.append((secrets.token_hex(20), response, render_captcha(challenge)))
+    get_captcha_backend().store(captchas, image_timeout())
+    return [(key, answer) for key, answer, _ in captchas]
+
+
+def get_captcha_image(key):
+    """Return the pre-rendered PNG for ``key``, or None once it expired."""
+    return get_captcha_backend().get_image(key)
+
+
+def consume_captcha(key):
+    """
+    Atomically fetch and invalidate a CAPTCHA's answer.
+
+    Every CAPTCHA can be checked once, right or wrong.
+
+    Returns:
+        str: The expected answer, or None if the key is unknown or expired
+    """
+    return get_captcha_backend().consume(key)
+
+
+class LocalCaptchaPool:
+    """In-process pool, refilled by a background thread."""
+
+    def size(self):
+        return len(_local_pool)
+
+    def put(self, entries):
+        _local_pool.extend(entries)
+
+    def take(self):
+        """Pop the newest entry."""
+        try:
+            return _local_pool.pop()
+        except IndexError:
+            return None
+
+    def prune(self, oldest):
+        """Drop entries created before ``oldest``, which sit at the front."""
+        removed = 0
+        try:
+            while int(_local_pool[0].rsplit(":", 1)[1]) < oldest:
+                _local_pool.popleft()
+                removed += 1
+        except IndexError:
+            pass
+        return removed
+
+    def clear(self):
+        _local_pool.clear()
+
+
+class RedisCaptchaPool:
+    """Pool shared by all workers, refilled by ``manage.py refill_captchas``."""
+
+    _prune = None
+
+    def size(self):
+        return get_redis_client().llen(CAPTCHA_POOL_KEY)
+
+    def put(self, entries):
+        get_redis_client().rpush(CAPTCHA_POOL_KEY, *entries)
+
+    def take(self):
+        """Pop the newest entry."""
+        entry = get_redis_client().rpop(CAPTCHA_POOL_KEY)
+        return entry.decode() if entry is not None else None
+
+    def prune(self, oldest):
+        """Drop entries created before ``oldest``, which sit at the front."""
+        if RedisCaptchaPool._prune is None:
+            RedisCaptchaPool._prune = get_redis_client().register_script(
+                PRUNE_POOL_SCRIPT
+            )
+        return self._prune(keys=[CAPTCHA_POOL_KEY], args=[int(oldest)])
+
+    def clear(self):
+        get_redis_client().delete(CAPTCHA_POOL_KEY)
+
+
+def get_captcha_pool():
+    """Return the pool selected by ``COMMENT_CAPTCHA_POOL`` (local/redis)."""
+    if settings.COMMENT_CAPTCHA_POOL == "redis":
+        return RedisCaptchaPool()
+    return LocalCaptchaPool()
+
+
+def local_pool_target():
+    """
+    Size the local pool to demand: twice the CAPTCHAs this process handed
+    out within ``COMMENT_CAPTCHA_POOL_MAX_AGE``, kept between
+    ``COMMENT_CAPTCHA_POOL_MIN`` and ``COMMENT_CAPTCHA_POOL_SIZE``.
+
+    A quiet worker then renders a few CAPTCHAs per period rather than a
+    full pool that goes stale unused.
+    """
+    now = time.monotonic()
+    with _local_lock:
+        _recent_takes.append(now)
+        while (
+            _recent_takes
+            and _recent_takes[0] < now - settings.COMMENT_CAPTCHA_POOL_MAX_AGE
+        ) or len(_recent_takes) > settings.COMMENT_CAPTCHA_POOL_SIZE:
+            _recent_takes.popleft()
+        demand = len(_recent_takes)
+    return min(
+        settings.COMMENT_CAPTCHA_POOL_SIZE,
+        max(settings.COMMENT_CAPTCHA_POOL_MIN, 2 * demand),
+    )
+
+
+def refill_pool(pool=None, target=None):
+    """
+    Drop stale entries, top the pool up to ``target`` (default
+    ``COMMENT_CAPTCHA_POOL_SIZE``) and remove expired CAPTCHAs at most once
+    per ``COMMENT_CAPTCHA_CLEANUP_INTERVAL``.
+
+    Returns:
+        int: Number of CAPTCHAs added
+    """
+    global _last_cleanup
+    pool = pool or get_captcha_pool()
+    if target is None:
+        target = settings.COMMENT_CAPTCHA_POOL_SIZE
+    added = 0
+    with _refill_lock:
+        pool.prune(time.time() - settings.COMMENT_CAPTCHA_POOL_MAX_AGE)
+        missing = target - pool.size()
+        while added < missing:
+            batch = min(missing - added, settings.COMMENT_CAPTCHA_POOL_BATCH)
+            created = int(time.time())
+            pool.put([f"{key}:{created}" for key, _ in make_captchas(batch)])
+            added += batch
+
+        if (
+            time.monotonic() - _last_cleanup
+            >= settings.COMMENT_CAPTCHA_CLEANUP_INTERVAL
+        ):
+            get_captcha_backend().remove_expired()
+            _last_cleanup = time.monotonic()
+    return added
+
+
+def _refill_in_background(pool, target):
+    close_old_connections()
+    try:
+        refill_pool(pool, target)
+    except Exception as e:
+        logger.error(f"Error refilling CAPTCHA pool: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+def take_captcha():
+    """
+    Hand out a pre-generated CAPTCHA key in O(1).
+
+    The newest entry is taken. If even that is older than
+    ``COMMENT_CAPTCHA_POOL_MAX_AGE`` the whole pool is stale and is
+    dropped, so every CAPTCHA handed out stays valid for
+    ``CAPTCHA_TIMEOUT``. With the local pool a refill sized to recent
+    demand starts in a thread once the pool is down to half of that; when
+    the pool is empty or unreachable one CAPTCHA is generated inline.
+    """
+    pool = get_captcha_pool()
+    try:
+        key = None
+        entry = pool.take()
+        if entry is not None:
+            key, created = entry.rsplit(":", 1)
+            if int(created) < time.time() - settings.COMMENT_CAPTCHA_POOL_MAX_AGE:
+                pool.clear()
+                key = None
+
+        if isinstance(pool, LocalCaptchaPool):
+            target = local_pool_target()
+            if pool.size() <= target // 2 and not _refill_lock.locked():
+                threading.Thread(
+                    target=_refill_in_background,
+                    args=(pool, target),
+                    name="captcha-pool-refill",
+                    daemon=True,
+                ).start()
+    except Exception as e:
+        logger.error(f"Error taking CAPTCHA from pool: {str(e)}")
+        key = None
+
+    if key is None:
+        logger.warning("CAPTCHA pool empty, generating inline")
+        key = make_captchas(1)[0][0]
+    return key
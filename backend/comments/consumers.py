@@ -1,29 +1,116 @@
+import asyncio
 import json
 import logging
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.exceptions import ChannelFull
+from django.conf import settings
+from comment_app.ratelimit import get_scope_client_ip
+from .broadcast import ALL_GROUP, topic_group
+from .broadcast import broadcaster, comment_groups
+from .replay import get_replay_buffer
+from .throttling import TokenBucket, shared_token_bucket
 
 logger = logging.getLogger(__name__)
 
+# Fields (and their allowed types) of a client-originated comment broadcast
+CLIENT_COMMENT_REQUIRED = ("id", "username", "email", "text", "created_at")
+CLIENT_COMMENT_SCHEMA = {
+    "id": (int,),
+    "username": (str,),
+    "email": (str,),
+    "text": (str,),
+    "created_at": (str,),
+    "image": (str, type(None)),
+    "file": (str, type(None)),
+    "parent": (int, type(None)),
+}
+
+
+def validate_client_comment(message):
+    """
+    Check a client-originated comment against CLIENT_COMMENT_SCHEMA.
+
+    Args:
+        message (dict): The decoded message
+
+    Returns:
+        dict: The comment, without the optional ``action`` key
+
+    Raises:
+        ValueError: If a field is unknown, missing or has the wrong type
+    """
+    comment = {key: value for key, value in message.items() if key != "action"}
+    for key, value in comment.items():
+        types = CLIENT_COMMENT_SCHEMA.get(key)
+        if types is None:
+            raise ValueError(f"Unknown field: {key}")
+        # bool is an int subclass but never a valid id
+        if isinstance(value, bool) or not isinstance(value, types):
+            raise ValueError(f"Invalid value for {key}")
+    for key in CLIENT_COMMENT_REQUIRED:
+        if key not in comment:
+            raise ValueError(f"Missing field: {key}")
+    return comment
+
 
 class CommentConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for handling real-time comments.
+
+    Broadcast events arrive pre-serialized from ``comments/broadcast.py``.
+    Clients that connect with ``?batch=1`` receive each batch as one JSON
+    array; others receive one frame per event. Frames go through a bounded
+    per-connection outbox and a client that cannot keep up is disconnected
+    instead of buffering without limit.
+
+    Clients receive every event ("all") unless they connect with
+    ``?topics=top,thread:12``; topics can then be changed over the socket
+    with ``{"action": "subscribe" | "unsubscribe", "topics": [...]}``.
+    "all" cannot be combined with other topics.
+
+    Events carry a ``seq`` number. A client reconnecting with
+    ``?last_seq=N`` is sent the events it missed on its topics, or
+    ``{"event": "resync"}`` when they are no longer in the replay buffer.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.group_name = "comments"
+        self.group_name = ALL_GROUP
+        self.groups_joined = set()
         self.is_connected = False
+        self.batching = False
+        self.outbox = None
+        self.writer = None
+        self.connection_bucket = None
+        self.client_bucket = None
 
     async def connect(self):
         """
         Handle WebSocket connection.
         """
         try:
-            await self.channel_layer.group_add(self.group_name, self.channel_name)
+            query = parse_qs(self.scope.get("query_string", b"").decode())
+            self.batching = query.get("batch", ["0"])[0] in ("1", "true")
+            limits = settings.COMMENT_WS_RATE_LIMITS
+            self.connection_bucket = TokenBucket(*limits["connection"])
+            self.client_bucket = shared_token_bucket(*limits["user"], prefix="ws:rate")
+            self.outbox = asyncio.Queue(
+                maxsize=getattr(settings, "COMMENT_WS_SEND_QUEUE_SIZE", 100)
+            )
+
+            topics = ["all"]
+            if "topics" in query:
+                topics = query["topics"][0].split(",")
+
+            await self.subscribe(topics)
             await self.accept()
             self.is_connected = True
+            if "last_seq" in query:
+                # Live events queue up in the outbox meanwhile
+                await self.replay(query["last_seq"][0])
+            self.writer = asyncio.create_task(self.write_outbox())
             logger.info(f"Client connected: {self.channel_name}")
 
         except ChannelFull:
@@ -42,10 +129,15 @@ class CommentConsumer(AsyncWebsocketConsumer):
             close_code (int): WebSocket close code
         """
         try:
+            if self.writer is not None:
+                self.writer.cancel()
+                self.writer = None
+            self.outbox = None
+
             if self.is_connected:
-                await self.channel_layer.group_discard(
-                    self.group_name, self.channel_name
-                )
+                for group in self.groups_joined:
+                    await self.channel_layer.group_discard(group, self.channel_name)
+                self.groups_joined.clear()
                 self.is_connected = False
                 logger.info(
                     f"Client disconnected: {self.channel_name}, code: {close_code}"
@@ -54,34 +146,242 @@ class CommentConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"Error in disconnect: {str(e)}")
 
-    async def receive(self, text_data: str):
+    async def receive(self, text_data: str = None, bytes_data: bytes = None):
         """
-        Receive message from WebSocket and broadcast to group.
+        Receive a control message or, if enabled, a comment to broadcast.
+
+        Frames are size-checked and rate limited per connection and per
+        client before they are parsed; clients over the limit are closed.
 
         Args:
             text_data (str): Received message data
+            bytes_data (bytes): Binary frames are not accepted
         """
         try:
+            if text_data is None:
+                await self.send_error("Binary messages are not supported")
+                return
+
+            if len(text_data.encode()) > settings.COMMENT_WS_MAX_MESSAGE_BYTES:
+                logger.warning(f"Message too big from {self.channel_name}")
+                await self.close(code=1009)  # 1009 is "Message Too Big"
+                return
+
+            if not await self.consume_rate_limit():
+                logger.warning(f"Rate limit exceeded by {self.channel_name}")
+                await self.close(code=1008)  # 1008 is "Policy Violation"
+                return
+
             # Validate JSON format
             message = json.loads(text_data)
 
             if not isinstance(message, dict):
                 raise ValueError("Message must be a JSON object")
 
-            await self.channel_layer.group_send(
-                self.group_name, {"type": "send_comment", "message": message}
-            )
-            logger.debug(
-                f"Message received and broadcast: {text_data[:100]}"
-            )  # Log first 100 chars
+            action = message.get("action", "broadcast")
+            if action in ("subscribe", "unsubscribe"):
+                await self.change_subscriptions(message)
+            elif action == "broadcast":
+                await self.broadcast_client_comment(message)
+            else:
+                await self.send_error(f"Unknown action: {action}")
 
         except json.JSONDecodeError:
             logger.error("Invalid JSON received")
-            await self.send(text_data=json.dumps({"error": "Invalid JSON format"}))
+            await self.send_error("Invalid JSON format")
+
+        except ValueError as e:
+            await self.send_error(str(e))
 
         except Exception as e:
             logger.error(f"Error in receive: {str(e)}")
-            await self.send(text_data=json.dumps({"error": "Internal server error"}))
+            await self.send_error("Internal server error")
+
+    async def send_error(self, error: str):
+        await self.send(text_data=json.dumps({"error": error}))
+
+    async def consume_rate_limit(self):
+        """
+        Take a token from the connection's and the client's bucket.
+
+        The client is the user, or the address for anonymous sockets, so
+        opening more sockets does not raise the limit.
+
+        Returns:
+            bool: False if either bucket is empty
+        """
+        if not self.connection_bucket.consume():
+            return False
+
+        user = self.scope.get("user")
+        if user is not None and user.is_authenticated:
+            client = f"user:{user.pk}"
+        else:
+            client = f"ip:{get_scope_client_ip(self.scope)}"
+        try:
+            return await sync_to_async(
+                self.client_bucket.consume, thread_sensitive=False
+            )(client)
+        except Exception as e:
+            # The per-connection limit still applies without Redis
+            logger.error(f"Error checking WebSocket rate limit: {str(e)}")
+            return True
+
+    async def broadcast_client_comment(self, message: dict):
+        """
+        Rebroadcast a client-originated comment, if allowed.
+
+        Args:
+            message (dict): Comment fields, see CLIENT_COMMENT_SCHEMA
+        """
+        if not settings.COMMENT_WS_CLIENT_BROADCAST:
+            await self.send_error("Client broadcast is disabled")
+            return
+
+        user = self.scope.get("user")
+        if user is None or not user.is_authenticated:
+            await self.send_error("Authentication required")
+            return
+
+        comment = validate_client_comment(message)
+        broadcaster.publish(comment_groups(comment.get("parent")), comment)
+        logger.debug(f"Client comment broadcast: {str(comment)[:100]}")
+
+    async def subscribe(self, topics):
+        """
+        Join the groups for ``topics``, skipping invalid ones.
+
+        Every event also goes to the "all" group, so "all" is exclusive:
+        joining it leaves the topic groups, and topics are skipped while it
+        is joined, so no event is delivered twice.
+
+        Args:
+            topics (list): Topic names, see ``broadcast.topic_group``
+
+        Returns:
+            list: The topics that were joined
+        """
+        limit = getattr(settings, "COMMENT_WS_MAX_SUBSCRIPTIONS", 500)
+        joined = []
+        if "all" in topics:
+            for group in self.groups_joined - {ALL_GROUP}:
+                await self.channel_layer.group_discard(group, self.channel_name)
+            self.groups_joined &= {ALL_GROUP}
+            topics = ["all"]
+        for topic in topics:
+            group = topic_group(topic)
+            if group is None or len(self.groups_joined) >= limit:
+                continue
+            if ALL_GROUP in self.groups_joined and group != ALL_GROUP:
+                continue  # Already receiving every event
+            if group not in self.groups_joined:
+                await self.channel_layer.group_add(group, self.channel_name)
+                self.groups_joined.add(group)
+            joined.append(topic)
+        return joined
+
+    async def unsubscribe(self, topics):
+        """
+        Leave the groups for ``topics``.
+
+        Args:
+            topics (list): Topic names, see ``broadcast.topic_group``
+
+        Returns:
+            list: The topics that were left
+        """
+        left = []
+        for topic in topics:
+            group = topic_group(topic)
+            if group in self.groups_joined:
+                await self.channel_layer.group_discard(group, self.channel_name)
+                self.groups_joined.discard(group)
+                left.append(topic)
+        return left
+
+    async def change_subscriptions(self, message: dict):
+        """
+        Handle a subscribe/unsubscribe request and acknowledge it.
+
+        Args:
+            message (dict): ``{"action": ..., "topics": [...]}``
+        """
+        topics = message.get("topics")
+        if not isinstance(topics, list):
+            await self.send(text_data=json.dumps({"error": "topics must be a list"}))
+            return
+
+        if message["action"] == "subscribe":
+            changed = await self.subscribe(topics)
+        else:
+            changed = await self.unsubscribe(topics)
+        await self.send(
+            text_data=json.dumps({"event": f"{message['action']}d", "topics": changed})
+        )
+
+    async def replay(self, last_seq: str):
+        """
+        Send the events after ``last_seq`` on this connection's topics.
+
+        Args:
+            last_seq (str): Last sequence number the client has seen
+        """
+        try:
+            entries = await sync_to_async(
+                get_replay_buffer().since, thread_sensitive=False
+            )(int(last_seq), settings.COMMENT_WS_REPLAY_LIMIT)
+        except ValueError:
+            entries = None
+        except Exception as e:
+            logger.error(f"Error reading replay buffer: {str(e)}")
+            entries = None
+
+        if entries is None:
+            await self.send(text_data=json.dumps({"event": "resync"}))
+            return
+
+        texts = [
+            text
+            for _, groups, text in entries
+            if self.groups_joined.intersection(groups)
+        ]
+        if not self.batching:
+            for text in texts:
+                await self.send(text_data=text)
+            return
+
+        size = getattr(settings, "COMMENT_WS_MAX_BATCH", 100)
+        for start in range(0, len(texts), size):
+            await self.send(text_data=f"[{','.join(texts[start : start + size])}]")
+
+    async def write_outbox(self):
+        """Send queued frames to the client one at a time."""
+        while True:
+            text = await self.outbox.get()
+            try:
+                await self.send(text_data=text)
+            except Exception as e:
+                logger.error(f"Error in write_outbox: {str(e)}")
+
+    async def send_batch(self, event: dict):
+        """
+        Queue a pre-serialized batch of events for this client.
+
+        Args:
+            event (dict): Event with the batch as ``texts``, one JSON string
+                per event
+        """
+        if self.outbox is None:
+            return
+
+        texts = event["texts"]
+        frames = [f"[{','.join(texts)}]"] if self.batching else texts
+        try:
+            for text in frames:
+                self.outbox.put_nowait(text)
+        except asyncio.QueueFull:
+            logger.warning(f"Closing slow WebSocket client: {self.channel_name}")
+            await self.close(code=1013)  # 1013 is "Try Again Later"
 
     async def send_comment(self, event: dict):
         """
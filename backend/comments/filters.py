@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F
+from rest_framework.filters import BaseFilterBackend
+
+
+class CommentSearchFilter(BaseFilterBackend):
+    """
+    Full-text search over comment text via ``?search=``.
+
+    On PostgreSQL the trigger-maintained ``search_vector`` column is matched
+    through its GIN index and results are ranked; other databases (SQLite in
+    tests) fall back to a case-insensitive substring match. Runs after
+    OrderingFilter so an explicit ``?ordering=`` still wins over rank.
+    Keyset pagination orders by its own ``(field, id)`` cursor key, so
+    cursor-paginated searches are not ranked either.
+    """
+
+    search_param = "search"
+    search_config = getattr(settings, "COMMENT_SEARCH_CONFIG", "english")
+
+    def get_search_terms(self, request):
+        return request.query_params.get(self.search_param, "").strip()
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        if connection.vendor != "postgresql":
+            return queryset.filter(text__icontains=terms)
+
+        query = SearchQuery(terms, config=self.search_config, search_type="websearch")
+        queryset = queryset.filter(search_vector=query)
+        if "ordering" in request.query_params or self.uses_keyset(view):
+            return queryset
+        return queryset.annotate(rank=SearchRank(F("search_vector"), query)).order_by(
+            "-rank", "-created_at"
+        )
+
+    def uses_keyset(self, view):
+        """Whether the view paginates this request by cursor."""
+        uses_cursor = getattr(view, "_use_cursor_pagination", None)
+        return bool(uses_cursor and uses_cursor())
@@ -0,0 +1,469 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from hashlib import sha256
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image, ImageOps, ImageSequence
+from comment_app.redis_client import get_redis_client
+from .attachments import lock_blobs, retain, variant_names
+from .broadcast import broadcaster, comment_groups
+from .caching import bump_list_generation
+from .models import Comment, StoredFile
+
+logger = logging.getLogger(__name__)
+
+IMAGE_QUEUE_KEY = "comment_images:queue"
+# Jobs being handled, until they are acknowledged
+IMAGE_PROCESSING_KEY = "comment_images:processing"
+THUMBNAIL_SIZE = (320, 240)
+PROCESSING_POLL_INTERVAL = 0.5
+
+# Responsive variants, largest first so each is resized from the previous one
+VARIANT_SIZES = {"full": (1600, 1600), "320w": (320, 240), "thumb": (160, 120)}
+VARIANTS_DIR = "variants"
+Image.init()
+VARIANT_FORMATS = [("webp", "WEBP")]
+if "AVIF" in Image.SAVE:  # Only when Pillow was built with libavif
+    VARIANT_FORMATS.append(("avif", "AVIF"))
+VARIANT_FORMATS.append(("jpeg", "JPEG"))  # Universal fallback
+
+_executor = None
+
+
+def _thumbnail_frames(img, max_frames):
+    """Yield downscaled frames, decoding one full-size frame at a time."""
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        if index >= max_frames:
+            break
+        thumb = frame.copy()
+        thumb.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+        yield thumb
+
+
+def _fitted_size(img, box):
+    """The size ``img`` is downscaled to when fitted into ``box``."""
+    ratio = min(box[0] / img.width, box[1] / img.height, 1)
+    return max(1, int(img.width * ratio)), max(1, int(img.height * ratio))
+
+
+def thumbnail_image(path, output, max_pixels=None, max_frames=None):
+    """
+    Write a copy of the image at ``path`` downscaled to fit ``THUMBNAIL_SIZE``.
+
+    The pixel count is checked from the header before anything is decoded.
+    JPEGs are decoded in draft mode (libjpeg DCT scaling by 1/2..1/8), and
+    animated GIFs are resized frame by frame so only one full-size frame is
+    ever held in memory. The original is never modified: uploads are stored
+    under the hash of their bytes.
+
+    Args:
+        path: The source image
+        output: File name or file object receiving the thumbnail
+
+    Returns:
+        (width, height) of the thumbnail, or None if the image already fits
+        and nothing was written.
+
+    Raises:
+        ValueError: If the image exceeds ``max_pixels``.
+    """
+    max_pixels = max_pixels or settings.COMMENT_MAX_IMAGE_PIXELS
+    max_frames = max_frames or settings.COMMENT_MAX_IMAGE_FRAMES
+
+    with Image.open(path) as img:
+        if img.width * img.height > max_pixels:
+            raise ValueError(f"Image has more than {max_pixels} pixels")
+        if img.height <= THUMBNAIL_SIZE[1] and img.width <= THUMBNAIL_SIZE[0]:
+            return None
+
+        image_format = img.format
+        if getattr(img, "is_animated", False):
+            frames = _thumbnail_frames(img, max_frames)
+            first = next(frames)
+            first.save(
+                output,
+                format=image_format,
+                save_all=True,
+                append_images=frames,
+                loop=img.info.get("loop", 0),
+            )
+            return first.size
+
+        img.draft(None, _fitted_size(img, THUMBNAIL_SIZE))
+        img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+        img.save(output, format=image_format)
+        return img.size
+
+
+def _store_bytes(data, extension):
+    """Store ``data`` under a content-addressed name in the variants tree."""
+    digest = sha256(data).hexdigest()
+    name = f"{VARIANTS_DIR}/{digest[:2]}/{digest}.{extension}"
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(data))
+    return name
+
+
+def _store_variant(image, image_format, extension):
+    """Encode ``image`` and store it under a content-addressed name."""
+    if image_format == "JPEG" and image.mode != "RGB":
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+
+    buffer = BytesIO()
+    image.save(buffer, image_format, quality=80)
+    return _store_bytes(buffer.getvalue(), extension)
+
+
+def _animated_variants(path, image_format):
+    """An animated thumbnail as the only variant, in the source format."""
+    buffer = BytesIO()
+    size = thumbnail_image(path, buffer)
+    if size is None:
+        return {}
+    extension = image_format.lower()
+    return {
+        "thumb": {
+            "width": size[0],
+            "height": size[1],
+            extension: _store_bytes(buffer.getvalue(), extension),
+        }
+    }
+
+
+def build_image_variants(path, max_pixels=None):
+    """
+    Generate the responsive variants of the image at ``path``.
+
+    Each size in ``VARIANT_SIZES`` is encoded in every ``VARIANT_FORMATS``
+    format and stored under its content hash, so the files are immutable
+    and can be cached forever. Animated images only get an animated
+    ``thumb`` in their own format.
+
+    Returns:
+        dict mapping variant name to its width, height and stored file names.
+    """
+    max_pixels = max_pixels or settings.COMMENT_MAX_IMAGE_PIXELS
+
+    with Image.open(path) as img:
+        if img.width * img.height > max_pixels:
+            raise ValueError(f"Image has more than {max_pixels} pixels")
+        animated = getattr(img, "is_animated", False)
+        if animated:
+            animated_format = img.format
+        else:
+            # Draft mode scales by 1/2..1/8 while staying at least this size,
+            # so ask for the fitted size rather than the square box
+            img.draft("RGB", _fitted_size(img, VARIANT_SIZES["full"]))
+            has_alpha = img.mode in ("RGBA", "LA") or "transparency" in img.info
+            image = ImageOps.exif_transpose(img).convert("RGBA" if has_alpha else "RGB")
+    if animated:
+        return _animated_variants(path, animated_format)
+
+    variants = {}
+    for name, size in VARIANT_SIZES.items():
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        variant = {"width": image.width, "height": image.height}
+        for extension, image_format in VARIANT_FORMATS:
+            variant[extension] = _store_variant(image, image_format, extension)
+        variants[name] = variant
+    return variants
+
+
+def variant_srcset(variants, build_url):
+    """
+    Build ``{format: "url 160w, url 320w, ..."}`` from stored variants.
+
+    Args:
+        variants: ``Comment.image_variants``
+        build_url: Callable turning a storage URL into an absolute URL
+    """
+    if not variants:
+        return None
+    ordered = sorted(variants.values(), key=lambda variant: variant["width"])
+    stored = {key for variant in ordered for key in variant} - {"width", "height"}
+    # Preferred formats first, then e.g. the GIF of an animated thumbnail
+    extensions = [extension for extension, _ in VARIANT_FORMATS if extension in stored]
+    extensions += sorted(stored - set(extensions))
+    return {
+        extension: ", ".join(
+            f"{build_url(default_storage.url(variant[extension]))} {variant['width']}w"
+            for variant in ordered
+            if extension in variant
+        )
+        for extension in extensions
+    }
+
+
+def display_variant(variants):
+    """
+    Return the stored name of the variant shown as a comment's ``image``.
+
+    Lists display images at up to 320x240: the ``320w`` JPEG, or the
+    animated ``thumb`` in its own format.
+    """
+    for size in ("320w", "thumb"):
+        variant = (variants or {}).get(size)
+        if variant:
+            files = {
+                key: name
+                for key, name in variant.items()
+                if key not in ("width", "height")
+            }
+            return files.get("jpeg") or next(iter(files.values()), None)
+    return None
+
+
+def claim_processing(name):
+    """
+    Mark the blob ``name`` as being processed by this job.
+
+    A claim older than ``COMMENT_IMAGE_PROCESSING_TIMEOUT`` is treated as
+    abandoned (e.g. its worker crashed) and can be taken over.
+
+    Returns:
+        True if this job should build the variants.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.COMMENT_IMAGE_PROCESSING_TIMEOUT)
+    return bool(
+        StoredFile.objects.filter(name=name, image_variants__isnull=True)
+        .filter(Q(processing_since__isnull=True) | Q(processing_since__lt=stale))
+        .update(processing_since=now)
+    )
+
+
+def get_image_variants(path, name):
+    """
+    Return the variants of the blob ``name``, building them only once.
+
+    Identical uploads share a blob: the first job claims it and builds the
+    variants, later jobs wait for and reuse its result.
+
+    Raises:
+        ValueError: If the image exceeds ``COMMENT_MAX_IMAGE_PIXELS``.
+    """
+    while True:
+        blob = StoredFile.objects.filter(name=name).values("image_variants").first()
+        if blob is None:
+            # Not reference-counted (e.g. legacy data): nothing to share
+            return build_image_variants(path)
+        if blob["image_variants"] is not None:
+            return blob["image_variants"]
+        if claim_processing(name):
+            break
+        time.sleep(PROCESSING_POLL_INTERVAL)
+
+    try:
+        variants = build_image_variants(path)
+    except Exception:
+        # Let a waiting duplicate retry right away
+        StoredFile.objects.filter(name=name).update(processing_since=None)
+        raise
+    StoredFile.objects.filter(name=name).update(
+        image_variants=variants, processing_since=None
+    )
+    return variants
+
+
+def process_comment_image(comment_id):
+    """
+    Build a comment's image variants and announce the result.
+
+    Records the outcome in ``Comment.image_status``, invalidates cached
+    comment lists and sends an ``image_ready`` event to the ``comments``
+    WebSocket group. The uploaded original is left untouched.
+    """
+    try:
+        comment = Comment.objects.get(pk=comment_id)
+        if not comment.image or comment.image_status != Comment.ImageStatus.PENDING:
+            return  # Nothing to do, or a redelivered job already handled
+
+        for attempt in range(2):
+            try:
+                variants = get_image_variants(comment.image.path, comment.image.name)
+                status = Comment.ImageStatus.READY
+            except Exception as e:
+                logger.error(
+                    f"Error processing image for comment {comment_id}: {str(e)}"
+                )
+                variants = {}
+                status = Comment.ImageStatus.FAILED
+
+            with transaction.atomic():
+                names = variant_names(variants)
+                if not lock_blobs(names):
+                    if attempt == 0:
+                        # Shared variants were collected after we looked them
+                        # up: forget them so the retry builds them again
+                        StoredFile.objects.filter(name=comment.image.name).update(
+                            image_variants=None
+                        )
+                        continue
+                    logger.error(f"Image variants for comment {comment_id} vanished")
+                    variants, names = {}, set()
+                    status = Comment.ImageStatus.FAILED
+                # update() skips post_save so the comment is not re-broadcast.
+                # Only the pending image is updated, so a job that runs twice
+                # does not retain its variants twice.
+                updated = Comment.objects.filter(
+                    pk=comment_id,
+                    image=comment.image.name,
+                    image_status=Comment.ImageStatus.PENDING,
+                ).update(image_status=status, image_variants=variants)
+                if updated:
+                    retain(names)
+            break
+        bump_list_generation()
+
+        display = display_variant(variants)
+        display_url = default_storage.url(display) if display else comment.image.url
+        broadcaster.publish(
+            comment_groups(comment.parent_id),
+            {
+                "event": "image_ready",
+                "id": comment.id,
+                "parent": comment.parent_id,
+                "image": f"{settings.SITE_URL}{display_url}",
+                "image_status": status,
+                "image_srcset": variant_srcset(
+                    variants, lambda url: f"{settings.SITE_URL}{url}"
+                ),
+            },
+        )
+        logger.info(f"Processed image for comment ID {comment_id}: {status}")
+
+    except Comment.DoesNotExist:
+        logger.warning(f"Comment {comment_id} deleted before image processing")
+    except Exception as e:
+        logger.error(f"Error in image pipeline for comment {comment_id}: {str(e)}")
+
+
+def _process_in_worker(comment_id):
+    """Run a job outside the request cycle, releasing stale DB connections."""
+    close_old_connections()
+    try:
+        process_comment_image(comment_id)
+    finally:
+        close_old_connections()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.COMMENT_IMAGE_WORKERS,
+            thread_name_prefix="comment-images",
+        )
+    return _executor
+
+
+def enqueue_comment_image(comment_id):
+    """
+    Hand a comment's image to the configured background stage.
+
+    Falls back to the in-process pool if the Redis queue is unreachable.
+    """
+    mode = settings.COMMENT_IMAGE_QUEUE
+    if mode == "sync":
+        process_comment_image(comment_id)
+        return
+
+    if mode == "redis":
+        try:
+            get_redis_client().lpush(IMAGE_QUEUE_KEY, comment_id)
+            return
+        except Exception as e:
+            logger.error(f"Error queueing image, processing locally: {str(e)}")
+
+    _get_executor().submit(_process_in_worker, comment_id)
+
+
+def resubmit_stale_images(submit=None, older_than=None):
+    """
+    Re-submit comments whose image has been pending for too long.
+
+    Jobs handed to the in-process pool (``COMMENT_IMAGE_QUEUE=local``) are
+    lost when the process restarts; ``manage.py process_images --sweep``
+    picks them up again. Processing a comment twice is harmless.
+
+    Args:
+        submit: Callable taking a comment id, ``enqueue_comment_image``
+            by default
+        older_than: Age in seconds, ``COMMENT_IMAGE_PROCESSING_TIMEOUT``
+            by default
+
+    Returns:
+        The number of comments re-submitted.
+    """
+    submit = submit or enqueue_comment_image
+    older_than = older_than or settings.COMMENT_IMAGE_PROCESSING_TIMEOUT
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    stale = list(
+        Comment.objects.filter(
+            image_status=Comment.ImageStatus.PENDING, created_at__lt=cutoff
+        ).values_list("pk", flat=True)
+    )
+    for comment_id in stale:
+        submit(comment_id)
+    if stale:
+        logger.warning(f"Re-submitted {len(stale)} stale pending images")
+    return len(stale)
+
+
+def requeue_abandoned_jobs(client):
+    """
+    Move jobs left in the processing list by a worker that died back to
+    the front of the queue.
+
+    Jobs other workers are still running may be moved too; processing a
+    comment twice is harmless.
+    """
+    requeued = 0
+    while client.lmove(IMAGE_PROCESSING_KEY, IMAGE_QUEUE_KEY, "RIGHT", "RIGHT"):
+        requeued += 1
+    if requeued:
+        logger.warning(f"Requeued {requeued} abandoned image jobs")
+
+
+def run_image_worker(timeout=5, backoff=1, max_backoff=30):
+    """
+    Consume the Redis image queue forever (``manage.py process_images``).
+
+    Each job is moved atomically to a processing list and only removed
+    from it once handled, so a job is not lost if the worker dies; leftover
+    jobs are requeued when a worker starts. Redis errors are retried with
+    exponential backoff and a malformed job is logged and dropped.
+    """
+    delay = backoff
+    requeued = False
+    while True:
+        try:
+            client = get_redis_client()
+            if not requeued:
+                requeue_abandoned_jobs(client)
+                requeued = True
+            item = client.blmove(
+                IMAGE_QUEUE_KEY, IMAGE_PROCESSING_KEY, timeout, "RIGHT", "LEFT"
+            )
+            delay = backoff
+            if item is None:
+                continue
+            try:
+                _process_in_worker(int(item))
+            except ValueError:
+                logger.error(f"Dropping malformed image job: {item!r}")
+            finally:
+                client.lrem(IMAGE_PROCESSING_KEY, 1, item)
+        except Exception as e:
+            logger.error(f"Error in image worker, retrying in {delay}s: {str(e)}")
+            time.sleep(delay)
+            delay = min(delay * 2, max_backoff)
@@ -0,0 +1,96 @@
+"""Helpers shared by the ``benchmark_*`` management commands."""
+
+from django.conf import settings
+
+# Run without Redis: in-process cache, channel layer and replay buffer, and
+# CAPTCHAs in the database so a forked server sees them
+IN_MEMORY_SETTINGS = {
+    "CHANNEL_LAYERS": {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {"capacity": 1000},
+        }
+    },
+    "CACHES": {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    "COMMENT_WS_REPLAY": "local",
+    "COMMENT_CAPTCHA_BACKEND": "db",
+    "RATE_LIMIT_BACKEND": "local",
+    "ALLOWED_HOSTS": ["*"],
+}
+
+
+def unthrottled_rate_limits():
+    """RATE_LIMITS with the same windows but quotas no benchmark reaches."""
+    return {
+        scope: (10**9, window) for scope, (_, window) in settings.RATE_LIMITS.items()
+    }
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values``; None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize_latencies(seconds):
+    """
+    Summarize request latencies.
+
+    Args:
+        seconds (list): One duration per request, in seconds
+
+    Returns:
+        dict: Mean and p50/p95/p99 in milliseconds
+    """
+    if not seconds:
+        return {"mean_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        "mean_ms": sum(seconds) / len(seconds) * 1000,
+        "p50_ms": percentile(seconds, 0.5) * 1000,
+        "p95_ms": percentile(seconds, 0.95) * 1000,
+        "p99_ms": percentile(seconds, 0.99) * 1000,
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare benchmark results with a stored baseline.
+
+    A scenario regresses when its p95 latency grows, or its throughput
+    drops, by more than ``tolerance``, or when it issues more queries.
+
+    Args:
+        results (dict): Scenario name -> metrics, as written by the command
+        baseline (dict): The same structure from an earlier run
+        tolerance (float): Allowed relative change, e.g. 0.2 for 20%
+
+    Returns:
+        list: Human-readable regression descriptions
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if previous.get("p95_ms") and current["p95_ms"] is not None:
+            if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: p95 {current['p95_ms']:.1f} ms "
+                    f"(baseline {previous['p95_ms']:.1f} ms)"
+                )
+        if previous.get("requests_per_second"):
+            floor = previous["requests_per_second"] * (1 - tolerance)
+            if current["requests_per_second"] < floor:
+                regressions.append(
+                    f"{name}: {current['requests_per_second']:.1f} req/s "
+                    f"(baseline {previous['requests_per_second']:.1f} req/s)"
+                )
+        if previous.get("queries_max") is not None:
+            if current["queries_max"] > previous["queries_max"]:
+                regressions.append(
+                    f"{name}: {current['queries_max']} queries per request "
+                    f"(baseline {previous['queries_max']})"
+                )
+    return regressions
@@ -0,0 +1,225 @@
+import json
+import random
+import time
+from datetime import datetime, timezone
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from comments.caching import bump_list_generation, local_cache
+from comments.captchas import make_captchas
+from comments.management.benchmarking import (
+    IN_MEMORY_SETTINGS,
+    find_regressions,
+    summarize_latencies,
+    unthrottled_rate_limits,
+)
+from comments.models import Comment
+
+MARKER = "api-benchmark"
+BENCHMARK_USER = "api-benchmark"
+BENCHMARK_PASSWORD = "api-benchmark-password"
+
+# Scenario name -> default number of requests. Login is dominated by
+# password hashing, so it runs fewer requests.
+SCENARIOS = {
+    "comments_list": 200,
+    "comments_list_uncached": 200,
+    "comments_list_cursor": 200,
+    "comments_search": 50,
+    "comments_create": 100,
+    "captcha": 100,
+    "auth_check": 200,
+    "auth_login": 10,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the comments, CAPTCHA and auth API in-process against the "
+        "configured database. Records throughput, latency percentiles and "
+        "queries per request for each scenario, and fails when a scenario "
+        "regresses against --baseline. Use generate_comments for a large "
+        "fixture first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenarios",
+            default=",".join(SCENARIOS),
+            help=f"Comma-separated subset of: {', '.join(SCENARIOS)}",
+        )
+        parser.add_argument(
+            "--requests", type=int, help="Requests per scenario (default varies)"
+        )
+        parser.add_argument("--warmup", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--in-memory",
+            action="store_true",
+            help="Use in-process cache and channel layer instead of Redis",
+        )
+        parser.add_argument("--json", dest="json_path", help="Write results here")
+        parser.add_argument("--baseline", help="Results JSON from an earlier run")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Allowed relative slowdown before flagging a regression",
+        )
+
+    def handle(self, *args, **options):
+        names = options["scenarios"].split(",")
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        # Requests still pass through the rate limiter, but are never throttled
+        overrides = {"RATE_LIMITS": unthrottled_rate_limits()}
+        if options["in_memory"]:
+            overrides.update(IN_MEMORY_SETTINGS)
+        with override_settings(**overrides):
+            results = self.run_benchmark(names, options)
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as output:
+                json.dump(
+                    {
+                        "benchmark": "api",
+                        "started_at": datetime.now(timezone.utc).isoformat(),
+                        "database": connection.vendor,
+                        "comments": Comment.objects.count(),
+                        "results": results,
+                    },
+                    output,
+                    indent=2,
+                )
+
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)["results"]
+            regressions = find_regressions(results, baseline, options["tolerance"])
+            if regressions:
+                raise CommandError(
+                    "Performance regressions:\n  " + "\n  ".join(regressions)
+                )
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline"))
+
+    def run_benchmark(self, names, options):
+        self.rng = random.Random(options["seed"])
+        self.user, created = User.objects.get_or_create(username=BENCHMARK_USER)
+        if created or not self.user.check_password(BENCHMARK_PASSWORD):
+            self.user.set_password(BENCHMARK_PASSWORD)
+            self.user.save()
+        self.client = Client(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}",
+            raise_request_exception=False,
+        )
+        self.pages = max(1, Comment.objects.filter(parent__isnull=True).count() // 25)
+        self.cursor = None
+
+        results = {}
+        try:
+            for name in names:
+                count = options["requests"] or SCENARIOS[name]
+                results[name] = self.run_scenario(name, count, options["warmup"])
+                row = results[name]
+                self.stdout.write(
+                    f"{name:<24} {row['requests_per_second']:>8.1f} req/s  "
+                    f"p50 {row['p50_ms']:>8.1f} ms  "
+                    f"p95 {row['p95_ms']:>8.1f} ms  "
+                    f"p99 {row['p99_ms']:>8.1f} ms  "
+                    f"{row['queries_mean']:>5.1f} queries  "
+                    f"{row['errors']} errors"
+                )
+        finally:
+            Comment.objects.filter(text__startswith=MARKER).delete()
+        return results
+
+    def run_scenario(self, name, count, warmup):
+        """Time ``count`` requests of a scenario after ``warmup`` untimed ones."""
+        scenario = getattr(self, f"scenario_{name}")
+        latencies = []
+        queries = []
+        errors = 0
+        for index in range(warmup + count):
+            request = scenario(index)  # Untimed setup, returns the request
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = request()
+                elapsed = time.perf_counter() - started
+            if index < warmup:
+                continue
+            latencies.append(elapsed)
+            queries.append(len(captured))
+            if response.status_code >= 400:
+                errors += 1
+
+        return {
+            "requests": count,
+            "requests_per_second": count / sum(latencies),
+            **summarize_latencies(latencies),
+            "queries_mean": sum(queries) / len(queries),
+            "queries_max": max(queries),
+            "errors": errors,
+        }
+
+    def random_page(self, last=100):
+        return self.rng.randint(1, min(self.pages, last))
+
+    def scenario_comments_list(self, index):
+        page = self.random_page(last=5)  # Hot pages, served from the cache
+        return lambda: self.client.get(f"/api/comments/?page={page}")
+
+    def scenario_comments_list_uncached(self, index):
+        bump_list_generation()
+        local_cache.clear()
+        page = self.random_page()
+        return lambda: self.client.get(f"/api/comments/?page={page}")
+
+    def scenario_comments_list_cursor(self, index):
+        bump_list_generation()
+        local_cache.clear()
+        url = self.cursor or "/api/comments/?pagination=cursor"
+
+        def request():
+            response = self.client.get(url)
+            if response.status_code == 200:
+                self.cursor = response.json().get("next")
+            return response
+
+        return request
+
+    def scenario_comments_search(self, index):
+        bump_list_generation()
+        word = self.rng.choice(["lorem", "django", "websocket", "latency"])
+        return lambda: self.client.get(f"/api/comments/?search={word}")
+
+    def scenario_comments_create(self, index):
+        [(key, answer)] = make_captchas(1)
+        data = {
+            "username": "benchmark",
+            "email": "benchmark@example.com",
+            "text": f"{MARKER} {index}",
+            "captcha_key": key,
+            "captcha_text": answer,
+        }
+        return lambda: self.client.post(
+            "/api/comments/", data, content_type="application/json"
+        )
+
+    def scenario_captcha(self, index):
+        # A distinct client address per request keeps clear of the rate limit
+        address = f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+        return lambda: self.client.get("/api/captcha/", REMOTE_ADDR=address)
+
+    def scenario_auth_check(self, index):
+        return lambda: self.client.get("/api/auth/check/")
+
+    def scenario_auth_login(self, index):
+        data = {"username": BENCHMARK_USER, "password": BENCHMARK_PASSWORD}
+        return lambda: Client(raise_request_exception=False).post(
+            "/api/auth/login/", data, content_type="application/json"
+        )
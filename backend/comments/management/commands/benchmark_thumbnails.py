@@ -0,0 +1,164 @@
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import warnings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from PIL import Image
+from comments.images import THUMBNAIL_SIZE, build_image_variants
+
+SIZE_CLASSES = {
+    "small": (640, 480),
+    "medium": (1920, 1080),
+    "large": (4000, 3000),
+    "huge": (10000, 10000),
+}
+GIF_SIZE = (1600, 1200)
+GIF_FRAMES = 30
+
+
+def legacy_thumbnail(path):
+    """The original inline Comment.save code path, for comparison."""
+    img = Image.open(path)
+    if img.height > THUMBNAIL_SIZE[1] or img.width > THUMBNAIL_SIZE[0]:
+        img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+        img.save(path)
+
+
+def current_variants(path):
+    """The background pipeline: every variant size and format."""
+    build_image_variants(path)
+
+
+def uncapped_variants(path):
+    """The current path with the pixel cap lifted, to measure decoding."""
+    build_image_variants(path, max_pixels=10**12)
+
+
+def read_status(field):
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field):
+                    return int(line.split()[1])  # kB
+    except OSError:
+        pass
+    return None
+
+
+def measure(func, path, queue):
+    """Run one thumbnail in a forked child and report time and peak RSS."""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")  # Reset VmHWM to the current RSS
+    except OSError:
+        pass
+    baseline = read_status("VmRSS") or 0
+
+    rejected = False
+    start = time.perf_counter()
+    try:
+        func(path)
+    except ValueError:  # Refused by COMMENT_MAX_IMAGE_PIXELS
+        rejected = True
+    elapsed = time.perf_counter() - start
+
+    peak = read_status("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(
+        {
+            "seconds": elapsed,
+            "peak_rss_mb": (peak - baseline) / 1024,
+            "rejected": rejected,
+        }
+    )
+
+
+def make_samples(directory, queue):
+    """Write sample images; runs in a child so the parent heap stays small."""
+    samples = {}
+    for name, size in SIZE_CLASSES.items():
+        for fmt, ext in (("JPEG", "jpg"), ("PNG", "png")):
+            path = os.path.join(directory, f"{name}.{ext}")
+            Image.effect_noise(size, 64).convert("RGB").save(path, fmt)
+            samples[f"{name}-{ext} {size[0]}x{size[1]}"] = path
+
+    frames = [
+        Image.effect_noise(GIF_SIZE, 32 + i).convert("P") for i in range(GIF_FRAMES)
+    ]
+    path = os.path.join(directory, "animated.gif")
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=80)
+    samples[f"animated-gif {GIF_SIZE[0]}x{GIF_SIZE[1]}x{GIF_FRAMES}"] = path
+    queue.put(samples)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark peak RSS and time of comment image processing per image "
+        "size class: the legacy inline thumbnail, and build_image_variants "
+        "with and without COMMENT_MAX_IMAGE_PIXELS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--json", dest="json_path", help="Write results here")
+
+    def handle(self, *args, **options):
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+        context = multiprocessing.get_context("fork")
+        workdir = tempfile.mkdtemp()
+        media_root = os.path.join(workdir, "media")
+        results = []
+        try:
+            queue = context.Queue()
+            child = context.Process(target=make_samples, args=(workdir, queue))
+            child.start()
+            samples = queue.get()
+            child.join()
+            for label, source in samples.items():
+                for variant, func in (
+                    ("legacy", legacy_thumbnail),
+                    ("uncapped", uncapped_variants),
+                    ("current", current_variants),
+                ):
+                    runs = []
+                    for _ in range(options["repeat"]):
+                        path = f"{source}.{variant}{os.path.splitext(source)[1]}"
+                        shutil.copyfile(source, path)
+                        # Fresh variant storage, so every run encodes and writes
+                        shutil.rmtree(media_root, ignore_errors=True)
+                        queue = context.Queue()
+                        with override_settings(MEDIA_ROOT=media_root):
+                            child = context.Process(
+                                target=measure, args=(func, path, queue)
+                            )
+                            child.start()
+                            runs.append(queue.get())
+                            child.join()
+                    results.append(
+                        {
+                            "image": label,
+                            "variant": variant,
+                            "seconds": min(run["seconds"] for run in runs),
+                            "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+                            "rejected": runs[0]["rejected"],
+                        }
+                    )
+                    row = results[-1]
+                    self.stdout.write(
+                        f"{label:<36} {variant:<8} "
+                        f"{row['seconds'] * 1000:>9.1f} ms "
+                        f"{row['peak_rss_mb']:>9.1f} MB"
+                        + ("  (rejected)" if row["rejected"] else "")
+                    )
+        finally:
+            shutil.rmtree(workdir)
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as output:
+                json.dump(results, output, indent=2)
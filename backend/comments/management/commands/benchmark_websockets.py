@@ -0,0 +1,256 @@
+import asyncio
+import json
+import multiprocessing
+import resource
+import socket
+import time
+import urllib.request
+from datetime import datetime, timezone
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from websockets.asyncio.client import connect
+from comments.captchas import make_captchas
+from comments.management.benchmarking import (
+    IN_MEMORY_SETTINGS,
+    percentile,
+    unthrottled_rate_limits,
+)
+from comments.models import Comment
+
+MARKER = "ws-benchmark"
+
+
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def read_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_server(port):
+    """Serve comment_app.asgi with in-memory backends (forked child)."""
+    import uvicorn
+
+    raise_open_file_limit()
+    from comment_app.asgi import application
+
+    uvicorn.run(
+        application,
+        host="127.0.0.1",
+        port=port,
+        log_level="warning",
+        ws_max_size=65536,
+        backlog=4096,
+    )
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def post_comment(url, token, text, captcha):
+    body = json.dumps(
+        {
+            "username": "benchmark",
+            "email": "benchmark@example.com",
+            "text": text,
+            "captcha_key": captcha[0],
+            "captcha_text": captcha[1],
+        }
+    ).encode()
+    request = urllib.request.Request(
+        url,
+        data=body,
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}",
+        },
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+
+
+class Command(BaseCommand):
+    help = (
+        "Open N WebSocket connections to ws/comments/ on a local single-worker "
+        "ASGI server, post comments through the REST API and report delivery "
+        "latency percentiles, memory per connection and messages/sec."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--connections",
+            default="100,1000",
+            help="Comma-separated connection counts to test, e.g. 100,1000,5000",
+        )
+        parser.add_argument(
+            "--rate", type=float, default=10, help="Comments posted per second"
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10, help="Seconds to post for"
+        )
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--json", dest="json_path", help="Write results here")
+
+    def handle(self, *args, **options):
+        # The server is a single uvicorn worker with everything in-process, so
+        # the numbers reflect one worker and not the health of Redis. The
+        # settings, including unthrottled rate limits, also apply to the
+        # forked server.
+        with override_settings(
+            **IN_MEMORY_SETTINGS, RATE_LIMITS=unthrottled_rate_limits()
+        ):
+            self.run_benchmark(options)
+
+    def run_benchmark(self, options):
+        levels = [int(count) for count in options["connections"].split(",")]
+        limit = raise_open_file_limit()
+        if max(levels) * 2 + 100 > limit:
+            self.stderr.write(f"Open file limit {limit} may be too low")
+
+        user, _ = User.objects.get_or_create(username="ws-benchmark")
+        port = options["port"]
+        connections.close_all()  # Not shared with the forked server
+        server = multiprocessing.get_context("fork").Process(
+            target=run_server, args=(port,), daemon=True
+        )
+        server.start()
+        results = []
+        try:
+            wait_for_port(port)
+            for count in levels:
+                posts = max(1, int(options["rate"] * options["duration"]))
+                captchas = make_captchas(posts)
+                connections.close_all()
+
+                result = asyncio.run(
+                    self.run_level(
+                        port,
+                        server.pid,
+                        count,
+                        captchas,
+                        options["rate"],
+                        str(AccessToken.for_user(user)),
+                    )
+                )
+                results.append(result)
+                self.stdout.write(
+                    f"{count:>7} sockets  "
+                    f"connect {result['connect_seconds']:>6.2f} s  "
+                    f"p50 {result['p50_ms'] or 0:>8.1f} ms  "
+                    f"p99 {result['p99_ms'] or 0:>8.1f} ms  "
+                    f"{result['rss_per_connection_kb'] or 0:>6.1f} KiB/socket  "
+                    f"{result['messages_per_second']:>9.0f} msg/s  "
+                    f"delivered {result['delivered']}/{result['expected']}"
+                )
+        finally:
+            server.terminate()
+            server.join()
+            Comment.objects.filter(text__startswith=MARKER).delete()
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as output:
+                json.dump(
+                    {
+                        "benchmark": "websockets",
+                        "started_at": datetime.now(timezone.utc).isoformat(),
+                        "rate": options["rate"],
+                        "duration": options["duration"],
+                        "results": results,
+                    },
+                    output,
+                    indent=2,
+                )
+
+    async def run_level(self, port, server_pid, count, captchas, rate, token):
+        """Measure one connection count; every socket receives every comment."""
+        sent = {}
+        latencies = []
+        last_delivery = 0
+        expected = len(captchas) * count
+
+        async def listen(websocket):
+            nonlocal last_delivery
+            async for frame in websocket:
+                received = time.perf_counter()
+                data = json.loads(frame)
+                for event in data if isinstance(data, list) else [data]:
+                    started = sent.get(event.get("text"))
+                    if started is not None:
+                        latencies.append(received - started)
+                        last_delivery = received
+
+        rss_before = read_rss_kb(server_pid)
+        opening = asyncio.Semaphore(100)
+
+        async def open_socket():
+            async with opening:
+                return await connect(
+                    f"ws://127.0.0.1:{port}/ws/comments/?batch=1",
+                    ping_interval=None,
+                    open_timeout=60,
+                )
+
+        started = time.perf_counter()
+        sockets = await asyncio.gather(*(open_socket() for _ in range(count)))
+        connect_seconds = time.perf_counter() - started
+        listeners = [asyncio.create_task(listen(websocket)) for websocket in sockets]
+        await asyncio.sleep(1)
+        rss_after = read_rss_kb(server_pid)
+
+        url = f"http://127.0.0.1:{port}/api/comments/"
+
+        async def post(index, captcha):
+            await asyncio.sleep(index / rate)
+            text = f"{MARKER} {count}-{index}"
+            sent[text] = time.perf_counter()
+            await asyncio.to_thread(post_comment, url, token, text, captcha)
+
+        first_post = time.perf_counter()
+        await asyncio.gather(
+            *(post(index, captcha) for index, captcha in enumerate(captchas))
+        )
+        deadline = time.monotonic() + 30
+        while len(latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*(websocket.close() for websocket in sockets))
+
+        elapsed = (last_delivery or time.perf_counter()) - first_post
+        p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+        return {
+            "connections": count,
+            "connect_seconds": connect_seconds,
+            "rss_per_connection_kb": (
+                (rss_after - rss_before) / count
+                if rss_before is not None and rss_after is not None
+                else None
+            ),
+            "p50_ms": p50 * 1000 if p50 is not None else None,
+            "p99_ms": p99 * 1000 if p99 is not None else None,
+            "delivered": len(latencies),
+            "expected": expected,
+            "messages_per_second": len(latencies) / elapsed if elapsed > 0 else 0,
+        }
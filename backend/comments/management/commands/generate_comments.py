@@ -0,0 +1,76 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from comments.models import Comment
+
+FIXTURE_EMAIL_DOMAIN = "fixtures.example.com"
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua django channels redis "
+    "postgres comment reply thread websocket cache query index latency"
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-insert benchmark fixture comments: top-level threads with a fixed "
+        "number of replies each, e.g. --count 1000000 for one million rows. "
+        "Signals do not fire, so nothing is broadcast or cached."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count", type=int, default=1000000, help="Total comments to create"
+        )
+        parser.add_argument(
+            "--replies", type=int, default=3, help="Replies per top-level comment"
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def make_comment(self, rng, parent_id=None):
+        user = rng.randrange(10000)
+        return Comment(
+            username=f"user{user}",
+            email=f"user{user}@{FIXTURE_EMAIL_DOMAIN}",
+            text=" ".join(rng.choices(WORDS, k=rng.randint(5, 60))),
+            parent_id=parent_id,
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        per_thread = options["replies"] + 1
+        threads = max(1, options["count"] // per_thread)
+        batch = max(1, options["batch_size"] // per_thread)
+        started = time.perf_counter()
+        created = 0
+
+        for start in range(0, threads, batch):
+            with transaction.atomic():
+                parents = Comment.objects.bulk_create(
+                    [
+                        self.make_comment(rng)
+                        for _ in range(start, min(threads, start + batch))
+                    ]
+                )
+                replies = Comment.objects.bulk_create(
+                    [
+                        self.make_comment(rng, parent.pk)
+                        for parent in parents
+                        for _ in range(options["replies"])
+                    ]
+                )
+            created += len(parents) + len(replies)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{created} comments ({created / elapsed:.0f}/s)", ending="\r"
+            )
+            self.stdout.flush()
+
+        self.stdout.write("")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {created} comments in {time.perf_counter() - started:.1f} s"
+            )
+        )
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from comments.images import (
+    enqueue_comment_image,
+    process_comment_image,
+    resubmit_stale_images,
+    run_image_worker,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Process comment images queued in Redis (COMMENT_IMAGE_QUEUE=redis). "
+        "Use --sweep for cron to re-submit images stuck in pending, e.g. jobs "
+        "of the local pool lost on restart."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sweep",
+            action="store_true",
+            help="Re-submit stale pending images once, then exit",
+        )
+
+    def handle(self, *args, **options):
+        if options["sweep"]:
+            # Without a Redis worker to hand them to, process them here
+            redis = settings.COMMENT_IMAGE_QUEUE == "redis"
+            count = resubmit_stale_images(
+                enqueue_comment_image if redis else process_comment_image
+            )
+            self.stdout.write(self.style.SUCCESS(f"Re-submitted {count} images"))
+            return
+
+        self.stdout.write("Waiting for comment images...")
+        run_image_worker()
@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from comments.captchas import get_captcha_pool, refill_pool
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep the CAPTCHA pool filled with pre-rendered CAPTCHAs and remove "
+        "expired ones (COMMENT_CAPTCHA_POOL=redis). Use --once for cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval", type=float, default=1, help="Seconds between checks"
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="Refill and clean up once, then exit"
+        )
+
+    def handle(self, *args, **options):
+        pool = get_captcha_pool()
+        if options["once"]:
+            added = refill_pool(pool)
+            self.stdout.write(self.style.SUCCESS(f"Added {added} CAPTCHAs"))
+            return
+
+        self.stdout.write("Refilling the CAPTCHA pool...")
+        while True:
+            try:
+                refill_pool(pool)
+            except Exception as e:
+                self.stderr.write(f"Error refilling CAPTCHA pool: {str(e)}")
+            time.sleep(options["interval"])
@@ -0,0 +1,53 @@
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_CONFIG = "pg_catalog.english"
+
+FORWARD_SQL = [
+    "CREATE INDEX comments_comment_search_vector_gin "
+    "ON comments_comment USING gin (search_vector)",
+    "CREATE TRIGGER comments_comment_search_vector_update "
+    "BEFORE INSERT OR UPDATE OF text ON comments_comment "
+    "FOR EACH ROW EXECUTE FUNCTION "
+    f"tsvector_update_trigger(search_vector, '{SEARCH_CONFIG}', text)",
+    "UPDATE comments_comment "
+    f"SET search_vector = to_tsvector('{SEARCH_CONFIG}', text)",
+]
+
+REVERSE_SQL = [
+    "DROP TRIGGER IF EXISTS comments_comment_search_vector_update "
+    "ON comments_comment",
+    "DROP INDEX IF EXISTS comments_comment_search_vector_gin",
+]
+
+
+def run_on_postgres(statements):
+    """The GIN index and trigger are PostgreSQL-only; SQLite skips them."""
+
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != "postgresql":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("comments", "0003_alter_comment_created_at_alter_comment_email_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.RunPython(
+            run_on_postgres(FORWARD_SQL), run_on_postgres(REVERSE_SQL)
+        ),
+    ]
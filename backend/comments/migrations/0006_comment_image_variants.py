@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("comments", "0005_comment_image_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="image_variants",
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:12
+
+import comments.storage
+import django.core.validators
+from collections import Counter
+from django.db import migrations, models
+
+
+def count_existing_attachments(apps, schema_editor):
+    """Start reference counts for files uploaded before deduplication."""
+    Comment = apps.get_model("comments", "Comment")
+    StoredFile = apps.get_model("comments", "StoredFile")
+
+    counts = Counter()
+    for image, file, variants in Comment.objects.values_list(
+        "image", "file", "image_variants"
+    ).iterator():
+        counts.update(name for name in (image, file) if name)
+        for variant in (variants or {}).values():
+            counts.update(
+                value
+                for key, value in variant.items()
+                if key not in ("width", "height")
+            )
+
+    StoredFile.objects.bulk_create(
+        [StoredFile(name=name, ref_count=count) for name, count in counts.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("comments", "0006_comment_image_variants"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StoredFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255, unique=True)),
+                ("ref_count", models.IntegerField(default=0)),
+                ("image_variants", models.JSONField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="comment",
+            name="file",
+            field=models.FileField(
+                blank=True,
+                null=True,
+                storage=comments.storage.ContentAddressedStorage(),
+                upload_to="uploads/",
+                validators=[django.core.validators.FileExtensionValidator(["txt"])],
+            ),
+        ),
+        migrations.AlterField(
+            model_name="comment",
+            name="image",
+            field=models.ImageField(
+                blank=True,
+                null=True,
+                storage=comments.storage.ContentAddressedStorage(),
+                upload_to="uploads/",
+                validators=[
+                    django.core.validators.FileExtensionValidator(
+                        ["jpg", "jpeg", "png", "gif"]
+                    )
+                ],
+            ),
+        ),
+        migrations.RunPython(count_existing_attachments, migrations.RunPython.noop),
+    ]
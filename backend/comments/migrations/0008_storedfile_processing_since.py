@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("comments", "0007_content_addressed_attachments"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="storedfile",
+            name="processing_since",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
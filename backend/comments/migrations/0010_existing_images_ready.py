@@ -0,0 +1,22 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:05
+
+from django.db import migrations
+
+
+def mark_existing_images_ready(apps, schema_editor):
+    """Images uploaded before the background pipeline were resized inline."""
+    Comment = apps.get_model("comments", "Comment")
+    Comment.objects.filter(image_status="", image__isnull=False).exclude(
+        image=""
+    ).update(image_status="ready")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("comments", "0009_comment_keyset_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(mark_existing_images_ready, migrations.RunPython.noop),
+    ]
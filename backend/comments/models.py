@@ -1,8 +1,9 @@
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.core.validators import FileExtensionValidator
-from PIL import Image
 from bleach import clean
+from .storage import attachment_storage
 
 ALLOWED_TAGS = ["a", "code", "i", "strong"]
 
@@ -15,18 +16,31 @@ def validate_html(value):
 
 
 class Comment(models.Model):
+    class ImageStatus(models.TextChoices):
+        NONE = "", "No image"
+        PENDING = "pending", "Pending"
+        READY = "ready", "Ready"
+        FAILED = "failed", "Failed"
+
     username = models.CharField(max_length=50, db_index=True)
     email = models.EmailField(db_index=True)
     homepage = models.URLField(blank=True, null=True)
     text = models.TextField(validators=[validate_html])
     image = models.ImageField(
         upload_to="uploads/",
+        storage=attachment_storage,
         blank=True,
         null=True,
         validators=[FileExtensionValidator(["jpg", "jpeg", "png", "gif"])],
     )
+    image_status = models.CharField(
+        max_length=10, choices=ImageStatus.choices, blank=True, default=""
+    )
+    # Responsive variants built by comments/images.py, keyed by size name
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     file = models.FileField(
         upload_to="uploads/",
+        storage=attachment_storage,
         blank=True,
         null=True,
         validators=[FileExtensionValidator(["txt"])],
@@ -40,19 +54,58 @@ class Comment(models.Model):
         related_name="replies",
         db_index=True,
     )
+    # Maintained by a database trigger on PostgreSQL, see migration 0004
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        # Keyset pagination (comments/pagination.py) seeks top-level comments
+        # by (sort field, id) for each of the view's ordering_fields
+        indexes = [
+            models.Index(
+                fields=[field, "id"],
+                name=f"comment_top_{field}_id_idx",
+                condition=models.Q(parent__isnull=True),
+            )
+            for field in ("created_at", "username", "email")
+        ]
 
     def save(self, *args, **kwargs):
         if self.file and self.file.size > 100 * 1024:
             raise ValidationError("File size should not exceed 100 KB")
 
-        super().save(*args, **kwargs)
+        # Thumbnailing happens in the background (comments/images.py)
+        new_image = bool(self.image) and not self.image._committed
+        if new_image:
+            self.image_status = self.ImageStatus.PENDING
 
-        if self.image:
-            img = Image.open(self.image.path)
-            if img.height > 240 or img.width > 320:
-                output_size = (320, 240)
-                img.thumbnail(output_size, Image.Resampling.LANCZOS)  # Updated here
-                img.save(self.image.path)
+        # Storage locks a reused blob until post_save has counted the reference
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+        if new_image:
+            from .images import enqueue_comment_image
+
+            pk = self.pk
+            transaction.on_commit(lambda: enqueue_comment_image(pk))
 
     def __str__(self):
         return self.username
+
+
+class StoredFile(models.Model):
+    """
+    Reference count for a blob in content-addressed attachment storage.
+
+    Comments sharing an identical upload (or image variant) share one file;
+    it is deleted once no comment references it any more.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    ref_count = models.IntegerField(default=0)
+    # Processing results for image blobs, reused by identical uploads
+    image_variants = models.JSONField(null=True, blank=True)
+    # Set while a job builds the variants, so duplicates wait for its result
+    processing_since = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,161 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class CommentKeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination for top-level comments.
+
+    Pages are addressed by the position of the last seen row instead of an
+    OFFSET, so no COUNT(*) is issued and every page costs the same index
+    range scan regardless of depth. The sort field comes from the view's
+    ``ordering_fields`` and ``id`` is always appended as a tie-breaker.
+    """
+
+    cursor_query_param = "cursor"
+    page_size = api_settings.PAGE_SIZE
+    tie_breaker = "id"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_ordering(self, request, view):
+        """Return the (field, descending) pair requested by the client."""
+        default = (getattr(view, "ordering", None) or ["-created_at"])[0]
+        ordering = request.query_params.get("ordering", default).split(",")[0]
+        field = ordering.lstrip("-")
+
+        if field not in getattr(view, "ordering_fields", []):
+            ordering = default
+            field = ordering.lstrip("-")
+
+        return field, ordering.startswith("-")
+
+    def encode_cursor(self, position, reverse):
+        """Serialize a position into an opaque, URL-safe cursor string."""
+        payload = json.dumps({"p": position, "r": int(reverse)}, default=str)
+        return urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+    def decode_cursor(self, request):
+        """Return (position, reverse) from the request, or (None, False)."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            padded = encoded + "=" * (-len(encoded) % 4)
+            payload = json.loads(urlsafe_b64decode(padded.encode()).decode())
+            position = payload["p"]
+            if not isinstance(position, list) or len(position) != 2:
+                raise ValueError("Malformed cursor position")
+            return position, bool(payload.get("r"))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def coerce_position(self, model, position):
+        """
+        Convert a decoded position to the sort and tie-breaker field types.
+
+        Raises:
+            NotFound: If either value is not valid for its field, so a
+                tampered cursor is a 404 rather than an error in the query.
+        """
+        try:
+            values = [
+                model._meta.get_field(name).to_python(value)
+                for name, value in zip((self.field, self.tie_breaker), position)
+            ]
+        except (ValidationError, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        if None in values:
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def _position_filter(self, position, descending):
+        """
+        Build the compound ``(field, id) > / < (value, pk)`` predicate.
+
+        The OR alone is not sargable, so it is ANDed with a plain range on
+        the sort field that lets the ``(field, id)`` index seek to the
+        cursor instead of scanning from the start.
+        """
+        value, pk = position
+        lookup = "lt" if descending else "gt"
+        seek = Q(**{f"{self.field}__{lookup}e": value})
+        return seek & (
+            Q(**{f"{self.field}__{lookup}": value})
+            | Q(**{self.field: value, f"{self.tie_breaker}__{lookup}": pk})
+        )
+
+    def _position(self, obj):
+        return [getattr(obj, self.field), getattr(obj, self.tie_breaker)]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.field, descending = self.get_ordering(request, view)
+        position, self.reverse = self.decode_cursor(request)
+
+        # Walking backwards flips the sort so the index is still scanned
+        # from the cursor outwards; the rows are flipped back below.
+        scan_descending = descending != self.reverse
+        prefix = "-" if scan_descending else ""
+        queryset = queryset.order_by(
+            f"{prefix}{self.field}", f"{prefix}{self.tie_breaker}"
+        )
+        if position is not None:
+            position = self.coerce_position(queryset.model, position)
+            queryset = queryset.filter(self._position_filter(position, scan_descending))
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+
+        if self.reverse:
+            results.reverse()
+            self.has_previous, self.has_next = has_more, position is not None
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        self.page = results
+        return results
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        cursor = self.encode_cursor(self._position(self.page[-1]), reverse=False)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        url = self.request.build_absolute_uri()
+        if not self.page:
+            return remove_query_param(url, self.cursor_query_param)
+        cursor = self.encode_cursor(self._position(self.page[0]), reverse=True)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_next_link(),
+                "previous": self.get_previous_link(),
+                "results": data,
+            }
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
@@ -0,0 +1,148 @@
+import threading
+from collections import deque
+from django.conf import settings
+from comment_app.redis_client import get_redis_client
+
+STREAM_KEY = "comments:stream"
+SEQUENCE_KEY = "comments:stream:seq"
+
+# INCR and XADD run atomically so stream IDs (<seq>-0) stay in order across
+# processes. The sequence number is spliced into the serialized event, with
+# no trailing comma when the event is an empty object.
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+local rest = string.sub(ARGV[3], 2)
+local separator = ','
+if string.match(rest, '^%s*}') then
+    separator = ''
+end
+local text = '{"seq":' .. seq .. separator .. rest
+redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], seq .. '-0',
+           'groups', ARGV[2], 'text', text)
+return seq
+"""
+
+
+def stamp(text, seq):
+    """Insert ``"seq"`` into a serialized JSON object, as APPEND_SCRIPT does."""
+    rest = text[1:]
+    separator = "" if rest.lstrip().startswith("}") else ","
+    return f'{{"seq":{seq}{separator}{rest}'
+
+
+class RedisReplayBuffer:
+    """
+    Sequence numbers and recent events kept in a capped Redis stream.
+
+    Shared by every worker, so a client can resume on any of them.
+    """
+
+    def __init__(self):
+        self._append = None
+
+    def append(self, events):
+        """
+        Assign the next sequence numbers to events and record them.
+
+        Args:
+            events (list): (groups, text) tuples, where ``text`` is the event
+                serialized as a JSON object
+
+        Returns:
+            list: (seq, text with "seq" added) tuples, in order
+        """
+        client = get_redis_client()
+        if self._append is None:
+            self._append = client.register_script(APPEND_SCRIPT)
+        pipe = client.pipeline(transaction=False)
+        for groups, text in events:
+            self._append(
+                keys=[STREAM_KEY, SEQUENCE_KEY],
+                args=[settings.COMMENT_WS_REPLAY_SIZE, ",".join(groups), text],
+                client=pipe,
+            )
+        seqs = pipe.execute()
+        return [(seq, stamp(text, seq)) for seq, (_, text) in zip(seqs, events)]
+
+    def since(self, last_seq, limit):
+        """
+        Return the events after ``last_seq``.
+
+        Args:
+            last_seq (int): Last sequence number the client has seen
+            limit (int): Maximum number of events to replay
+
+        Returns:
+            list | None: (seq, groups, text) tuples, or None if the gap is
+                no longer (or too much to be) covered by the buffer
+        """
+        pipe = get_redis_client().pipeline(transaction=False)
+        pipe.get(SEQUENCE_KEY)
+        pipe.xrange(STREAM_KEY, count=1)
+        pipe.xrange(STREAM_KEY, min=f"{last_seq + 1}-0", count=limit + 1)
+        current, oldest, entries = pipe.execute()
+
+        current = int(current or 0)
+        if last_seq > current:  # The stream was reset since
+            return None
+        if last_seq == current:
+            return []
+        if not oldest or int(oldest[0][0].split(b"-")[0]) > last_seq + 1:
+            return None
+        if len(entries) > limit:
+            return None
+        return [
+            (
+                int(entry_id.split(b"-")[0]),
+                fields[b"groups"].decode().split(","),
+                fields[b"text"].decode(),
+            )
+            for entry_id, fields in entries
+        ]
+
+
+class LocalReplayBuffer:
+    """In-process equivalent of RedisReplayBuffer for a single worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._events = deque()
+
+    def append(self, events):
+        stamped = []
+        with self._lock:
+            for groups, text in events:
+                self._seq += 1
+                text = stamp(text, self._seq)
+                self._events.append((self._seq, list(groups), text))
+                stamped.append((self._seq, text))
+            while len(self._events) > settings.COMMENT_WS_REPLAY_SIZE:
+                self._events.popleft()
+        return stamped
+
+    def since(self, last_seq, limit):
+        with self._lock:
+            if last_seq > self._seq:
+                return None
+            if last_seq == self._seq:
+                return []
+            if not self._events or self._events[0][0] > last_seq + 1:
+                return None
+            entries = [event for event in self._events if event[0] > last_seq]
+        if len(entries) > limit:
+            return None
+        return entries
+
+
+_buffers = {}
+
+
+def get_replay_buffer():
+    """Return the replay buffer selected by ``COMMENT_WS_REPLAY``."""
+    backend = settings.COMMENT_WS_REPLAY
+    if backend not in _buffers:
+        _buffers[backend] = (
+            RedisReplayBuffer() if backend == "redis" else LocalReplayBuffer()
+        )
+    return _buffers[backend]
@@ -0,0 +1,45 @@
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+from .models import Comment
+
+
+def load_replies(parents, limit=None):
+    """
+    Fetch the replies of several comments with a single query.
+
+    Args:
+        parents: Iterable of top-level Comment instances (e.g. one page)
+        limit: Optional maximum number of replies returned per parent
+
+    Returns:
+        dict mapping parent id to a ``(replies, reply_count)`` tuple, where
+        ``reply_count`` is the total number of replies even when capped.
+    """
+    parent_ids = [parent.pk for parent in parents]
+    batch = {parent_id: ([], 0) for parent_id in parent_ids}
+    if not parent_ids:
+        return batch
+
+    partition = [F("parent_id")]
+    queryset = (
+        Comment.objects.filter(parent_id__in=parent_ids)
+        .defer("search_vector")
+        .annotate(reply_count=Window(Count("id"), partition_by=partition))
+        .order_by("parent_id", "created_at", "id")
+    )
+
+    if limit is not None:
+        queryset = queryset.annotate(
+            reply_rank=Window(
+                RowNumber(),
+                partition_by=partition,
+                order_by=[F("created_at").asc(), F("id").asc()],
+            )
+        ).filter(reply_rank__lte=limit)
+
+    for reply in queryset:
+        replies, _ = batch[reply.parent_id]
+        replies.append(reply)
+        batch[reply.parent_id] = (replies, reply.reply_count)
+
+    return batch
@@ -1,12 +1,25 @@
+from django.core.files.storage import default_storage
 from rest_framework import serializers
-from captcha.models import CaptchaStore
+from comment_app.performance_middleware import timed
+from .captchas import consume_captcha
+from .images import display_variant, variant_srcset
 from .models import Comment
 
 
+class TimedListSerializer(serializers.ListSerializer):
+    """Report list serialization time to the performance middleware."""
+
+    def to_representation(self, data):
+        with timed("serialize"):
+            return super().to_representation(data)
+
+
 class CommentSerializer(serializers.ModelSerializer):
     captcha_key = serializers.CharField(write_only=True)
     captcha_text = serializers.CharField(write_only=True)
     replies = serializers.SerializerMethodField()
+    reply_count = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Comment
@@ -17,24 +30,63 @@ class CommentSerializer(serializers.ModelSerializer):
             "homepage",
             "text",
             "image",
+            "image_status",
+            "image_srcset",
             "file",
             "parent",
             "created_at",
             "captcha_key",
             "captcha_text",
             "replies",
+            "reply_count",
         ]
-        read_only_fields = ["id", "created_at"]
+        read_only_fields = ["id", "created_at", "image_status"]
+        list_serializer_class = TimedListSerializer
+
+    def _get_reply_batch(self, obj):
+        """
+        Return ``(replies, reply_count)`` for the comment.
+
+        The view preloads replies for a whole page with ``load_replies`` and
+        passes them in the ``reply_batch`` context entry; replies themselves
+        never have children because nesting is limited to one level.
+        """
+        batch = self.context.get("reply_batch")
+        if batch is not None:
+            if obj.pk in batch:
+                return batch[obj.pk]
+            if obj.parent_id is not None:
+                return [], 0
+
+        replies = list(obj.replies.all())  # Uses prefetch cache if present
+        return replies, len(replies)
 
     def get_replies(self, obj):
-        """Get all replies for the current comment."""
-        if hasattr(obj, "replies"):  # Check if replies relation exists
-            return CommentSerializer(
-                obj.replies.all().select_related("parent"),  # Optimize query
-                many=True,
-                context=self.context,
-            ).data
-        return []
+        """Get the (possibly capped) replies for the current comment."""
+        replies, _ = self._get_reply_batch(obj)
+        return CommentSerializer(replies, many=True, context=self.context).data
+
+    def get_reply_count(self, obj):
+        """Get the total number of replies for the current comment."""
+        _, reply_count = self._get_reply_batch(obj)
+        return reply_count
+
+    def get_image_srcset(self, obj):
+        """Responsive image variants as ``{format: srcset}``."""
+        request = self.context.get("request")
+        build_url = request.build_absolute_uri if request else str
+        return variant_srcset(obj.image_variants, build_url)
+
+    def to_representation(self, instance):
+        """Serve the 320x240 display variant as ``image`` once it is built."""
+        data = super().to_representation(instance)
+        if instance.image_status == Comment.ImageStatus.READY:
+            display = display_variant(instance.image_variants)
+            if display:
+                request = self.context.get("request")
+                url = default_storage.url(display)
+                data["image"] = request.build_absolute_uri(url) if request else url
+        return data
 
     def validate(self, data):
         """Validate the comment data including CAPTCHA verification."""
@@ -51,20 +103,14 @@ class CommentSerializer(serializers.ModelSerializer):
                 {"captcha": "Both captcha key and text are required"}
             )
 
-        try:
-            captcha = CaptchaStore.objects.get(hashkey=captcha_key)
-            if (
-                captcha.response.upper() != captcha_text.upper()
-            ):  # Case-insensitive comparison
-                raise serializers.ValidationError({"captcha_text": "Invalid CAPTCHA"})
-
-            # Delete used CAPTCHA immediately
-            captcha.delete()
-
-        except CaptchaStore.DoesNotExist:
+        # Fetched and deleted in one step, so each CAPTCHA is checked once
+        answer = consume_captcha(captcha_key)
+        if answer is None:
             raise serializers.ValidationError(
                 {"captcha_key": "Invalid or expired CAPTCHA key"}
             )
+        if answer.upper() != captcha_text.upper():  # Case-insensitive comparison
+            raise serializers.ValidationError({"captcha_text": "Invalid CAPTCHA"})
 
         # Validate parent comment if provided
         if "parent" in data and data["parent"]:
@@ -1,9 +1,12 @@
 import logging
-from django.db.models.signals import post_save
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from django.core.exceptions import ObjectDoesNotExist
+from .attachments import attachment_names, release, retain
+from .broadcast import broadcaster, comment_groups
+from .caching import bump_list_generation
 from .models import Comment
 from django.conf import settings
 
@@ -26,36 +29,72 @@ def send_new_comment_via_websocket(sender, instance, created, **kwargs):
         if not created:
             return
 
-            # Get the channel layer for WebSocket communication
-        channel_layer = get_channel_layer()
-
         # Prepare the message payload
-        message_payload = {
-            "type": "send_comment",
-            "message": {
-                "id": instance.id,
-                "username": instance.username,
-                "email": instance.email,
-                "text": instance.text,
-                "created_at": instance.created_at.isoformat(),
-                "image": (
-                    f"{settings.SITE_URL}{instance.image.url}"
-                    if instance.image
-                    else None
-                ),
-                "file": (
-                    f"{settings.SITE_URL}{instance.file.url}" if instance.file else None
-                ),
-                "parent": instance.parent.id if instance.parent else None,
-            },
+        message = {
+            "id": instance.id,
+            "username": instance.username,
+            "email": instance.email,
+            "text": instance.text,
+            "created_at": instance.created_at.isoformat(),
+            "image": (
+                f"{settings.SITE_URL}{instance.image.url}" if instance.image else None
+            ),
+            "file": (
+                f"{settings.SITE_URL}{instance.file.url}" if instance.file else None
+            ),
+            "parent": instance.parent.id if instance.parent else None,
         }
 
-        # Send the message to the WebSocket group
-        async_to_sync(channel_layer.group_send)("comments", message_payload)
+        # Sent only if the comment commits, by the background broadcaster
+        # (comments/broadcast.py), so the request never waits on Redis
+        transaction.on_commit(
+            partial(broadcaster.publish, comment_groups(message["parent"]), message)
+        )
 
-        logger.info(f"Successfully sent comment ID {instance.id} to WebSocket")
+        logger.info(f"Queued comment ID {instance.id} for WebSocket broadcast")
 
     except ObjectDoesNotExist:
         logger.error(f"Failed to find comment with ID {instance.id}")
     except Exception as e:
         logger.error(f"Error sending comment to WebSocket: {str(e)}")
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_list_cache(sender, instance, **kwargs):
+    """
+    Signal handler to invalidate cached comment lists on any write.
+
+    The generation is bumped after commit so a concurrent reader cannot
+    cache the pre-commit state under the new generation.
+    """
+    transaction.on_commit(bump_list_generation)
+
+
+@receiver(pre_save, sender=Comment)
+def remember_previous_attachments(sender, instance, **kwargs):
+    """Record the files an existing comment referenced before this save."""
+    previous = None
+    if instance.pk is not None:
+        previous = Comment.objects.filter(pk=instance.pk).first()
+    instance._previous_attachments = attachment_names(previous) if previous else set()
+
+
+@receiver(post_save, sender=Comment)
+def count_attachment_references(sender, instance, **kwargs):
+    """
+    Signal handler to keep attachment reference counts in sync.
+
+    Identical uploads share one blob in content-addressed storage, so files
+    are only deleted when the last comment referencing them goes away.
+    """
+    current = attachment_names(instance)
+    previous = getattr(instance, "_previous_attachments", set())
+    retain(current - previous)
+    release(previous - current)
+
+
+@receiver(post_delete, sender=Comment)
+def release_attachments(sender, instance, **kwargs):
+    """Release a deleted comment's files, including CASCADE-deleted replies."""
+    release(attachment_names(instance))
@@ -0,0 +1,61 @@
+import os
+import tempfile
+from hashlib import sha256
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that names every upload after the SHA-256 of its bytes.
+
+    The hash is computed while the upload is streamed to a temporary file,
+    so identical uploads end up as one blob (``<dir>/ab/abcd....ext``) and a
+    known blob is not written twice. Blobs are shared between comments and
+    reference-counted by ``comments/attachments.py``; saving must happen in
+    the transaction that takes the reference (see ``Comment.save``) so the
+    blob's row stays locked against garbage collection until then.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is derived from the content in _save()
+        return name
+
+    def _save(self, name, content):
+        # Lazy import: the models module builds its fields with this storage
+        from .attachments import lock_blobs
+
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        os.makedirs(self.path(directory), exist_ok=True)
+
+        hasher = sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.path(directory), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as output:
+                if hasattr(content, "seek"):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    output.write(chunk)
+
+            digest = hasher.hexdigest()
+            blob_name = os.path.join(directory, digest[:2], f"{digest}{extension}")
+            blob_path = self.path(blob_name)
+            if lock_blobs([blob_name]):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+                if self.file_permissions_mode is not None:
+                    os.chmod(blob_path, self.file_permissions_mode)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return blob_name.replace("\\", "/")
+
+
+attachment_storage = ContentAddressedStorage()
@@ -1,3 +1,1190 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from hashlib import sha256
+from io import BytesIO, StringIO
+from unittest import mock
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from comment_app.ratelimit import SlidingWindowLimiter
+from captcha.models import CaptchaStore
+from channels.sessions import CookieMiddleware
+from comment_app.jwt_cookie_middleware import JWTCookieWebSocketMiddleware
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.test import TestCase, override_settings
+from PIL import Image, JpegImagePlugin, PngImagePlugin
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from . import images
+from .attachments import collect_garbage, variant_names
+from .broadcast import ALL_GROUP, broadcaster, comment_groups
+from .captchas import (
+    _local_captchas,
+    _local_pool,
+    _recent_takes,
+    consume_captcha,
+    make_captchas,
+    refill_pool,
+    take_captcha,
+)
+from .consumers import CommentConsumer
+from .filters import CommentSearchFilter
+from .management.benchmarking import find_regressions
+from .caching import acquire_rebuild_lock, local_cache, release_rebuild_lock
+from .models import Comment, StoredFile
+from .pagination import CommentKeysetPagination
+from .serializers import CommentSerializer
+from .storage import attachment_storage
+from .throttling import LocalTokenBucket
 
-# Create your tests here.
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+TEST_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def make_image(size, name="image.png", fmt="PNG"):
+    buffer = BytesIO()
+    Image.new("RGB", size, "white").save(buffer, fmt)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+@override_settings(
+    CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, COMMENT_WS_REPLAY="local"
+)
+class CommentListQueriesTest(TestCase):
+    """The comment list must not issue one query per thread."""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("reader"))
+
+    def create_threads(self, count, replies=3):
+        for i in range(count):
+            parent = Comment.objects.create(
+                username=f"user{i}", email=f"user{i}@example.com", text="parent"
+            )
+            for j in range(replies):
+                Comment.objects.create(
+                    username=f"reply{j}",
+                    email=f"reply{j}@example.com",
+                    text="reply",
+                    parent=parent,
+                )
+
+    def test_list_query_count_is_constant(self):
+        """COUNT + page + replies, regardless of the number of threads."""
+        self.create_threads(2)
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/comments/?ordering=username")
+
+        cache.clear()
+        self.create_threads(20)
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/comments/?ordering=email")
+
+        self.assertEqual(len(response.json()["results"]), 22)
+        for thread in response.json()["results"]:
+            self.assertEqual(thread["reply_count"], 3)
+            self.assertEqual(len(thread["replies"]), 3)
+
+    def test_cursor_list_skips_count_query(self):
+        self.create_threads(10)
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/comments/?pagination=cursor")
+        self.assertNotIn("count", response.json())
+
+    def test_list_queries_skip_search_vector(self):
+        self.create_threads(2)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/api/comments/")
+        self.assertTrue(queries.captured_queries)
+        for query in queries.captured_queries:
+            self.assertNotIn("search_vector", query["sql"])
+
+    def test_replies_limit_keeps_total_count(self):
+        self.create_threads(4, replies=5)
+        response = self.client.get("/api/comments/?replies_limit=2")
+
+        for thread in response.json()["results"]:
+            self.assertEqual(thread["reply_count"], 5)
+            self.assertEqual(len(thread["replies"]), 2)
+            self.assertEqual(thread["replies"][0]["replies"], [])
+
+
+@override_settings(
+    CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, COMMENT_WS_REPLAY="local"
+)
+class CommentKeysetPaginationTest(TestCase):
+    """Cursor pages follow each other without gaps, repeats or 500s."""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("reader"))
+        for i in range(5):
+            Comment.objects.create(
+                username=f"user{i}", email=f"user{i}@example.com", text=str(i)
+            )
+        # Identical sort values: only the id tie-breaker orders these
+        Comment.objects.update(created_at=timezone.now())
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_next_and_previous_links_walk_all_rows(self):
+        with mock.patch.object(CommentKeysetPagination, "page_size", 2):
+            page = self.get("/api/comments/?pagination=cursor")
+            self.assertIsNone(page["previous"])
+            pages = [[row["id"] for row in page["results"]]]
+            while page["next"]:
+                page = self.get(page["next"])
+                pages.append([row["id"] for row in page["results"]])
+
+            ids = [pk for rows in pages for pk in rows]
+            expected = list(
+                Comment.objects.order_by("-id").values_list("id", flat=True)
+            )
+            self.assertEqual(ids, expected)
+            self.assertEqual(len(pages), 3)
+
+            previous = self.get(page["previous"])
+            self.assertEqual([row["id"] for row in previous["results"]], pages[1])
+
+    def test_cursor_page_has_seekable_range(self):
+        created_at = Comment.objects.first().created_at
+        cursor = CommentKeysetPagination().encode_cursor([str(created_at), 3], False)
+        with CaptureQueriesContext(connection) as queries:
+            self.get(f"/api/comments/?cursor={cursor}")
+        page_sql = next(q["sql"] for q in queries if "ORDER BY" in q["sql"])
+        # A plain range on the sort field lets the (created_at, id) index seek
+        self.assertRegex(page_sql, r'"created_at" <= \S+ \S+ AND \(')
+
+    def test_invalid_cursors_are_not_found(self):
+        bad_position = CommentKeysetPagination().encode_cursor(["garbage", 1], False)
+        for cursor in ("not-base64!", bad_position):
+            response = self.client.get(f"/api/comments/?cursor={cursor}")
+            self.assertEqual(response.status_code, 404)
+
+
+@override_settings(
+    CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, COMMENT_WS_REPLAY="local"
+)
+class CommentListCacheTest(TestCase):
+    """Cached list pages must go stale as soon as a comment is written."""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("reader"))
+
+    def test_writes_invalidate_cached_pages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            comment = Comment.objects.create(
+                username="first", email="first@example.com", text="first"
+            )
+        self.assertEqual(self.client.get("/api/comments/").json()["count"], 1)
+
+        with self.assertNumQueries(0):
+            self.client.get("/api/comments/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(
+                username="second", email="second@example.com", text="second"
+            )
+        self.assertEqual(self.client.get("/api/comments/").json()["count"], 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            comment.delete()
+        self.assertEqual(self.client.get("/api/comments/").json()["count"], 1)
+
+    def test_stale_page_served_while_another_worker_rebuilds(self):
+        self.assertEqual(self.client.get("/api/comments/")["X-Cache"], "MISS")
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(username="new", email="new@example.com", text="new")
+
+        with mock.patch("comments.views.acquire_rebuild_lock", return_value=False):
+            with self.assertNumQueries(0):
+                response = self.client.get("/api/comments/")
+        self.assertEqual(response["X-Cache"], "STALE")
+        self.assertEqual(response.json()["count"], 0)
+
+        response = self.client.get("/api/comments/")
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.json()["count"], 1)
+        self.assertEqual(self.client.get("/api/comments/")["X-Cache"], "HIT")
+
+    def test_busy_rebuild_without_stale_copy_is_served_uncached(self):
+        Comment.objects.create(username="a", email="a@example.com", text="a")
+        with mock.patch(
+            "comments.views.acquire_rebuild_lock", return_value=None
+        ), mock.patch("comments.caching.time.sleep") as sleep:
+            response = self.client.get("/api/comments/")
+        self.assertTrue(sleep.called)  # Waited briefly for the other worker
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Cache"], "BYPASS")
+        self.assertEqual(response.json()["count"], 1)
+        # Only the lock holder stores the page
+        self.assertEqual(self.client.get("/api/comments/")["X-Cache"], "MISS")
+
+    def test_expired_lock_holder_cannot_release_new_lock(self):
+        first = acquire_rebuild_lock("page", timeout=10)
+        cache.delete("page:lock")  # The lock timed out mid-rebuild
+        second = acquire_rebuild_lock("page", timeout=10)
+        self.assertIsNone(acquire_rebuild_lock("page", timeout=10))
+
+        release_rebuild_lock("page", first)
+        self.assertIsNone(acquire_rebuild_lock("page", timeout=10))
+        release_rebuild_lock("page", second)
+        self.assertIsNotNone(acquire_rebuild_lock("page", timeout=10))
+
+    def test_cached_bytes_support_etag_and_gzip(self):
+        for i in range(30):
+            Comment.objects.create(username=f"u{i}", email="u@example.com", text="t")
+
+        response = self.client.get("/api/comments/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        gzip_etag = response["ETag"]
+
+        plain = self.client.get("/api/comments/")
+        self.assertEqual(plain["X-Cache"], "HIT")
+        self.assertEqual(gzip_etag, f'{plain["ETag"][:-1]}-gz"')
+        self.assertEqual(plain.json()["count"], 30)
+
+        response = self.client.get("/api/comments/", HTTP_IF_NONE_MATCH=plain["ETag"])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            "/api/comments/", HTTP_IF_NONE_MATCH=gzip_etag, HTTP_ACCEPT_ENCODING="gzip"
+        )
+        self.assertEqual(response.status_code, 304)
+        # A gzip tag does not validate the identity representation
+        response = self.client.get("/api/comments/", HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(PERFORMANCE_SAMPLE_RATE=1.0, PERFORMANCE_SERVER_TIMING=True)
+    def test_server_timing_reports_queries_and_cache(self):
+        response = self.client.get("/api/comments/")
+        timing = response["Server-Timing"]
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('cache;desc="0 hits, 1 misses"', timing)
+        self.assertRegex(timing, r"serialize;dur=[\d.]+")
+
+        timing = self.client.get("/api/comments/")["Server-Timing"]
+        self.assertIn('db;dur=0.0;desc="0 queries"', timing)
+        self.assertIn('cache;desc="1 hits, 0 misses"', timing)
+
+        with self.settings(PERFORMANCE_SAMPLE_RATE=0):
+            self.assertFalse(
+                self.client.get("/api/comments/").has_header("Server-Timing")
+            )
+        with self.settings(PERFORMANCE_SERVER_TIMING=False):
+            self.assertFalse(
+                self.client.get("/api/comments/").has_header("Server-Timing")
+            )
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    COMMENT_WS_REPLAY="local",
+    COMMENT_LOCAL_CACHE_ENABLED=True,
+)
+class CommentLocalCacheTest(TestCase):
+    """The in-process tier answers hot pages without touching the shared cache."""
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("reader"))
+
+    def test_hot_page_served_from_local_tier(self):
+        self.client.get("/api/comments/")
+        with mock.patch.object(cache, "get_many") as shared_get:
+            response = self.client.get("/api/comments/")
+        shared_get.assert_not_called()
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertEqual(local_cache.stats["local"]["hits"], 1)
+
+    def test_write_invalidates_local_tier(self):
+        self.client.get("/api/comments/")
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(username="new", email="new@example.com", text="new")
+        self.assertEqual(self.client.get("/api/comments/").json()["count"], 1)
+
+
+@override_settings(
+    CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, COMMENT_WS_REPLAY="local"
+)
+class CommentSearchTest(TestCase):
+    """?search= falls back to a substring match outside PostgreSQL."""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("reader"))
+
+    def test_search_matches_comments_and_replies(self):
+        parent = Comment.objects.create(
+            username="a", email="a@example.com", text="Django channels rock"
+        )
+        Comment.objects.create(
+            username="b", email="b@example.com", text="Plain reply", parent=parent
+        )
+        Comment.objects.create(
+            username="c",
+            email="c@example.com",
+            text="Reply about CHANNELS",
+            parent=parent,
+        )
+
+        results = self.client.get("/api/comments/?search=channels").json()["results"]
+        self.assertEqual(
+            sorted(comment["text"] for comment in results),
+            ["Django channels rock", "Reply about CHANNELS"],
+        )
+
+    def test_rank_ordering_only_without_cursor(self):
+        search = CommentSearchFilter()
+
+        def ordering(params, cursor):
+            request = mock.Mock(query_params=params)
+            view = mock.Mock(_use_cursor_pagination=lambda: cursor)
+            with mock.patch("comments.filters.connection") as postgres:
+                postgres.vendor = "postgresql"
+                queryset = search.filter_queryset(request, Comment.objects.all(), view)
+            return queryset.query.order_by
+
+        self.assertEqual(ordering({"search": "x"}, False), ("-rank", "-created_at"))
+        # Keyset pagination re-applies its own ORDER BY, so rank is not used
+        self.assertEqual(ordering({"search": "x"}, True), ())
+        self.assertEqual(ordering({"search": "x", "ordering": "email"}, False), ())
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    COMMENT_WS_REPLAY="local",
+    COMMENT_IMAGE_QUEUE="sync",
+)
+class CommentImagePipelineTest(TestCase):
+    """Image variants are built after commit, outside Comment.save."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_variants_are_built_in_background_stage(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            comment = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="pic",
+                image=make_image((1000, 800)),
+            )
+        self.assertEqual(comment.image_status, Comment.ImageStatus.PENDING)
+        self.assertEqual(Image.open(comment.image.path).size, (1000, 800))
+
+        for callback in callbacks:
+            callback()
+
+        comment.refresh_from_db()
+        self.assertEqual(comment.image_status, Comment.ImageStatus.READY)
+        # The content-addressed original is never rewritten
+        self.assertEqual(Image.open(comment.image.path).size, (1000, 800))
+        with open(comment.image.path, "rb") as original:
+            digest = sha256(original.read()).hexdigest()
+        self.assertEqual(os.path.basename(comment.image.name), f"{digest}.png")
+
+        variants = comment.image_variants
+        self.assertEqual(variants["full"]["width"], 1000)
+        self.assertEqual(variants["320w"]["width"], 300)
+        self.assertEqual(variants["thumb"]["width"], 150)
+        self.assertTrue(variants["thumb"]["webp"].startswith("variants/"))
+        self.assertTrue(variants["thumb"]["jpeg"].endswith(".jpeg"))
+
+    def test_ready_image_is_served_as_display_variant(self):
+        with mock.patch.object(broadcaster, "publish") as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                comment = Comment.objects.create(
+                    username="a",
+                    email="a@example.com",
+                    text="pic",
+                    image=make_image((1000, 800)),
+                )
+        comment.refresh_from_db()
+        display = attachment_storage.url(comment.image_variants["320w"]["jpeg"])
+        self.assertEqual(CommentSerializer(comment).data["image"], display)
+        event = publish.call_args_list[-1].args[1]
+        self.assertEqual(event["event"], "image_ready")
+        self.assertTrue(event["image"].endswith(display))
+
+    def test_identical_variants_share_storage(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="1",
+                image=make_image((800, 600)),
+            )
+            second = Comment.objects.create(
+                username="b",
+                email="b@example.com",
+                text="2",
+                image=make_image((800, 600)),
+            )
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(first.image_variants, second.image_variants)
+
+        srcset = CommentSerializer(second).data["image_srcset"]
+        self.assertRegex(
+            srcset["webp"], r"^/media/variants/.+\.webp 160w, .+ 320w, .+ 800w$"
+        )
+
+    def test_animated_image_gets_animated_thumbnail(self):
+        buffer = BytesIO()
+        frames = [
+            Image.new("RGB", (640, 480), color) for color in ("red", "lime", "blue")
+        ]
+        frames[0].save(buffer, "GIF", save_all=True, append_images=frames[1:])
+        with self.captureOnCommitCallbacks(execute=True):
+            comment = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="gif",
+                image=SimpleUploadedFile("anim.gif", buffer.getvalue()),
+            )
+        comment.refresh_from_db()
+        thumb = comment.image_variants["thumb"]
+        self.assertEqual((thumb["width"], thumb["height"]), (320, 240))
+        with Image.open(attachment_storage.path(thumb["gif"])) as img:
+            self.assertEqual(img.n_frames, 3)
+        self.assertEqual(Image.open(comment.image.path).size, (640, 480))
+        self.assertRegex(
+            CommentSerializer(comment).data["image_srcset"]["gif"], r"\.gif 320w$"
+        )
+
+    def save_source(self, image, name, fmt, **params):
+        path = os.path.join(self.media_root, name)
+        image.save(path, fmt, **params)
+        return path
+
+    def test_jpeg_is_decoded_in_draft_mode(self):
+        decoded = []
+        draft = JpegImagePlugin.JpegImageFile.draft
+
+        def record_draft(img, mode, size):
+            result = draft(img, mode, size)
+            decoded.append(img.size)
+            return result
+
+        with mock.patch.object(
+            JpegImagePlugin.JpegImageFile, "draft", autospec=True
+        ) as spy:
+            spy.side_effect = record_draft
+            path = self.save_source(Image.new("RGB", (3200, 2400)), "a.jpg", "JPEG")
+            variants = images.build_image_variants(path)
+            path = self.save_source(Image.new("RGB", (1280, 960)), "b.jpg", "JPEG")
+            size = images.thumbnail_image(path, BytesIO())
+
+        # DCT scaling decodes at 1/2 and 1/4 instead of the full resolution
+        self.assertEqual(decoded, [(1600, 1200), (320, 240)])
+        self.assertEqual(variants["full"]["width"], 1600)
+        self.assertEqual(size, (320, 240))
+
+    def test_pixel_cap_is_checked_before_decoding(self):
+        path = self.save_source(Image.new("RGB", (400, 300)), "big.png", "PNG")
+        with mock.patch.object(
+            PngImagePlugin.PngImageFile, "load", autospec=True
+        ) as load:
+            with self.assertRaises(ValueError):
+                images.build_image_variants(path, max_pixels=400 * 300 - 1)
+            with self.assertRaises(ValueError):
+                images.thumbnail_image(path, BytesIO(), max_pixels=400 * 300 - 1)
+        load.assert_not_called()
+
+    def test_animated_thumbnail_stops_at_frame_limit(self):
+        frames = [
+            Image.new("RGB", (640, 480), color)
+            for color in ("red", "lime", "blue", "white", "black")
+        ]
+        path = self.save_source(
+            frames[0], "anim.gif", "GIF", save_all=True, append_images=frames[1:]
+        )
+        output = BytesIO()
+        size = images.thumbnail_image(path, output, max_frames=2)
+        self.assertEqual(size, (320, 240))
+        with Image.open(output) as thumb:
+            self.assertEqual(thumb.n_frames, 2)
+
+    def test_duplicate_waits_for_claimed_blob(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            comment = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="pic",
+                image=make_image((800, 600)),
+            )
+        # Another job is building this blob's variants
+        StoredFile.objects.filter(name=comment.image.name).update(
+            processing_since=timezone.now()
+        )
+        variants = {"thumb": {"width": 160, "height": 120}}
+
+        def other_job_finishes(seconds):
+            StoredFile.objects.filter(name=comment.image.name).update(
+                image_variants=variants, processing_since=None
+            )
+
+        with mock.patch.object(
+            images.time, "sleep", side_effect=other_job_finishes
+        ), mock.patch.object(images, "build_image_variants") as build:
+            for callback in callbacks:
+                callback()
+        build.assert_not_called()
+        comment.refresh_from_db()
+        self.assertEqual(comment.image_variants, variants)
+
+    def test_worker_survives_errors_and_acknowledges_jobs(self):
+        class StopWorker(BaseException):
+            pass
+
+        client = mock.Mock()
+        client.lmove.side_effect = [b"7", None]  # Left over by a dead worker
+        client.blmove.side_effect = [
+            ConnectionError("redis down"),
+            b"bogus",
+            b"42",
+            StopWorker,
+        ]
+        with mock.patch.object(
+            images, "get_redis_client", return_value=client
+        ), mock.patch.object(images.time, "sleep") as sleep, mock.patch.object(
+            images, "process_comment_image"
+        ) as process:
+            with self.assertRaises(StopWorker):
+                images.run_image_worker()
+
+        client.lmove.assert_called_with(
+            images.IMAGE_PROCESSING_KEY, images.IMAGE_QUEUE_KEY, "RIGHT", "RIGHT"
+        )
+        sleep.assert_called_once_with(1)
+        process.assert_called_once_with(42)
+        self.assertEqual(
+            client.lrem.call_args_list,
+            [
+                mock.call(images.IMAGE_PROCESSING_KEY, 1, b"bogus"),
+                mock.call(images.IMAGE_PROCESSING_KEY, 1, b"42"),
+            ],
+        )
+
+    @override_settings(COMMENT_IMAGE_QUEUE="local")
+    def test_sweep_resubmits_lost_pending_images(self):
+        # The jobs were never run, as if the process restarted
+        with self.captureOnCommitCallbacks():
+            lost, recent = [
+                Comment.objects.create(
+                    username=name,
+                    email=f"{name}@example.com",
+                    text=name,
+                    image=make_image((800, 600)),
+                )
+                for name in ("lost", "recent")
+            ]
+        Comment.objects.filter(pk=lost.pk).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+
+        call_command("process_images", "--sweep", stdout=StringIO())
+        lost.refresh_from_db()
+        recent.refresh_from_db()
+        self.assertEqual(lost.image_status, Comment.ImageStatus.READY)
+        self.assertEqual(recent.image_status, Comment.ImageStatus.PENDING)
+
+    def test_redelivered_job_does_not_retain_variants_twice(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            comment = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="pic",
+                image=make_image((800, 600)),
+            )
+        comment.refresh_from_db()
+        images.process_comment_image(comment.pk)
+        name = comment.image_variants["thumb"]["webp"]
+        self.assertEqual(StoredFile.objects.get(name=name).ref_count, 1)
+
+    def test_shared_blobs_are_collected_with_last_reference(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            parent = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="1",
+                image=make_image((800, 600)),
+            )
+            Comment.objects.create(
+                username="b",
+                email="b@example.com",
+                text="2",
+                image=make_image((800, 600)),
+                parent=parent,
+            )
+            other = Comment.objects.create(
+                username="c",
+                email="c@example.com",
+                text="3",
+                image=make_image((800, 600)),
+            )
+        parent.refresh_from_db()
+        other.refresh_from_db()
+        names = [parent.image.name, *variant_names(parent.image_variants)]
+        self.assertEqual(StoredFile.objects.get(name=parent.image.name).ref_count, 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            parent.delete()  # CASCADE removes the reply too
+        self.assertEqual(StoredFile.objects.get(name=parent.image.name).ref_count, 1)
+        self.assertTrue(all(attachment_storage.exists(name) for name in names))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertFalse(StoredFile.objects.filter(name__in=names).exists())
+        self.assertFalse(any(attachment_storage.exists(name) for name in names))
+
+    def test_collection_does_not_delete_rereferenced_blob(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            comment = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="pic",
+                image=make_image((800, 600)),
+            )
+        # A release queued collection, but the blob was referenced again
+        collect_garbage([comment.image.name])
+        self.assertTrue(attachment_storage.exists(comment.image.name))
+        self.assertTrue(StoredFile.objects.filter(name=comment.image.name).exists())
+
+    def test_variants_collected_before_retain_are_rebuilt(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Comment.objects.create(
+                username="a",
+                email="a@example.com",
+                text="1",
+                image=make_image((800, 600)),
+            )
+        first.refresh_from_db()
+        names = variant_names(first.image_variants)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            second = Comment.objects.create(
+                username="b",
+                email="b@example.com",
+                text="2",
+                image=make_image((800, 600)),
+            )
+
+        def first_is_deleted(path, name):
+            # The last holder goes away after the shared variants were looked up
+            variants = StoredFile.objects.get(name=name).image_variants
+            with self.captureOnCommitCallbacks(execute=True):
+                first.delete()
+            return variants
+
+        lookups = iter([first_is_deleted])
+        real_lookup = images.get_image_variants
+        with mock.patch.object(
+            images,
+            "get_image_variants",
+            side_effect=lambda path, name: next(lookups, real_lookup)(path, name),
+        ):
+            for callback in callbacks:
+                callback()
+
+        second.refresh_from_db()
+        self.assertEqual(second.image_status, Comment.ImageStatus.READY)
+        self.assertEqual(variant_names(second.image_variants), names)
+        for name in names:
+            self.assertTrue(attachment_storage.exists(name))
+            self.assertEqual(StoredFile.objects.get(name=name).ref_count, 1)
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    COMMENT_WS_REPLAY="local",
+    RATE_LIMIT_BACKEND="local",
+    COMMENT_UPLOAD_LIMITS={"image": 64 * 1024, "file": 1024},
+    COMMENT_MAX_IMAGE_PIXELS=1000 * 1000,
+)
+class CommentUploadHandlerTest(TestCase):
+    """Oversized or disallowed uploads are rejected while streaming."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("writer"))
+
+    def post(self, **files):
+        data = {"username": "a", "email": "a@example.com", "text": "hi", **files}
+        return self.client.post("/api/comments/", data, format="multipart")
+
+    def test_oversized_text_file_is_rejected(self):
+        upload = SimpleUploadedFile("big.txt", b"x" * 2048, "text/plain")
+        self.assertEqual(self.post(file=upload).status_code, 413)
+
+    def test_pixel_bomb_is_rejected_from_header(self):
+        bomb = make_image((2000, 2000))
+        bomb.content_type = "image/png"
+        self.assertEqual(self.post(image=bomb).status_code, 413)
+
+    def test_disallowed_extension_is_rejected(self):
+        upload = SimpleUploadedFile("script.js", b"alert(1)", "text/plain")
+        response = self.post(file=upload)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("file", response.json())
+
+
+class ConsumerTestMixin:
+    """Drive CommentConsumer directly through its ASGI interface."""
+
+    async def connect(self, query=b"", **scope):
+        communicator = ApplicationCommunicator(
+            CommentConsumer.as_asgi(),
+            {
+                "type": "websocket",
+                "path": "/ws/comments/",
+                "query_string": query,
+                **scope,
+            },
+        )
+        await communicator.send_input({"type": "websocket.connect"})
+        self.assertEqual(
+            (await communicator.receive_output())["type"], "websocket.accept"
+        )
+        return communicator
+
+    async def receive_json(self, communicator):
+        return json.loads((await communicator.receive_output())["text"])
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    COMMENT_WS_BATCH_WINDOW=60,
+    COMMENT_WS_SEND_QUEUE_SIZE=2,
+    COMMENT_WS_REPLAY="local",
+    COMMENT_WS_REPLAY_SIZE=2,
+    RATE_LIMIT_BACKEND="local",
+)
+class CommentBroadcastTest(ConsumerTestMixin, TestCase):
+    """Events are serialized once and fanned out in coalesced batches."""
+
+    async def publish(self, *messages):
+        for message in messages:
+            broadcaster.publish([ALL_GROUP], message)
+        await sync_to_async(broadcaster.flush)()
+
+    async def test_batching_client_receives_one_array(self):
+        batching = await self.connect(b"batch=1")
+        legacy = await self.connect()
+
+        await self.publish({"id": 1}, {"id": 2})
+        batch = await self.receive_json(batching)
+        self.assertEqual([event["id"] for event in batch], [1, 2])
+        self.assertEqual(batch[1]["seq"], batch[0]["seq"] + 1)
+        self.assertEqual(await self.receive_json(legacy), batch[0])
+        self.assertEqual(await self.receive_json(legacy), batch[1])
+
+        for communicator in (batching, legacy):
+            await communicator.send_input(
+                {"type": "websocket.disconnect", "code": 1000}
+            )
+            await communicator.wait()
+
+    def test_group_send_carries_each_event_once(self):
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch("comments.broadcast.get_channel_layer", return_value=layer):
+            broadcaster.publish([ALL_GROUP], {"id": 1})
+            broadcaster.flush()
+        group, message = layer.group_send.call_args.args
+        self.assertEqual(group, ALL_GROUP)
+        self.assertEqual(list(message), ["type", "texts"])
+        self.assertEqual(json.loads(message["texts"][0])["id"], 1)
+
+    async def test_topic_subscriptions_filter_events(self):
+        communicator = await self.connect(b"topics=top")
+        await communicator.send_input(
+            {
+                "type": "websocket.receive",
+                "text": json.dumps(
+                    {"action": "subscribe", "topics": ["thread:7", "bogus"]}
+                ),
+            }
+        )
+        self.assertEqual(
+            await self.receive_json(communicator),
+            {"event": "subscribed", "topics": ["thread:7"]},
+        )
+
+        broadcaster.publish(comment_groups(8), {"id": 1, "parent": 8})
+        broadcaster.publish(comment_groups(7), {"id": 2, "parent": 7})
+        broadcaster.publish(comment_groups(None), {"id": 3, "parent": None})
+        await sync_to_async(broadcaster.flush)()
+        self.assertEqual((await self.receive_json(communicator))["id"], 2)
+        self.assertEqual((await self.receive_json(communicator))["id"], 3)
+        self.assertTrue(await communicator.receive_nothing())
+
+    async def test_all_topic_never_delivers_events_twice(self):
+        communicator = await self.connect(b"topics=top,thread:7")
+
+        async def change(action, topics):
+            await communicator.send_input(
+                {
+                    "type": "websocket.receive",
+                    "text": json.dumps({"action": action, "topics": topics}),
+                }
+            )
+            return (await self.receive_json(communicator))["topics"]
+
+        self.assertEqual(await change("subscribe", ["all"]), ["all"])
+        self.assertEqual(await change("subscribe", ["thread:8"]), [])
+
+        broadcaster.publish(comment_groups(None), {"id": 1, "parent": None})
+        broadcaster.publish(comment_groups(7), {"id": 2, "parent": 7})
+        await sync_to_async(broadcaster.flush)()
+        ids = [(await self.receive_json(communicator))["id"] for _ in range(2)]
+        self.assertEqual(sorted(ids), [1, 2])
+        self.assertTrue(await communicator.receive_nothing())
+
+    async def test_empty_event_is_stamped_as_valid_json(self):
+        communicator = await self.connect()
+        await self.publish({})
+        event = await self.receive_json(communicator)
+        self.assertEqual(list(event), ["seq"])
+
+    async def test_reconnecting_client_replays_missed_events(self):
+        communicator = await self.connect()
+        await self.publish({"id": 1})
+        last_seq = (await self.receive_json(communicator))["seq"]
+        await self.publish({"id": 2}, {"id": 3})
+
+        resumed = await self.connect(f"last_seq={last_seq}".encode())
+        self.assertEqual((await self.receive_json(resumed))["id"], 2)
+        self.assertEqual((await self.receive_json(resumed))["id"], 3)
+        self.assertTrue(await resumed.receive_nothing())
+
+        expired = await self.connect(f"last_seq={last_seq - 1}".encode())
+        self.assertEqual(await self.receive_json(expired), {"event": "resync"})
+
+    def test_comments_are_broadcast_only_after_commit(self):
+        with mock.patch.object(broadcaster, "publish") as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError):
+                    with transaction.atomic():
+                        Comment.objects.create(
+                            username="a", email="a@example.com", text="x"
+                        )
+                        raise RuntimeError  # Roll back
+            publish.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                comment = Comment.objects.create(
+                    username="b", email="b@example.com", text="y"
+                )
+        groups, message = publish.call_args.args
+        self.assertEqual(groups, comment_groups(None))
+        self.assertEqual(message["id"], comment.id)
+
+    async def test_slow_client_is_disconnected(self):
+        communicator = await self.connect()
+        await self.publish({"id": 1}, {"id": 2}, {"id": 3})
+        output = await communicator.receive_output()
+        while output["type"] != "websocket.close":
+            output = await communicator.receive_output()
+        self.assertEqual(output["code"], 1013)
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    COMMENT_WS_REPLAY="local",
+    COMMENT_WS_MAX_MESSAGE_BYTES=256,
+    COMMENT_WS_RATE_LIMITS={"connection": (0.01, 3), "user": (0.01, 3)},
+    RATE_LIMIT_BACKEND="local",
+)
+class CommentConsumerReceiveTest(ConsumerTestMixin, TestCase):
+    """Client frames are size-capped, rate limited and schema-checked."""
+
+    def setUp(self):
+        LocalTokenBucket._buckets.clear()
+
+    async def send_text(self, communicator, message):
+        text = message if isinstance(message, str) else json.dumps(message)
+        await communicator.send_input({"type": "websocket.receive", "text": text})
+
+    async def receive_close_code(self, communicator):
+        output = await communicator.receive_output()
+        self.assertEqual(output["type"], "websocket.close")
+        return output["code"]
+
+    async def test_oversized_frame_closes_connection(self):
+        communicator = await self.connect()
+        await self.send_text(communicator, "x" * 300)
+        self.assertEqual(await self.receive_close_code(communicator), 1009)
+
+    async def test_flooding_client_is_closed(self):
+        communicator = await self.connect()
+        for _ in range(3):
+            await self.send_text(communicator, {"action": "subscribe", "topics": []})
+            await self.receive_json(communicator)
+        await self.send_text(communicator, {"action": "subscribe", "topics": []})
+        self.assertEqual(await self.receive_close_code(communicator), 1008)
+
+    async def test_client_broadcast_is_disabled_by_default(self):
+        communicator = await self.connect()
+        await self.send_text(communicator, {"id": 1, "text": "spam"})
+        self.assertEqual(
+            await self.receive_json(communicator),
+            {"error": "Client broadcast is disabled"},
+        )
+
+    async def test_anonymous_sockets_share_client_limit(self):
+        client = {"client": ["203.0.113.5", 50000]}
+        first = await self.connect(**client)
+        second = await self.connect(**client)
+        for communicator in (first, second, first):
+            await self.send_text(communicator, {"action": "subscribe", "topics": []})
+            await self.receive_json(communicator)
+        # Fresh connection bucket, but the address has used its 3 tokens
+        await self.send_text(second, {"action": "subscribe", "topics": []})
+        self.assertEqual(await self.receive_close_code(second), 1008)
+
+        other = await self.connect(client=["203.0.113.6", 50000])
+        await self.send_text(other, {"action": "subscribe", "topics": []})
+        await self.receive_json(other)
+
+    async def test_access_token_cookie_authenticates_socket(self):
+        user = await User.objects.acreate(username="writer")
+        token = await sync_to_async(AccessToken.for_user)(user)
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+
+        middleware = CookieMiddleware(JWTCookieWebSocketMiddleware(app))
+        for cookie in (f"access_token={token}", "access_token=forged"):
+            await middleware(
+                {
+                    "type": "websocket",
+                    "headers": [(b"cookie", cookie.encode())],
+                    "user": AnonymousUser(),
+                },
+                None,
+                None,
+            )
+        self.assertEqual(scopes[0]["user"].pk, user.pk)
+        self.assertFalse(scopes[1]["user"].is_authenticated)
+
+    @override_settings(COMMENT_WS_CLIENT_BROADCAST=True)
+    async def test_client_broadcast_requires_user_and_schema(self):
+        anonymous = await self.connect()
+        await self.send_text(anonymous, {"id": 1, "text": "hi"})
+        self.assertEqual(
+            await self.receive_json(anonymous), {"error": "Authentication required"}
+        )
+
+        user = await User.objects.acreate(username="writer")
+        communicator = await self.connect(user=user)
+        await self.send_text(communicator, {"id": 1, "event": "image_ready"})
+        self.assertEqual(
+            await self.receive_json(communicator),
+            {"error": "Unknown field: event"},
+        )
+        await self.send_text(communicator, {"action": "broadcast"})
+        self.assertEqual(
+            await self.receive_json(communicator), {"error": "Missing field: id"}
+        )
+        comment = {
+            "id": 1,
+            "username": "writer",
+            "email": "writer@example.com",
+            "text": "hi",
+            "created_at": "2024-01-01T00:00:00Z",
+        }
+        with mock.patch.object(broadcaster, "publish") as publish:
+            await self.send_text(communicator, comment)
+            self.assertTrue(await communicator.receive_nothing())
+        publish.assert_called_once_with(comment_groups(None), comment)
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    COMMENT_WS_REPLAY="local",
+    COMMENT_CAPTCHA_BACKEND="local",
+    COMMENT_CAPTCHA_POOL="local",
+    COMMENT_CAPTCHA_POOL_SIZE=5,
+    COMMENT_CAPTCHA_POOL_MIN=0,
+    RATE_LIMIT_BACKEND="local",
+)
+class CaptchaPoolTest(TestCase):
+    """get_captcha hands out pre-rendered CAPTCHAs without touching the DB."""
+
+    def setUp(self):
+        cache.clear()
+        _local_pool.clear()
+        _recent_takes.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("pooled"))
+
+    def post_comment(self, key, answer):
+        return self.client.post(
+            "/api/comments/",
+            {
+                "username": "pooled",
+                "email": "pooled@example.com",
+                "text": "hello",
+                "captcha_key": key,
+                "captcha_text": answer,
+            },
+            format="json",
+        )
+
+    def test_pooled_captcha_round_trip(self):
+        self.assertEqual(refill_pool(), 5)
+        self.assertEqual(refill_pool(), 0)
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/captcha/")
+        self.assertEqual(response.status_code, 200)
+        key = response.json()["key"]
+        self.assertEqual(len(_local_pool), 4)
+
+        image = self.client.get(response.json()["image"])
+        self.assertEqual(image["Content-Type"], "image/png")
+        self.assertEqual(Image.open(BytesIO(image.content)).format, "PNG")
+
+        answer = _local_captchas[key][0]
+        self.assertEqual(self.post_comment(key, answer.lower()).status_code, 201)
+        self.assertFalse(CaptchaStore.objects.exists())
+
+        # Consumed along with its image
+        self.assertEqual(self.post_comment(key, answer).status_code, 400)
+        self.assertEqual(self.client.get(f"/captcha/image/{key}/").status_code, 410)
+
+    def test_wrong_answer_consumes_captcha(self):
+        [(key, answer)] = make_captchas(1)
+        response = self.post_comment(key, "wrong")
+        self.assertIn("captcha_text", response.json())
+        self.assertIn("captcha_key", self.post_comment(key, answer).json())
+
+    def test_stale_pool_is_dropped_in_one_take(self):
+        refill_pool()
+        for index, entry in enumerate(_local_pool):
+            _local_pool[index] = f"{entry.split(':')[0]}:0"
+        stale = {entry.split(":")[0] for entry in _local_pool}
+        with mock.patch("comments.captchas.threading.Thread"):
+            self.assertNotIn(take_captcha(), stale)
+        self.assertEqual(len(_local_pool), 0)
+
+    def test_refill_prunes_stale_entries(self):
+        _local_pool.extend(["old1:0", "old2:0"])
+        self.assertEqual(refill_pool(target=3), 3)
+        self.assertFalse(any(entry.startswith("old") for entry in _local_pool))
+
+    def test_local_refill_is_sized_to_demand(self):
+        with mock.patch("comments.captchas.threading.Thread") as thread:
+            take_captcha()
+            take_captcha()
+        # Two CAPTCHAs handed out recently: refill to twice that
+        self.assertEqual(thread.call_args.kwargs["args"][1], 4)
+
+    def test_empty_pool_generates_inline(self):
+        key = take_captcha()
+        self.assertEqual(self.client.get(f"/captcha/image/{key}/").status_code, 200)
+        self.assertEqual(self.client.get("/captcha/image/missing/").status_code, 410)
+
+    @override_settings(COMMENT_CAPTCHA_BACKEND="db")
+    def test_database_backend_consumes_once(self):
+        [(key, answer)] = make_captchas(1)
+        self.assertEqual(CaptchaStore.objects.get(hashkey=key).response, answer.lower())
+        self.assertEqual(consume_captcha(key), answer.lower())
+        self.assertIsNone(consume_captcha(key))
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+    COMMENT_WS_REPLAY="local",
+    COMMENT_CAPTCHA_BACKEND="local",
+    RATE_LIMIT_BACKEND="local",
+    RATE_LIMITS={"comments": (2, 60), "captcha": (10, 60)},
+)
+class CommentRateLimitTest(TestCase):
+    """Comment POSTs are rate limited per user and report their quota."""
+
+    def setUp(self):
+        SlidingWindowLimiter._local_state.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("limited"))
+
+    def post_comment(self):
+        [(key, answer)] = make_captchas(1)
+        data = {
+            "username": "limited",
+            "email": "limited@example.com",
+            "text": "hello",
+            "captcha_key": key,
+            "captcha_text": answer,
+        }
+        return self.client.post("/api/comments/", data, format="json")
+
+    def test_comment_posts_are_limited(self):
+        first = self.post_comment()
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first["X-RateLimit-Limit"], "2")
+        self.assertEqual(first["X-RateLimit-Remaining"], "1")
+        self.assertEqual(self.post_comment().status_code, 201)
+
+        throttled = self.post_comment()
+        self.assertEqual(throttled.status_code, 429)
+        self.assertEqual(throttled["X-RateLimit-Remaining"], "0")
+        self.assertGreaterEqual(int(throttled["Retry-After"]), 1)
+        self.assertEqual(Comment.objects.count(), 2)
+
+        # Reading is not limited
+        self.assertEqual(self.client.get("/api/comments/").status_code, 200)
+
+
+class BenchmarkBaselineTest(TestCase):
+    """benchmark_api flags slower, lower-throughput or chattier scenarios."""
+
+    def test_find_regressions(self):
+        baseline = {
+            "list": {"p95_ms": 10.0, "requests_per_second": 100.0, "queries_max": 3},
+            "login": {"p95_ms": 400.0, "requests_per_second": 2.0, "queries_max": 2},
+        }
+        results = {
+            "list": {"p95_ms": 11.0, "requests_per_second": 95.0, "queries_max": 4},
+            "login": {"p95_ms": 600.0, "requests_per_second": 1.5, "queries_max": 2},
+            "new": {"p95_ms": 1.0, "requests_per_second": 1.0, "queries_max": 9},
+        }
+        regressions = find_regressions(results, baseline, tolerance=0.2)
+        self.assertEqual(len(regressions), 3)
+        self.assertTrue(regressions[0].startswith("list: 4 queries"))
+        self.assertTrue(all(r.startswith("login") for r in regressions[1:]))
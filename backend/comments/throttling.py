@@ -0,0 +1,107 @@
+import threading
+import time
+from django.conf import settings
+from comment_app.redis_client import get_redis_client
+
+# Refill, take one token and store the bucket in one atomic step. The Redis
+# clock is used so every worker sees the same time.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return allowed
+"""
+
+
+class TokenBucket:
+    """
+    In-process token bucket for state owned by a single worker.
+
+    Args:
+        rate (float): Tokens added per second
+        capacity (int): Maximum burst
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self):
+        """Take one token; return False if the bucket is empty."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RedisTokenBucket:
+    """
+    Token bucket shared by every worker, keyed e.g. by user.
+
+    Args:
+        rate (float): Tokens added per second
+        capacity (int): Maximum burst
+        prefix (str): Redis key prefix
+    """
+
+    def __init__(self, rate, capacity, prefix):
+        self.rate = rate
+        self.capacity = capacity
+        self.prefix = prefix
+        self._script = None
+
+    def consume(self, key):
+        """Take one token from ``key``'s bucket; return False if it is empty."""
+        if self._script is None:
+            self._script = get_redis_client().register_script(TOKEN_BUCKET_SCRIPT)
+        return bool(
+            self._script(keys=[f"{self.prefix}:{key}"], args=[self.rate, self.capacity])
+        )
+
+
+class LocalTokenBucket:
+    """
+    Per-process stand-in for RedisTokenBucket (``RATE_LIMIT_BACKEND``
+    "local"), for development and tests.
+    """
+
+    _buckets = {}
+    _lock = threading.Lock()
+
+    def __init__(self, rate, capacity, prefix):
+        self.rate = rate
+        self.capacity = capacity
+        self.prefix = prefix
+
+    def consume(self, key):
+        """Take one token from ``key``'s bucket; return False if it is empty."""
+        with self._lock:
+            bucket = self._buckets.get(f"{self.prefix}:{key}")
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self._buckets[f"{self.prefix}:{key}"] = bucket
+            return bucket.consume()
+
+
+def shared_token_bucket(rate, capacity, prefix):
+    """Return the keyed token bucket for the configured ``RATE_LIMIT_BACKEND``."""
+    if settings.RATE_LIMIT_BACKEND == "redis":
+        return RedisTokenBucket(rate, capacity, prefix)
+    return LocalTokenBucket(rate, capacity, prefix)
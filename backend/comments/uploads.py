@@ -0,0 +1,107 @@
+import os
+from io import BytesIO
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+from PIL import Image, UnidentifiedImageError
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+ALLOWED_UPLOADS = {
+    "image": {
+        "extensions": {"jpg", "jpeg", "png", "gif"},
+        "content_types": {"image/jpeg", "image/png", "image/gif"},
+        "formats": {"JPEG", "PNG", "GIF"},
+    },
+    "file": {
+        "extensions": {"txt"},
+        "content_types": {"text/plain"},
+    },
+}
+DEFAULT_UPLOAD_LIMITS = {"image": 5 * 1024 * 1024, "file": 100 * 1024}
+IMAGE_HEADER_MAX = 256 * 1024  # Enough for PIL to read any sane header
+FORM_FIELDS_SLACK = 64 * 1024
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Uploaded file is too large."
+    default_code = "upload_too_large"
+
+
+class CommentUploadHandler(FileUploadHandler):
+    """
+    Validate comment attachments while the request body streams in.
+
+    Runs before Django's memory/temporary-file handlers and aborts with 413
+    as soon as a field exceeds its byte limit or an image header declares
+    more than ``COMMENT_MAX_IMAGE_PIXELS`` pixels, so oversized uploads are
+    never fully buffered or spooled to disk.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.limits = getattr(settings, "COMMENT_UPLOAD_LIMITS", DEFAULT_UPLOAD_LIMITS)
+        self.max_pixels = getattr(settings, "COMMENT_MAX_IMAGE_PIXELS", 4096 * 4096)
+
+    def handle_raw_input(
+        self, input_data, META, content_length, boundary, encoding=None
+    ):
+        # Reject before reading a byte if the body cannot possibly fit
+        if content_length > sum(self.limits.values()) + FORM_FIELDS_SLACK:
+            raise UploadTooLarge()
+
+    def new_file(self, field_name, file_name, content_type, *args, **kwargs):
+        super().new_file(field_name, file_name, content_type, *args, **kwargs)
+        rules = ALLOWED_UPLOADS.get(field_name)
+        if rules is None:
+            raise ValidationError({field_name: "Unexpected file field"})
+
+        extension = os.path.splitext(file_name)[1].lower().lstrip(".")
+        if extension not in rules["extensions"]:
+            raise ValidationError(
+                {field_name: f"File extension '{extension}' is not allowed"}
+            )
+        if content_type not in rules["content_types"]:
+            raise ValidationError(
+                {field_name: f"Content type '{content_type}' is not allowed"}
+            )
+
+        self.received = 0
+        self.header = b"" if field_name == "image" else None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.limits[self.field_name]:
+            raise UploadTooLarge(
+                f"{self.field_name} exceeds {self.limits[self.field_name]} bytes"
+            )
+
+        if self.header is not None:
+            self.header += raw_data
+            self.check_image_header(final=False)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if self.header is not None:
+            self.check_image_header(final=True)
+        return None  # Let the next handler build the uploaded file
+
+    def check_image_header(self, final):
+        """Sniff the real format and pixel count from the image header."""
+        try:
+            with Image.open(BytesIO(self.header)) as img:
+                image_format, (width, height) = img.format, img.size
+        except Image.DecompressionBombError:
+            raise UploadTooLarge("Image has too many pixels")
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            if final or len(self.header) >= IMAGE_HEADER_MAX:
+                raise ValidationError({"image": "Upload a valid image"})
+            return  # Header not complete yet
+
+        self.header = None
+        if image_format not in ALLOWED_UPLOADS["image"]["formats"]:
+            raise ValidationError({"image": f"Image format {image_format} not allowed"})
+        if width * height > self.max_pixels:
+            raise UploadTooLarge(
+                f"Image has {width * height} pixels, maximum is {self.max_pixels}"
+            )
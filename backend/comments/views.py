@@ -1,28 +1,55 @@
+import gzip
+import re
 from hashlib import md5
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.decorators import api_view
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.decorators import action, api_view, throttle_classes
 from rest_framework import status
-from django.core.cache import cache
+from rest_framework.exceptions import APIException
+from comment_app.ratelimit import CaptchaRateThrottle, CommentCreateRateThrottle
+from users.authentication import (
+    CachedJWTAuthentication,
+    StatelessReadJWTAuthentication,
+)
+from .captchas import get_captcha_image, take_captcha
+from .caching import (
+    LIST_CACHE_PREFIX,
+    acquire_rebuild_lock,
+    get_cache_stats,
+    get_cached_page,
+    is_fresh,
+    release_rebuild_lock,
+    render_page,
+    set_cached_page,
+    wait_for_page,
+)
+from .filters import CommentSearchFilter
 from .models import Comment
+from .pagination import CommentKeysetPagination
+from .replies import load_replies
 from .serializers import CommentSerializer
-from captcha.models import CaptchaStore
-from captcha.helpers import captcha_image_url
+from .uploads import CommentUploadHandler
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import OrderingFilter
 import logging
-from django.utils.timezone import now
 
 # Get a logger instance for this module
 logger = logging.getLogger(__name__)
 
+accepts_gzip_re = re.compile(r"\bgzip\b")
+
 
 @api_view(["GET"])
+@throttle_classes([CaptchaRateThrottle])
 def get_captcha(request):
     """
-    Generate a new CAPTCHA and return its key and image URL.
+    Hand out a pre-generated CAPTCHA and return its key and image URL.
 
     Returns:
         Response object containing:
@@ -30,53 +57,112 @@ def get_captcha(request):
         - image: URL to the CAPTCHA image
     """
     try:
-        # Clean up expired captchas
-        CaptchaStore.remove_expired()
-
-        # Generate new CAPTCHA
-        captcha_key = CaptchaStore.generate_key()
-
-        # Get the image URL
-        captcha_image = captcha_image_url(captcha_key)
-
-        # Rate limiting check
-        client_ip = request.META.get(
-            "HTTP_X_FORWARDED_FOR", request.META.get("REMOTE_ADDR")
-        )
-        cache_key = f"captcha_rate_limit_{client_ip}"
-        request_count = cache.get(cache_key, 0)
-
-        if request_count > 10:  # Max 10 requests per minute
-            return Response(
-                {"error": "Too many CAPTCHA requests. Please try again later."},
-                status=status.HTTP_429_TOO_MANY_REQUESTS,
-            )
-
-        # Update rate limiting counter
-        cache.set(cache_key, request_count + 1, 60)  # 60 seconds expiry
+        # Pre-rendered CAPTCHA from the pool
+        captcha_key = take_captcha()
+        captcha_image = reverse("captcha-image", args=[captcha_key])
 
         return Response(
             {"key": captcha_key, "image": captcha_image}, status=status.HTTP_200_OK
         )
 
     except Exception as e:
+        logger.error(f"Error generating CAPTCHA: {str(e)}")
         return Response(
             {"error": "Failed to generate CAPTCHA"},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
 
 
+def captcha_image(request, key):
+    """
+    Serve the pre-rendered PNG of a CAPTCHA from the CAPTCHA backend.
+
+    Returns:
+        The image, or 410 Gone once it has expired
+    """
+    image = get_captcha_image(key)
+    if image is None:
+        return HttpResponse(status=410)
+    response = HttpResponse(image, content_type="image/png")
+    response["Cache-Control"] = "private, no-store"
+    return response
+
+
 class CommentViewSet(ModelViewSet):
+    # Listing and reading comments trust the token claims; every other action
+    # (writes, admin endpoints) loads the (cached) user
+    authentication_classes = [CachedJWTAuthentication]
+    read_authentication_classes = [StatelessReadJWTAuthentication]
+    read_actions = ("list", "retrieve")
     permission_classes = [IsAuthenticated]
-    queryset = Comment.objects.filter(parent__isnull=True).prefetch_related("replies")
+    throttle_classes = [CommentCreateRateThrottle]
+    queryset = Comment.objects.filter(parent__isnull=True)
     serializer_class = CommentSerializer
-    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, OrderingFilter, CommentSearchFilter]
     ordering_fields = ["username", "email", "created_at"]
     ordering = ["-created_at"]
     filterset_fields = ["username", "email"]
+    cursor_pagination_class = CommentKeysetPagination
 
+    REPLIES_LIMIT = getattr(settings, "COMMENT_REPLIES_LIMIT", None)
     CACHE_TIMEOUT = getattr(settings, "COMMENT_CACHE_TIMEOUT", 300)
-    CACHE_KEY_PREFIX = "comment_list"
+    CACHE_STALE_TIMEOUT = getattr(settings, "COMMENT_CACHE_STALE_TIMEOUT", 300)
+    CACHE_LOCK_TIMEOUT = getattr(settings, "COMMENT_CACHE_LOCK_TIMEOUT", 10)
+    CACHE_LOCK_WAIT = getattr(settings, "COMMENT_CACHE_LOCK_WAIT", 0.2)
+    CACHE_COMPRESS = getattr(settings, "COMMENT_CACHE_COMPRESS", True)
+    CACHE_KEY_PREFIX = LIST_CACHE_PREFIX
+
+    def initialize_request(self, request, *args, **kwargs):
+        """Validate attachments while they stream in, before buffering."""
+        if request.method in ("POST", "PUT", "PATCH"):
+            request.upload_handlers.insert(0, CommentUploadHandler(request))
+        return super().initialize_request(request, *args, **kwargs)
+
+    def get_authenticators(self):
+        # Runs before self.action is set, so resolve it from the method
+        action = self.action_map.get(self.request.method.lower())
+        if action in self.read_actions:
+            return [auth() for auth in self.read_authentication_classes]
+        return super().get_authenticators()
+
+    def get_queryset(self):
+        """Searches match replies as well as top-level comments."""
+        if self.action == "list" and self.request.query_params.get("search"):
+            queryset = Comment.objects.all()
+        else:
+            queryset = super().get_queryset()
+        # The tsvector is only used in SQL by the search filter
+        return queryset.defer("search_vector")
+
+    def _use_cursor_pagination(self):
+        """Keyset pagination is opt-in via ?pagination=cursor or a cursor."""
+        params = self.request.query_params
+        return params.get("pagination") == "cursor" or "cursor" in params
+
+    @property
+    def paginator(self):
+        """Swap in keyset pagination when the client asks for it."""
+        if not hasattr(self, "_paginator") and self._use_cursor_pagination():
+            self._paginator = self.cursor_pagination_class()
+        return super().paginator
+
+    def get_replies_limit(self):
+        """Per-thread reply cap from ?replies_limit=N, else the setting."""
+        try:
+            limit = int(self.request.query_params["replies_limit"])
+            return limit if limit >= 0 else self.REPLIES_LIMIT
+        except (KeyError, ValueError):
+            return self.REPLIES_LIMIT
+
+    def get_serializer(self, *args, **kwargs):
+        """Preload replies for every comment being read in one query."""
+        if args and self.action in ("list", "retrieve"):
+            parents = args[0] if kwargs.get("many") else [args[0]]
+            context = kwargs.setdefault("context", self.get_serializer_context())
+            context["reply_batch"] = load_replies(
+                parents, limit=self.get_replies_limit()
+            )
+        return super().get_serializer(*args, **kwargs)
 
     def _generate_cache_key(self, request):
         """Generate a deterministic cache key based on request parameters"""
@@ -112,8 +198,44 @@ class CommentViewSet(ModelViewSet):
             )
             raise
 
+    def _cached_response(self, request, entry, cache_status):
+        """
+        Build a response straight from cached JSON bytes.
+
+        Answers ``If-None-Match`` with 304 and only decompresses the body for
+        clients that do not accept gzip. The two encodings are different
+        bytes, so the gzip one gets its own strong ETag (``"<hash>-gz"``).
+        """
+        accepts_gzip = accepts_gzip_re.search(
+            request.META.get("HTTP_ACCEPT_ENCODING", "")
+        )
+        send_gzip = entry["gzip"] and accepts_gzip
+        etag = f'{entry["etag"][:-1]}-gz"' if send_gzip else entry["etag"]
+
+        etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+        if etag in etags or "*" in etags:
+            response = HttpResponseNotModified()
+        else:
+            body = entry["body"]
+            response = HttpResponse(content_type="application/json")
+            if send_gzip:
+                response["Content-Encoding"] = "gzip"
+            elif entry["gzip"]:
+                body = gzip.decompress(body)
+            response.content = body
+
+        response["ETag"] = etag
+        response["X-Cache"] = cache_status
+        patch_vary_headers(response, ["Accept-Encoding"])
+        return response
+
+    @action(detail=False, methods=["get"], permission_classes=[IsAdminUser])
+    def cache_stats(self, request):
+        """Hit/miss counters per cache tier for the worker serving this."""
+        return Response(get_cache_stats())
+
     def list(self, request, *args, **kwargs):
-        start_time = now()
+        # Timing, query and cache counts are reported by PerformanceMiddleware
         request_id = id(request)  # Unique identifier for this request
 
         logger.info(
@@ -122,13 +244,44 @@ class CommentViewSet(ModelViewSet):
             request.query_params,
         )
 
+        if request.accepted_renderer.format != "json":
+            # Only JSON is cached as bytes; e.g. the browsable API is not
+            return super().list(request, *args, **kwargs)
+
         try:
             cache_key = self._generate_cache_key(request)
-            cached_data = cache.get(cache_key)
+            entry, generation = get_cached_page(cache_key)
 
-            if cached_data:
+            if is_fresh(entry, generation):
                 logger.info("Cache hit [ID:%s] for key: %s", request_id, cache_key)
-                return Response(cached_data)
+                return self._cached_response(request, entry, "HIT")
+
+            lock = acquire_rebuild_lock(cache_key, self.CACHE_LOCK_TIMEOUT)
+            if not lock:
+                # Another worker is rebuilding this page: serve the stale copy
+                if entry is not None:
+                    logger.info(
+                        "Serving stale cache [ID:%s] for key: %s",
+                        request_id,
+                        cache_key,
+                    )
+                    return self._cached_response(request, entry, "STALE")
+
+                # Cold key: give the rebuild a moment, then build the page
+                # ourselves without storing it rather than fail the read
+                entry = wait_for_page(cache_key, generation, self.CACHE_LOCK_WAIT)
+                if entry is not None:
+                    return self._cached_response(request, entry, "HIT")
+
+                logger.warning(
+                    "Cache rebuild in progress [ID:%s] for key: %s, "
+                    "serving uncached",
+                    request_id,
+                    cache_key,
+                )
+                response = super().list(request, *args, **kwargs)
+                response["X-Cache"] = "BYPASS"
+                return response
 
             logger.debug(
                 "Cache miss [ID:%s] for key: %s. Fetching from database",
@@ -136,27 +289,32 @@ class CommentViewSet(ModelViewSet):
                 cache_key,
             )
 
-            response = super().list(request, *args, **kwargs)
-
-            if response.status_code == 200:
-                logger.debug(
-                    "Caching response [ID:%s] with key: %s for %s seconds",
-                    request_id,
-                    cache_key,
-                    self.CACHE_TIMEOUT,
-                )
-                cache.set(cache_key, response.data, timeout=self.CACHE_TIMEOUT)
-
-            processing_time = (now() - start_time).total_seconds()
-            logger.info(
-                "Request completed [ID:%s]. Status: %s. Processing time: %.3f seconds",
-                request_id,
-                response.status_code,
-                processing_time,
-            )
+            try:
+                response = super().list(request, *args, **kwargs)
+
+                if response.status_code == 200:
+                    logger.debug(
+                        "Caching response [ID:%s] with key: %s for %s seconds",
+                        request_id,
+                        cache_key,
+                        self.CACHE_TIMEOUT,
+                    )
+                    entry = set_cached_page(
+                        cache_key,
+                        render_page(response.data, compress=self.CACHE_COMPRESS),
+                        generation,
+                        self.CACHE_TIMEOUT,
+                        self.CACHE_STALE_TIMEOUT,
+                    )
+                    response = self._cached_response(request, entry, "MISS")
+            finally:
+                release_rebuild_lock(cache_key, lock)
 
             return response
 
+        except APIException:
+            # Client errors (e.g. an invalid cursor) are not cache failures
+            raise
         except Exception as e:
             logger.error(
                 "Error processing list request [ID:%s]: %s",
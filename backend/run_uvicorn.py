@@ -13,6 +13,9 @@ subprocess.run(
         "8000",
         "--workers",
         "4",
+        # Reject oversized WebSocket frames before they are buffered
+        "--ws-max-size",
+        "65536",
         "--reload",
     ],
 )
@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import router
+from django.utils.translation import gettext_lazy as _
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_PREFIX = "auth:userfields:"
+
+# Only what authentication, permissions and the auth check read is cached;
+# the password hash is added just when tokens are revoked by it
+CACHED_USER_FIELDS = (
+    "id",
+    "username",
+    "email",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+)
+
+_local_users = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def cached_user_fields():
+    fields = [api_settings.USER_ID_FIELD, *CACHED_USER_FIELDS]
+    if api_settings.CHECK_REVOKE_TOKEN:
+        fields.append("password")
+    return list(dict.fromkeys(fields))
+
+
+def build_user(values):
+    """
+    Turn cached field values into a user; other fields load lazily on access
+    and ``save()`` only writes the cached ones.
+    """
+    model = get_user_model()
+    # from_db() expects the values in model field order
+    names = [f.attname for f in model._meta.concrete_fields if f.attname in values]
+    return model.from_db(
+        router.db_for_read(model), names, [values[name] for name in names]
+    )
+
+
+def get_cached_user(user_id):
+    """
+    Load a user by ``USER_ID_FIELD`` through the per-process and shared caches.
+
+    Args:
+        user_id: Value of the token's user id claim
+
+    Returns:
+        A fresh user instance with the cached fields loaded, or None if there
+        is no such user
+    """
+    now = time.monotonic()
+    with _local_lock:
+        entry = _local_users.get(user_id)
+        if entry is not None and entry[1] > now:
+            _local_users.move_to_end(user_id)
+            return build_user(entry[0])
+
+    key = f"{USER_CACHE_PREFIX}{user_id}"
+    try:
+        values = cache.get(key)
+    except Exception as e:
+        logger.error(f"Error reading cached user {user_id}: {str(e)}")
+        values = None
+    if values is None:
+        values = (
+            get_user_model()
+            .objects.filter(**{api_settings.USER_ID_FIELD: user_id})
+            .values(*cached_user_fields())
+            .first()
+        )
+        if values is None:
+            return None
+        try:
+            cache.set(key, values, settings.AUTH_USER_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Error caching user {user_id}: {str(e)}")
+
+    with _local_lock:
+        _local_users[user_id] = (values, now + settings.AUTH_USER_CACHE_LOCAL_TTL)
+        _local_users.move_to_end(user_id)
+        while len(_local_users) > settings.AUTH_USER_CACHE_LOCAL_SIZE:
+            _local_users.popitem(last=False)
+    return build_user(values)
+
+
+def invalidate_cached_user(user_id):
+    """
+    Drop a user from the shared cache and this process's copy.
+
+    Other processes may keep theirs for up to ``AUTH_USER_CACHE_LOCAL_TTL``.
+    """
+    with _local_lock:
+        _local_users.pop(user_id, None)
+    try:
+        cache.delete(f"{USER_CACHE_PREFIX}{user_id}")
+    except Exception as e:
+        logger.error(f"Error invalidating cached user {user_id}: {str(e)}")
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    SimpleJWT authentication that resolves users through ``get_cached_user``
+    instead of querying the database on every request.
+
+    The active and revoked-token checks still run against the cached user.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        user = get_cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(
+                api_settings.REVOKE_TOKEN_CLAIM
+            ) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
+
+        return user
+
+
+def get_token_user(raw_token):
+    """
+    Resolve an access token to its (cached) user.
+
+    Returns:
+        The user, or None if the token is invalid or the user inactive
+    """
+    authentication = CachedJWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+class StatelessReadJWTAuthentication(CachedJWTAuthentication):
+    """
+    Trust the signed token claims for safe (read-only) methods.
+
+    Reads get a ``TokenUser`` carrying only the claims, with no user lookup;
+    a user deactivated meanwhile can read until the access token expires.
+    Writes resolve the full user like ``CachedJWTAuthentication``.
+    """
+
+    def authenticate(self, request):
+        self.stateless = request.method in SAFE_METHODS
+        return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        if not self.stateless:
+            return super().get_user(validated_token)
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        return api_settings.TOKEN_USER_CLASS(validated_token)
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+class HashingBusy(Exception):
+    """Raised when the password hashing queue is full."""
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.AUTH_HASH_WORKERS,
+            thread_name_prefix="password-hashing",
+        )
+    return _executor
+
+
+def _run_in_worker(func, args, kwargs):
+    """Run a job in a hashing thread, releasing stale DB connections."""
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_hashing(func, *args, **kwargs):
+    """
+    Run a password-hashing call (authenticate, create_user...) off the event
+    loop in a dedicated pool of ``AUTH_HASH_WORKERS`` threads.
+
+    PBKDF2 releases the GIL, so the threads hash in parallel without taking
+    the threads that serve sync views. At most ``AUTH_HASH_QUEUE_SIZE`` calls
+    may wait for a worker; beyond that the call is refused immediately so
+    the caller can shed load. With no workers the call runs inline (tests).
+
+    Raises:
+        HashingBusy: If every worker is busy and the queue is full.
+    """
+    global _pending
+    with _pending_lock:
+        if _pending >= settings.AUTH_HASH_WORKERS + settings.AUTH_HASH_QUEUE_SIZE:
+            logger.warning("Password hashing queue full, shedding request")
+            raise HashingBusy()
+        _pending += 1
+    try:
+        if not settings.AUTH_HASH_WORKERS:
+            return await sync_to_async(func)(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _get_executor(), _run_in_worker, func, args, kwargs
+        )
+    finally:
+        with _pending_lock:
+            _pending -= 1
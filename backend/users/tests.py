@@ -1,3 +1,190 @@
-from django.test import TestCase
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from comment_app.ratelimit import SlidingWindowLimiter, get_client_ip
+from .authentication import USER_CACHE_PREFIX, _local_users
 
-# Create your tests here.
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    RATE_LIMIT_BACKEND="local",
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    AUTH_HASH_WORKERS=0,
+)
+class LoginRateLimitTest(TestCase):
+    """Failed logins are limited per client address."""
+
+    def setUp(self):
+        SlidingWindowLimiter._local_state.clear()
+        User.objects.create_user("reader", password="correct-password")
+        self.client = APIClient()
+
+    def login(self, password, address="203.0.113.5"):
+        return self.client.post(
+            "/api/auth/login/",
+            {"username": "reader", "password": password},
+            format="json",
+            REMOTE_ADDR=address,
+        )
+
+    def test_failed_attempts_are_limited(self):
+        for _ in range(5):
+            self.assertEqual(self.login("wrong").status_code, 401)
+
+        response = self.login("correct-password")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["X-RateLimit-Remaining"], "0")
+        self.assertIn("Retry-After", response)
+
+        # Another client is unaffected
+        self.assertEqual(self.login("correct-password", "203.0.113.6").status_code, 200)
+
+    def test_attempt_is_recorded_before_password_check(self):
+        limiter = SlidingWindowLimiter("login")
+
+        def check_quota(**credentials):
+            # A concurrent guess would already see this attempt counted
+            self.assertEqual(limiter.check("ip:203.0.113.5").remaining, 4)
+
+        with mock.patch("users.views.authenticate", side_effect=check_quota) as auth:
+            self.assertEqual(self.login("wrong").status_code, 401)
+        auth.assert_called_once()
+
+    def test_successful_login_resets_attempts(self):
+        for _ in range(4):
+            self.login("wrong")
+        self.assertEqual(self.login("correct-password").status_code, 200)
+        for _ in range(4):
+            self.assertEqual(self.login("wrong").status_code, 401)
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    RATE_LIMIT_BACKEND="local",
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    AUTH_HASH_WORKERS=0,
+    AUTH_HASH_QUEUE_SIZE=1,
+)
+class AsyncAuthViewsTest(TestCase):
+    """Register, login and logout run as async views."""
+
+    def setUp(self):
+        SlidingWindowLimiter._local_state.clear()
+        self.client = APIClient()
+
+    def test_register_login_logout(self):
+        credentials = {"username": "writer", "password": "a-long-passphrase-42"}
+        response = self.client.post(
+            "/api/auth/register/",
+            {**credentials, "email": "Writer@Example.com"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(
+            User.objects.get(username="writer").check_password(credentials["password"])
+        )
+
+        response = self.client.post("/api/auth/login/", credentials, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("access_token", response.cookies)
+
+        response = self.client.post("/api/auth/logout/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cookies["refresh_token"].value, "")
+        self.client.cookies.clear()
+        self.assertEqual(self.client.post("/api/auth/logout/").status_code, 401)
+
+    def test_invalid_body_is_rejected(self):
+        response = self.client.post(
+            "/api/auth/login/", "[]", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(AUTH_HASH_QUEUE_SIZE=0)
+    def test_saturated_hashing_sheds_load(self):
+        response = self.client.post(
+            "/api/auth/login/",
+            {"username": "writer", "password": "secret"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+
+
+@override_settings(TRUSTED_PROXIES=["10.0.0.0/8"])
+class ClientIpTest(TestCase):
+    """X-Forwarded-For is only honoured from trusted proxies."""
+
+    def ip(self, remote, forwarded=None):
+        meta = {"REMOTE_ADDR": remote}
+        if forwarded:
+            meta["HTTP_X_FORWARDED_FOR"] = forwarded
+        return get_client_ip(RequestFactory().get("/", **meta))
+
+    def test_untrusted_peer_cannot_spoof(self):
+        self.assertEqual(self.ip("203.0.113.5", "198.51.100.1"), "203.0.113.5")
+
+    def test_trusted_proxies_are_skipped(self):
+        # The client prepended a fake hop; the proxies appended the real one
+        self.assertEqual(
+            self.ip("10.0.0.2", "1.2.3.4, 203.0.113.5, 10.0.0.1"), "203.0.113.5"
+        )
+        self.assertEqual(self.ip("10.0.0.2"), "10.0.0.2")
+
+
+@override_settings(CACHES=TEST_CACHES, COMMENT_WS_REPLAY="local")
+class CachedJWTAuthenticationTest(TestCase):
+    """Access tokens resolve users from the cache, not a query per request."""
+
+    def setUp(self):
+        cache.clear()
+        _local_users.clear()
+        self.user = User.objects.create_user("reader", email="old@example.com")
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}"
+        )
+
+    def test_user_is_cached_until_saved(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get("/api/auth/check/").status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get("/api/auth/check/").status_code, 200)
+
+        self.user.email = "new@example.com"
+        self.user.save()
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/auth/check/")
+        self.assertEqual(response.json()["email"], "new@example.com")
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get("/api/auth/check/")
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get("/api/auth/check/").status_code, 401)
+
+    def test_shared_cache_holds_no_password_hash(self):
+        self.client.get("/api/auth/check/")
+        values = cache.get(f"{USER_CACHE_PREFIX}{self.user.pk}")
+        self.assertEqual(values["username"], "reader")
+        self.assertNotIn("password", values)
+
+    def test_admin_endpoint_loads_full_user(self):
+        self.assertEqual(self.client.get("/api/comments/cache_stats/").status_code, 403)
+        admin = User.objects.create_user("admin", is_staff=True)
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(admin)}"
+        )
+        self.assertEqual(self.client.get("/api/comments/cache_stats/").status_code, 200)
+
+    def test_comment_reads_trust_token_claims(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get("/api/comments/").status_code, 200)
+        self.assertFalse(any("auth_user" in query["sql"] for query in queries))
@@ -1,19 +1,30 @@
+import json
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenRefreshView
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.exceptions import (
+    AuthenticationFailed,
+    InvalidToken,
+    TokenError,
+)
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
-from django.core.cache import cache
+from comment_app.ratelimit import SlidingWindowLimiter, get_client_ip, set_rate_limit
 from rest_framework import status
 import logging
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.contrib.auth.password_validation import validate_password
 from rest_framework.permissions import IsAuthenticated
+from .authentication import CachedJWTAuthentication
+from .hashing import HashingBusy, run_hashing
 
 logger = logging.getLogger(__name__)
 
@@ -114,8 +125,39 @@ class AuthCheckView(APIView):
             )
 
 
-class RegisterView(APIView):
-    permission_classes = [AllowAny]
+def read_json(request):
+    """
+    Return the request body as a dict: JSON, or form fields as a fallback.
+
+    Raises:
+        ValueError: If the body is not a JSON object.
+    """
+    if request.content_type != "application/json":
+        return request.POST.dict()
+    data = json.loads(request.body or b"{}")
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
+    return data
+
+
+def busy_response():
+    """503 for requests shed because password hashing is saturated."""
+    response = JsonResponse(
+        {"error": "Server is busy. Please try again later."},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+    response["Retry-After"] = "1"
+    return response
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class RegisterView(View):
+    """
+    Create user accounts.
+
+    Async, so password hashing runs in the bounded hashing pool
+    (users/hashing.py) instead of a thread serving other requests.
+    """
 
     def validate_registration_data(self, username, email, password):
         """Validate registration input data"""
@@ -151,35 +193,37 @@ class RegisterView(APIView):
 
         return errors
 
-    def post(self, request):
+    async def post(self, request):
         try:
             # Extract data
-            username = request.data.get("username", "").strip()
-            email = request.data.get("email", "").strip().lower()
-            password = request.data.get("password", "")
+            data = read_json(request)
+            username = str(data.get("username", "")).strip()
+            email = str(data.get("email", "")).strip().lower()
+            password = str(data.get("password", ""))
 
             # Validate input data
-            validation_errors = self.validate_registration_data(
+            validation_errors = await sync_to_async(self.validate_registration_data)(
                 username, email, password
             )
 
             if validation_errors:
-                return Response(
+                return JsonResponse(
                     {"errors": validation_errors}, status=status.HTTP_400_BAD_REQUEST
                 )
 
             # Check if username exists
-            if User.objects.filter(username=username).exists():
+            if await User.objects.filter(username=username).aexists():
                 logger.warning(
                     f"Registration attempt with existing username: {username}"
                 )
-                return Response(
+                return JsonResponse(
                     {"error": "Username already taken"},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
-            # Create user
-            user = User.objects.create_user(
+            # Create user, hashing the password off the event loop
+            user = await run_hashing(
+                User.objects.create_user,
                 username=username,
                 email=email,
                 password=password,
@@ -189,7 +233,7 @@ class RegisterView(APIView):
             # Log successful registration
             logger.info(f"New user registered successfully: {username}")
 
-            return Response(
+            return JsonResponse(
                 {
                     "message": "Registration successful",
                     "user_id": user.id,
@@ -198,23 +242,31 @@ class RegisterView(APIView):
                 status=status.HTTP_201_CREATED,
             )
 
+        except HashingBusy:
+            return busy_response()
+        except ValueError:
+            return JsonResponse(
+                {"error": "Invalid request body"}, status=status.HTTP_400_BAD_REQUEST
+            )
         except Exception as e:
             logger.error(f"Registration error: {str(e)}", exc_info=True)
-            return Response(
+            return JsonResponse(
                 {"error": "Registration failed. Please try again later."},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
 
-class LoginView(APIView):
+@method_decorator(csrf_exempt, name="dispatch")
+class LoginView(View):
     """Handle user authentication and token generation."""
 
-    permission_classes = [AllowAny]
-
-    def post(self, request):
+    async def post(self, request):
         """
         Process login requests and generate authentication tokens.
 
+        The password check runs in the bounded hashing pool; when that is
+        saturated the request is refused with 503 instead of queueing.
+
         Args:
             request: HTTP request object containing username and password
 
@@ -222,55 +274,54 @@ class LoginView(APIView):
             Response with authentication tokens in cookies
         """
         try:
-            username = request.data.get("username")
-            password = request.data.get("password")
+            data = read_json(request)
+            username = data.get("username")
+            password = data.get("password")
 
             # Validate input
             if not username or not password:
-                return Response(
+                return JsonResponse(
                     {"error": "Username and password are required"},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
-            # Rate limiting
-            ip_address = request.META.get(
-                "HTTP_X_FORWARDED_FOR", request.META.get("REMOTE_ADDR")
-            )
-            cache_key = f"login_attempts_{ip_address}"
-            login_attempts = cache.get(cache_key, 0)
+            # Rate limiting: every attempt is recorded atomically before the
+            # slow password check, so concurrent guesses cannot all slip
+            # through; a successful login clears the count again
+            limiter = SlidingWindowLimiter("login")
+            client = f"ip:{get_client_ip(request)}"
+            quota = await sync_to_async(limiter.hit)(client)
+            set_rate_limit(request, quota)
 
-            if login_attempts >= 5:  # Max 5 attempts per 15 minutes
-                return Response(
+            if not quota.allowed:  # Max 5 failed attempts per 15 minutes
+                return JsonResponse(
                     {"error": "Too many login attempts. Please try again later."},
                     status=status.HTTP_429_TOO_MANY_REQUESTS,
                 )
 
-            # Authenticate user
-            user = authenticate(username=username, password=password)
+            # Authenticate user, hashing the password off the event loop
+            user = await run_hashing(authenticate, username=username, password=password)
 
             if not user:
-                # Increment failed login attempts
-                cache.set(cache_key, login_attempts + 1, 900)  # 15 minutes
-
                 logger.warning(f"Failed login attempt for username: {username}")
-                return Response(
+                return JsonResponse(
                     {"error": "Invalid credentials"},
                     status=status.HTTP_401_UNAUTHORIZED,
                 )
 
             if not user.is_active:
-                return Response(
+                return JsonResponse(
                     {"error": "Account is disabled"}, status=status.HTTP_403_FORBIDDEN
                 )
 
             # Generate tokens
-            refresh = RefreshToken.for_user(user)
+            refresh = await sync_to_async(RefreshToken.for_user)(user)
 
             # Clear failed login attempts on successful login
-            cache.delete(cache_key)
+            await sync_to_async(limiter.reset)(client)
 
             # Prepare response
-            response = Response(
+            response = JsonResponse(
                 {
                     "message": "Login successful",
                     "user": {
@@ -309,20 +360,38 @@ class LoginView(APIView):
 
             return response
 
+        except HashingBusy:
+            return busy_response()
+        except ValueError:
+            return JsonResponse(
+                {"error": "Invalid request body"}, status=status.HTTP_400_BAD_REQUEST
+            )
         except Exception as e:
             logger.error(f"Login error: {str(e)}")
-            return Response(
+            return JsonResponse(
                 {"error": "An error occurred during login"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
 
-class LogoutView(APIView):
-    """Handle user logout and token invalidation."""
+def blacklist_refresh_token(refresh_token, username):
+    """Blacklist a refresh token; invalid tokens are logged and ignored."""
+    try:
+        RefreshToken(refresh_token).blacklist()
 
-    permission_classes = [IsAuthenticated]
+        # Log successful token blacklisting
+        logger.info(f"Token blacklisted for user: {username}")
+
+    except TokenError as e:
+        logger.warning(f"Invalid token during logout for user: {username}")
+        # Continue with logout even if token is invalid
 
-    def post(self, request):
+
+@method_decorator(csrf_exempt, name="dispatch")
+class LogoutView(View):
+    """Handle user logout and token invalidation."""
+
+    async def post(self, request):
         """
         Process logout requests and invalidate tokens.
 
@@ -332,34 +401,31 @@ class LogoutView(APIView):
         Returns:
             Response confirming logout status
         """
+        try:
+            authenticated = await sync_to_async(CachedJWTAuthentication().authenticate)(
+                request
+            )
+        except (AuthenticationFailed, InvalidToken):
+            authenticated = None
+        if authenticated is None:
+            return self.handle_no_permission()
+        user = authenticated[0]
+
         try:
             # Get tokens from cookies
             refresh_token = request.COOKIES.get("refresh_token")
-            access_token = request.COOKIES.get("access_token")
 
             if not refresh_token:
-                return Response(
+                return JsonResponse(
                     {"error": "No refresh token provided"},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
-            try:
-                # Blacklist the refresh token
-                token = RefreshToken(refresh_token)
-                token.blacklist()
-
-                # Log successful token blacklisting
-                logger.info(f"Token blacklisted for user: {request.user.username}")
-
-            except TokenError as e:
-                logger.warning(
-                    f"Invalid token during logout for user: {request.user.username}"
-                )
-                # Continue with logout even if token is invalid
-                pass
+            # Blacklist the refresh token
+            await sync_to_async(blacklist_refresh_token)(refresh_token, user.username)
 
             # Prepare response
-            response = Response(
+            response = JsonResponse(
                 {"message": "Logout successful"}, status=status.HTTP_200_OK
             )
 
@@ -377,14 +443,14 @@ class LogoutView(APIView):
 
             # Clear any session data if using sessions
             if hasattr(request, "session"):
-                request.session.flush()
+                await request.session.aflush()
 
-            logger.info(f"Successful logout for user: {request.user.username}")
+            logger.info(f"Successful logout for user: {user.username}")
             return response
 
         except Exception as e:
-            logger.error(f"Logout error for user {request.user.username}: {str(e)}")
-            return Response(
+            logger.error(f"Logout error for user {user.username}: {str(e)}")
+            return JsonResponse(
                 {
                     "error": "An error occurred during logout",
                     "detail": str(e) if settings.DEBUG else "Please try again",
@@ -394,6 +460,6 @@ class LogoutView(APIView):
 
     def handle_no_permission(self):
         """Handle unauthorized logout attempts."""
-        return Response(
+        return JsonResponse(
             {"error": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED
         )
@@ -1,4 +1,4 @@
-import React, { createContext, useState, useEffect } from "react";
+import React, { createContext, useState, useEffect, useRef } from "react";
 import api from "./api";
 
 const AuthContext = createContext();
@@ -12,6 +12,48 @@ export const AuthProvider = ({ children }) => {
     const [currentPage, setCurrentPage] = useState(1);  
     const [isAuthenticated, setIsAuthenticated] = useState(false);
     const [loading, setLoading] = useState(true); // New state to load
+    const wsRef = useRef(null);
+    const commentsRef = useRef([]);
+    const subscribedRef = useRef(new Set());
+    const lastSeqRef = useRef(null);
+    const seenSeqsRef = useRef(new Set());
+    const [resyncCount, setResyncCount] = useState(0);
+
+    // Topics for the top-level feed and the replies of every comment on screen
+    const wantedTopics = () => {
+        const wanted = new Set();
+        const collect = (comments) => comments.forEach((comment) => {
+            wanted.add(`thread:${comment.id}`);
+            collect(comment.replies || []);
+        });
+        collect(commentsRef.current);
+        return wanted;
+    };
+
+    const syncSubscriptions = () => {
+        const ws = wsRef.current;
+        if (!ws || ws.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        const wanted = wantedTopics();
+
+        const subscribed = subscribedRef.current;
+        const added = [...wanted].filter((topic) => !subscribed.has(topic));
+        const removed = [...subscribed].filter((topic) => !wanted.has(topic));
+        if (added.length) {
+            ws.send(JSON.stringify({ action: "subscribe", topics: added }));
+        }
+        if (removed.length) {
+            ws.send(JSON.stringify({ action: "unsubscribe", topics: removed }));
+        }
+        subscribedRef.current = wanted;
+    };
+
+    useEffect(() => {
+        commentsRef.current = comments;
+        syncSubscriptions();
+        // eslint-disable-next-line react-hooks/exhaustive-deps
+    }, [comments]);
 
     useEffect(() => {
         const refreshToken = async () => {
@@ -82,7 +124,7 @@ export const AuthProvider = ({ children }) => {
         else {
             setComments([]);
         }
-    }, [currentPage, sortField, sortOrder, isAuthenticated]);
+    }, [currentPage, sortField, sortOrder, isAuthenticated, resyncCount]);
 
 
     useEffect(() => {
@@ -108,10 +150,48 @@ export const AuthProvider = ({ children }) => {
             });
         };
 
-            const ws = new WebSocket(process.env.REACT_APP_BASE_WS);
-            ws.onmessage = (event) => {
-                const newComment = JSON.parse(event.data);
+            const updateImageInTree = (comments, update) => {
+                return comments.map((comment) => {
+                    if (comment.id === update.id) {
+                        return { ...comment, image: update.image, image_status: update.image_status };
+                    }
+                    if (comment.replies && comment.replies.length > 0) {
+                        return { ...comment, replies: updateImageInTree(comment.replies, update) };
+                    }
+                    return comment;
+                });
+            };
+
+            const handleMessage = (newComment) => {
                 console.log('New comment received:', newComment);
+
+                if (newComment.event === 'subscribed' || newComment.event === 'unsubscribed') {
+                    return;
+                }
+
+                if (newComment.event === 'resync') {
+                    // Missed events are gone from the server buffer: refetch
+                    lastSeqRef.current = null;
+                    setResyncCount((count) => count + 1);
+                    return;
+                }
+
+                if (newComment.seq !== undefined) {
+                    // Replayed and live events can overlap after a reconnect
+                    if (seenSeqsRef.current.has(newComment.seq)) {
+                        return;
+                    }
+                    seenSeqsRef.current.add(newComment.seq);
+                    if (seenSeqsRef.current.size > 1000) {
+                        seenSeqsRef.current = new Set([...seenSeqsRef.current].slice(-500));
+                    }
+                    lastSeqRef.current = Math.max(lastSeqRef.current || 0, newComment.seq);
+                }
+
+                if (newComment.event === 'image_ready') {
+                    setComments((prevComments) => updateImageInTree(prevComments, newComment));
+                    return;
+                }
     
                 setComments((prevComments) => {
                     if (newComment.parent) {
@@ -124,16 +204,55 @@ export const AuthProvider = ({ children }) => {
                     }
                 });
             };
-    
-            ws.onerror = (error) => {
-                console.error('WebSocket Error:', error);
+
+            let attempts = 0;
+            let reconnectTimer = null;
+            let closed = false;
+
+            const connect = () => {
+                // ?batch=1: the server coalesces events into JSON arrays;
+                // ?topics=: new threads plus the threads on screen;
+                // ?last_seq=: resume where the previous socket stopped
+                const topics = ["top", ...wantedTopics()];
+                const params = new URLSearchParams({ batch: "1", topics: topics.join(",") });
+                if (lastSeqRef.current !== null) {
+                    params.set("last_seq", lastSeqRef.current);
+                }
+                const ws = new WebSocket(`${process.env.REACT_APP_BASE_WS}?${params}`);
+                wsRef.current = ws;
+                ws.onopen = () => {
+                    attempts = 0;
+                    subscribedRef.current = new Set(topics.slice(1));
+                    syncSubscriptions();
+                };
+                ws.onmessage = (event) => {
+                    const data = JSON.parse(event.data);
+                    (Array.isArray(data) ? data : [data]).forEach(handleMessage);
+                };
+
+                ws.onerror = (error) => {
+                    console.error('WebSocket Error:', error);
+                };
+
+                ws.onclose = () => {
+                    console.log('WebSocket connection closed');
+                    if (closed) {
+                        return;
+                    }
+                    // Jittered exponential backoff so clients don't reconnect in lockstep
+                    const delay = Math.min(30000, 1000 * 2 ** attempts) * (0.5 + Math.random() / 2);
+                    attempts += 1;
+                    reconnectTimer = setTimeout(connect, delay);
+                };
             };
-    
-            ws.onclose = () => {
-                console.log('WebSocket connection closed');
+
+            connect();
+            return () => {
+                closed = true;
+                clearTimeout(reconnectTimer);
+                wsRef.current.close();
             };
-    
-            return () => ws.close();
+            // eslint-disable-next-line react-hooks/exhaustive-deps
         }, []);
 
     const login = async (username, password) => {